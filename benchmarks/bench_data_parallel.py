@@ -0,0 +1,67 @@
+'''
+Benchmark for data-parallel training.
+
+Measures training samples/sec of an MLP with the batches split among worker
+processes (see `cortex.utils.parallel`), for several numbers of workers.
+Speedups need as many free cores as workers; limit the BLAS threads of each
+process to compare fairly.
+
+Try with `OMP_NUM_THREADS=1 python bench_data_parallel.py -b 400 -w 1 2 4`.
+'''
+
+import argparse
+import numpy as np
+import time
+
+from cortex.utils import floatX
+from cortex.utils.tools import print_section
+from cortex.utils.training import set_optimizer
+
+from bench_optimizer import make_mlp
+
+
+def run_steps(f_grad_shared, inps, lr, steps):
+    '''Runs fused training steps and returns steps/sec.
+
+    '''
+    t0 = time.time()
+    for s in xrange(steps):
+        f_grad_shared(*(inps + [lr]))
+    return steps / (time.time() - t0)
+
+def main(batch_size=400, dim_in=784, dim_h=500, steps=200, optimizer='sgd',
+         workers=None):
+    if workers is None:
+        workers = [1, 2, 4]
+
+    rng = np.random.RandomState(0)
+    X = (rng.uniform(size=(batch_size, dim_in)) > 0.5).astype(floatX)
+    Y = np.eye(10, dtype=floatX)[rng.randint(0, 10, size=(batch_size,))]
+
+    print_section('MLP (batch size %d, %d-%d-10, %s)'
+                  % (batch_size, dim_in, dim_h, optimizer))
+    base = None
+    for n_workers in workers:
+        inputs, cost, tparams, constants, updates = make_mlp(dim_in, dim_h)
+        f_grad_shared, _, _ = set_optimizer(
+            inputs, cost, tparams, constants, updates, [],
+            optimizer=optimizer, n_workers=n_workers)
+        run_steps(f_grad_shared, [X, Y], 0.001, 5)
+        rate = run_steps(f_grad_shared, [X, Y], 0.001, steps) * batch_size
+        if n_workers > 1:
+            f_grad_shared.close()
+        if base is None:
+            base = rate
+        print '%d workers:\t%.1f samples/sec (x%.2f)' % (
+            n_workers, rate, rate / base)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-b', '--batch_size', type=int, default=400)
+    parser.add_argument('-i', '--dim_in', type=int, default=784)
+    parser.add_argument('-d', '--dim_h', type=int, default=500)
+    parser.add_argument('-s', '--steps', type=int, default=200)
+    parser.add_argument('-o', '--optimizer', default='sgd')
+    parser.add_argument('-w', '--workers', type=int, nargs='+', default=None)
+    args = parser.parse_args()
+    main(**vars(args))
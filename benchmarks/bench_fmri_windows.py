@@ -0,0 +1,113 @@
+'''
+Benchmark for window extraction in `FMRI.next`.
+
+Compares the old per-window loop with the vectorized gather across window and
+batch sizes, on synthetic sequences sized like masked fMRI.
+
+Try with `python bench_fmri_windows.py -s 20 -t 200 -d 30000`.
+'''
+
+import argparse
+import numpy as np
+import time
+
+from cortex.datasets.neuroimaging.fmri import FMRI
+from cortex.utils import floatX
+from cortex.utils.tools import print_section
+
+
+def make_fmri(X, Y, window, batch_size, stride=1, batch_buffers=0):
+    '''Makes an FMRI iterator on arrays without going through files.
+
+    '''
+    fmri = FMRI.__new__(FMRI)
+    fmri.name = 'fmri'
+    fmri.X = X
+    fmri.Y = Y
+    fmri.window = window
+    fmri.stride = stride
+    fmri.batch_size = batch_size
+    fmri.batch_buffers = batch_buffers
+    fmri.shuffle = True
+    fmri.inf = False
+    fmri.pos = 0
+    fmri._buffers = dict()
+    fmri._buffer_i = 0
+    fmri._window_offsets = np.arange(window)
+
+    n_subjects, n_scans = X.shape[:2]
+    scan_idx = np.arange(0, n_scans - window + 1, stride)
+    fmri.idx = np.zeros((n_subjects * len(scan_idx), 2), dtype='int64')
+    fmri.idx[:, 0] = np.repeat(np.arange(n_subjects), len(scan_idx))
+    fmri.idx[:, 1] = np.tile(scan_idx, n_subjects)
+    fmri.n = fmri.idx.shape[0]
+    fmri.randomize()
+    return fmri
+
+def next_loop(fmri):
+    '''The per-window loop `FMRI.next` used before vectorization.
+
+    '''
+    batch_size = fmri.batch_size
+    if fmri.pos == -1:
+        fmri.reset()
+        raise StopIteration
+
+    idxs = [fmri.idx[i] for i in range(fmri.pos, fmri.pos+batch_size)]
+    x = np.array([fmri.X[i][j:j+fmri.window] for i, j in idxs]).astype(floatX).transpose(1, 0, 2)
+    y = np.array([fmri.Y[i][j:j+fmri.window] for i, j in idxs]).astype(floatX).transpose(1, 0, 2)
+
+    fmri.pos += batch_size
+    if fmri.pos + batch_size > fmri.n:
+        fmri.pos = -1
+    return {fmri.name: x, 'group': y}
+
+def run_epoch(f_next, max_batches):
+    '''Draws batches for an epoch and returns batches/sec.
+
+    '''
+    batches = 0
+    t0 = time.time()
+    while batches < max_batches:
+        try:
+            f_next()
+        except StopIteration:
+            break
+        batches += 1
+    return batches / (time.time() - t0)
+
+def main(subjects=20, scans=200, dim=30000, windows=(10, 50),
+         batch_sizes=(10, 100), max_batches=100):
+    X = np.random.normal(size=(subjects, scans, dim)).astype(floatX)
+    Y = np.zeros((subjects, scans, 2), dtype=floatX)
+    Y[:, :, 0] = 1
+
+    for window in windows:
+        for batch_size in batch_sizes:
+            print_section('Window %d, batch size %d' % (window, batch_size))
+            fmri = make_fmri(X, Y, window, batch_size)
+            rate = run_epoch(lambda: next_loop(fmri), max_batches)
+            print 'Loop:\t\t\t%.2f batches/sec' % rate
+
+            fmri = make_fmri(X, Y, window, batch_size)
+            rate_v = run_epoch(fmri.next, max_batches)
+            print 'Vectorized:\t\t%.2f batches/sec (x%.2f)' % (
+                rate_v, rate_v / rate)
+
+            fmri = make_fmri(X, Y, window, batch_size, batch_buffers=2)
+            rate_b = run_epoch(fmri.next, max_batches)
+            print 'Vectorized, buffered:\t%.2f batches/sec (x%.2f)' % (
+                rate_b, rate_b / rate)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-s', '--subjects', type=int, default=20)
+    parser.add_argument('-t', '--scans', type=int, default=200)
+    parser.add_argument('-d', '--dim', type=int, default=30000)
+    parser.add_argument('-w', '--windows', type=int, nargs='+',
+                        default=[10, 50])
+    parser.add_argument('-b', '--batch_sizes', type=int, nargs='+',
+                        default=[10, 100])
+    parser.add_argument('-m', '--max_batches', type=int, default=100)
+    args = parser.parse_args()
+    main(**vars(args))
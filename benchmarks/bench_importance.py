@@ -0,0 +1,58 @@
+'''
+Benchmark for chunked importance sampling.
+
+Measures samples/sec of `-log p(x)` estimates with many posterior samples for
+several chunk sizes (see `cortex.inference.importance`), along with the size
+of the largest array of a chunk (the conditional outputs), which bounds the
+memory used.
+
+Try with `python bench_importance.py -n 5000 -c 10 100 1000`.
+'''
+
+import argparse
+import numpy as np
+
+from cortex.inference.importance import ImportanceSampler
+from cortex.models.helmholtz import Helmholtz
+from cortex.utils import floatX
+from cortex.utils.tools import print_section
+
+
+def main(batch_size=100, dim_in=784, dim_h=200, n_posterior_samples=1000,
+         chunk_sizes=None):
+    if chunk_sizes is None:
+        chunk_sizes = [10, 100, 1000]
+
+    model = Helmholtz.factory(
+        dim_h, distributions=dict(input='binomial'), dims=dict(input=dim_in),
+        prior='gaussian', rec_args=dict(input_layer='input', dim_h=500,
+                                        n_layers=2),
+        gen_args=dict(output='input', dim_h=500, n_layers=2))
+    model.set_tparams()
+
+    rng = np.random.RandomState(0)
+    X = (rng.uniform(size=(batch_size, dim_in)) > 0.5).astype(floatX)
+
+    print_section('GBN (batch size %d, %d-500-%d, %d posterior samples)'
+                  % (batch_size, dim_in, dim_h, n_posterior_samples))
+    for chunk_size in chunk_sizes:
+        sampler = ImportanceSampler(model, chunk_size=chunk_size)
+        sampler(X, n_posterior_samples=chunk_size)
+        rval = sampler(X, n_posterior_samples=n_posterior_samples)
+        mbytes = (min(chunk_size, n_posterior_samples) * batch_size * dim_in
+                  * np.dtype(floatX).itemsize / 2. ** 20)
+        print ('chunk %d:\t%.1f samples/sec\t-log p(x) %.3f\tlog ESS %.3f'
+               '\t(%.1f MB per chunk output)' % (
+                   chunk_size, rval['samples/sec'], rval['-log p(x)'],
+                   rval['log ESS'], mbytes))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-b', '--batch_size', type=int, default=100)
+    parser.add_argument('-i', '--dim_in', type=int, default=784)
+    parser.add_argument('-d', '--dim_h', type=int, default=200)
+    parser.add_argument('-n', '--n_posterior_samples', type=int, default=1000)
+    parser.add_argument('-c', '--chunk_sizes', type=int, nargs='+',
+                        default=None)
+    args = parser.parse_args()
+    main(**vars(args))
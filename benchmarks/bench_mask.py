@@ -0,0 +1,81 @@
+'''
+Benchmark for masking and unmasking MRI volumes.
+
+Compares the batched gather/scatter in `MRI._mask` and `MRI._unmask` against
+the previous per-sample loops over realistic volume sizes.
+
+Try with `python bench_mask.py -n 200`.
+'''
+
+import argparse
+import numpy as np
+import time
+
+from cortex.datasets.neuroimaging.mri import MRI
+from cortex.utils import floatX
+
+
+# 3mm and 2mm MNI volumes.
+volume_shapes = [(53, 63, 46), (91, 109, 91)]
+
+
+def loop_mask(X, mask):
+    '''Masking as done before, one sample at a time.
+
+    '''
+    mask_idx = np.where(mask.flatten() == 1)[0].tolist()
+    X_masked = np.zeros((X.shape[0], int(mask.sum()))).astype(floatX)
+    for i, x in enumerate(X):
+        X_masked[i] = x.flatten()[mask_idx]
+    return X_masked
+
+def loop_unmask(X_masked, mask):
+    '''Unmasking as done before, one sample at a time.
+
+    '''
+    mask_idx = np.where(mask.flatten() == 1)[0].tolist()
+    X = np.zeros((X_masked.shape[0],) + mask.shape).astype(floatX)
+    for i, x_m in enumerate(X_masked):
+        x_f = X[i].flatten()
+        x_f[mask_idx] = x_m
+        X[i] = x_f.reshape(mask.shape)
+    return X
+
+def timeit(f, *args, **kwargs):
+    t0 = time.time()
+    rval = f(*args, **kwargs)
+    return rval, time.time() - t0
+
+def main(n=100):
+    for shape in volume_shapes:
+        mask = (np.random.uniform(size=shape) > 0.5).astype('float32')
+        X = np.random.normal(size=(n,) + shape).astype(floatX)
+
+        mri = MRI.__new__(MRI)
+        mri.mask = mask
+        mri.image_shape = shape
+
+        print 'Volume %r, %d samples, %d voxels in mask' % (
+            shape, n, int(mask.sum()))
+
+        x_loop, dt_loop = timeit(loop_mask, X, mask)
+        x_vec, dt_vec = timeit(mri._mask, X)
+        out = np.empty_like(x_vec)
+        _, dt_out = timeit(mri._mask, X, out=out)
+        assert np.allclose(x_loop, x_vec)
+        print '\tmask:\tloop %.3fs, batched %.3fs (x%.1f), preallocated %.3fs' % (
+            dt_loop, dt_vec, dt_loop / dt_vec, dt_out)
+
+        X_loop, dt_loop = timeit(loop_unmask, x_vec, mask)
+        X_vec, dt_vec = timeit(mri._unmask, x_vec)
+        _, dt_out = timeit(mri._unmask, x_vec, out=X_vec)
+        assert np.allclose(X_loop, X_vec)
+        print '\tunmask:\tloop %.3fs, batched %.3fs (x%.1f), preallocated %.3fs' % (
+            dt_loop, dt_vec, dt_loop / dt_vec, dt_out)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-n', '--n', type=int, default=100,
+                        help='Number of volumes.')
+    args = parser.parse_args()
+    main(**vars(args))
@@ -0,0 +1,97 @@
+'''
+Benchmark for fused optimizer steps.
+
+Measures training steps/sec for the optimizers in `cortex.utils.op` with the
+fused single-call step and with separate gradient and update functions, on
+small-batch MLP and RBM training where call overhead dominates.
+
+Try with `python bench_optimizer.py -b 10 -o sgd rmsprop adam`.
+'''
+
+import argparse
+from collections import OrderedDict
+import numpy as np
+import theano
+from theano import tensor as T
+import time
+
+from cortex.models.mlp import MLP
+from cortex.models.rbm import RBM
+from cortex.utils import floatX
+from cortex.utils.tools import print_section
+from cortex.utils.training import set_optimizer
+
+
+def make_mlp(dim_in, dim_h, dim_out=10):
+    X = T.matrix('x', dtype=floatX)
+    Y = T.matrix('y', dtype=floatX)
+    model = MLP(dim_in, dim_out, dim_h=dim_h, n_layers=2,
+                distribution='multinomial')
+    tparams = model.set_tparams()
+    p = model(X)['p']
+    cost = model.neg_log_prob(Y, p).mean()
+    return [X, Y], cost, tparams, [], theano.OrderedUpdates()
+
+def make_rbm(dim_in, dim_h):
+    X = T.matrix('x', dtype=floatX)
+    model = RBM(dim_in, dim_h)
+    tparams = model.set_tparams()
+    results, _, updates, constants = model(X)
+    return [X], results['cost'], tparams, constants, updates
+
+def run_steps(f_grad_shared, f_grad_updates, inps, lr, steps):
+    '''Runs training steps and returns steps/sec.
+
+    '''
+    t0 = time.time()
+    for s in xrange(steps):
+        if f_grad_updates is None:
+            f_grad_shared(*(inps + [lr]))
+        else:
+            f_grad_shared(*inps)
+            f_grad_updates(lr)
+    return steps / (time.time() - t0)
+
+def compare(make_model, make_inputs, optimizer, steps, lr=0.001):
+    rates = OrderedDict()
+    for fused in [False, True]:
+        inputs, cost, tparams, constants, updates = make_model()
+        f_grad_shared, f_grad_updates, _ = set_optimizer(
+            inputs, cost, tparams, constants, updates, [],
+            optimizer=optimizer, optimizer_args=dict(fused=fused))
+        inps = make_inputs()
+        run_steps(f_grad_shared, f_grad_updates, inps, lr, 10)
+        rates[fused] = run_steps(f_grad_shared, f_grad_updates, inps, lr,
+                                 steps)
+
+    print '%s:\ttwo calls %.2f steps/sec, fused %.2f steps/sec (x%.2f)' % (
+        optimizer, rates[False], rates[True], rates[True] / rates[False])
+
+def main(batch_size=10, dim_in=784, dim_h=200, steps=2000,
+         optimizers=None):
+    if optimizers is None:
+        optimizers = ['sgd', 'rmsprop', 'adam', 'adadelta']
+
+    rng = np.random.RandomState(0)
+    X = (rng.uniform(size=(batch_size, dim_in)) > 0.5).astype(floatX)
+    Y = np.eye(10, dtype=floatX)[rng.randint(0, 10, size=(batch_size,))]
+
+    print_section('MLP (batch size %d, %d-%d-10)' % (batch_size, dim_in, dim_h))
+    for optimizer in optimizers:
+        compare(lambda: make_mlp(dim_in, dim_h), lambda: [X, Y], optimizer,
+                steps)
+
+    print_section('RBM (batch size %d, %d-%d)' % (batch_size, dim_in, dim_h))
+    for optimizer in optimizers:
+        compare(lambda: make_rbm(dim_in, dim_h), lambda: [X], optimizer,
+                steps)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-b', '--batch_size', type=int, default=10)
+    parser.add_argument('-i', '--dim_in', type=int, default=784)
+    parser.add_argument('-d', '--dim_h', type=int, default=200)
+    parser.add_argument('-s', '--steps', type=int, default=2000)
+    parser.add_argument('-o', '--optimizers', nargs='+', default=None)
+    args = parser.parse_args()
+    main(**vars(args))
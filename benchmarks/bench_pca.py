@@ -0,0 +1,57 @@
+'''
+Benchmark for the PCA backends of the MRI dataset.
+
+Compares fit time and reconstruction error of exact, randomized and
+incremental PCA on synthetic low-rank data with noise, sized like masked
+MRI.
+
+Try with `python bench_pca.py -n 2000 -d 50000 -k 100`.
+'''
+
+import argparse
+import numpy as np
+import time
+
+from cortex.datasets.neuroimaging.mri import MRI
+from cortex.utils import floatX
+
+
+def make_data(n, dim, rank, noise=0.5):
+    '''Low-rank data with isotropic noise.
+
+    '''
+    U = np.random.normal(size=(n, rank)).astype(floatX)
+    V = np.random.normal(size=(rank, dim)).astype(floatX)
+    X = U.dot(V) / np.sqrt(rank)
+    X += noise * np.random.normal(size=X.shape).astype(floatX)
+    return X
+
+def main(n=2000, dim=50000, components=100, chunk_size=500):
+    X = make_data(n, dim, rank=components // 2)
+    print 'Data: %d x %d, %d components' % (n, dim, components)
+
+    x_norm = (X ** 2).sum()
+    for backend in ['full', 'randomized', 'incremental']:
+        mri = MRI.__new__(MRI)
+        mri.pca_components = components
+        mri.pca_backend = backend
+        mri.chunk_size = chunk_size
+        pca = mri._make_pca()
+
+        t0 = time.time()
+        pca.fit(X)
+        dt_fit = time.time() - t0
+
+        X_r = pca.inverse_transform(pca.transform(X))
+        err = ((X - X_r) ** 2).sum() / x_norm
+        print '%s:\tfit %.2fs, relative reconstruction error %.5f' % (
+            backend, dt_fit, err)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-n', '--n', type=int, default=2000)
+    parser.add_argument('-d', '--dim', type=int, default=50000)
+    parser.add_argument('-k', '--components', type=int, default=100)
+    parser.add_argument('-c', '--chunk_size', type=int, default=500)
+    args = parser.parse_args()
+    main(**vars(args))
@@ -0,0 +1,87 @@
+'''
+Benchmark for background prefetching of batches.
+
+Measures training steps/sec with and without
+`cortex.datasets.prefetch.PrefetchDataset` on MNIST and on a synthetic array
+the size of a large MRI dataset.
+
+Try with `python bench_prefetch.py -s $data/basic/mnist.pkl.gz`.
+'''
+
+import argparse
+import numpy as np
+import theano
+from theano import tensor as T
+import time
+
+from cortex.datasets import BasicDataset
+from cortex.datasets.basic.mnist import MNIST
+from cortex.datasets.prefetch import PrefetchDataset
+from cortex.utils import floatX
+from cortex.utils.tools import print_section
+
+
+def make_step(dim_in, dim_h=500):
+    '''Makes a compiled step with roughly the cost of a small MLP update.
+
+    '''
+    X = T.matrix('x', dtype=floatX)
+    W = theano.shared(
+        (0.01 * np.random.randn(dim_in, dim_h)).astype(floatX), name='W')
+    H = T.tanh(T.dot(X, W))
+    cost = (H ** 2).mean()
+    updates = [(W, W - 0.001 * T.grad(cost, W))]
+    return theano.function([X], cost, updates=updates)
+
+def run_epochs(data_iter, f_step, epochs):
+    '''Runs epochs and returns steps/sec.
+
+    '''
+    steps = 0
+    t0 = time.time()
+    for e in xrange(epochs):
+        while True:
+            try:
+                x = data_iter.next()[data_iter.name]
+            except StopIteration:
+                break
+            f_step(x)
+            steps += 1
+    return steps / (time.time() - t0)
+
+def compare(make_dataset, epochs, depth):
+    dataset = make_dataset()
+    f_step = make_step(dataset.dims[dataset.name])
+
+    rate = run_epochs(dataset, f_step, epochs)
+    print 'No prefetch:\t\t%.2f steps/sec' % rate
+
+    prefetched = PrefetchDataset(make_dataset(), depth=depth)
+    rate_p = run_epochs(prefetched, f_step, epochs)
+    prefetched.close()
+    print 'Prefetch (depth %d):\t%.2f steps/sec (x%.2f)' % (
+        depth, rate_p, rate_p / rate)
+
+def main(source=None, batch_size=100, epochs=3, depth=2, n_mri=2000,
+         dim_mri=60000):
+    if source is not None:
+        print_section('MNIST')
+        compare(lambda: MNIST(source=source, batch_size=batch_size), epochs,
+                depth)
+
+    print_section('Synthetic MRI (%d x %d)' % (n_mri, dim_mri))
+    X = np.random.normal(size=(n_mri, dim_mri)).astype(floatX)
+    Y = np.random.randint(0, 2, size=(n_mri,)).astype(floatX)
+    compare(lambda: BasicDataset({'mri': X, 'group': Y}, name='mri',
+                                 labels='group', batch_size=batch_size),
+            epochs, depth)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-s', '--source', default=None,
+                        help='MNIST source. If not set, MNIST is skipped.')
+    parser.add_argument('-b', '--batch_size', type=int, default=100)
+    parser.add_argument('-e', '--epochs', type=int, default=3)
+    parser.add_argument('-d', '--depth', type=int, default=2)
+    args = parser.parse_args()
+    main(**vars(args))
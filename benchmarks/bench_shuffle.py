@@ -0,0 +1,71 @@
+'''
+Benchmark for shuffling in `BasicDataset`.
+
+Compares time per epoch and peak memory of the copy-based shuffle against
+index-permutation shuffling, with and without reused output buffers. Each
+mode runs in its own process so peak memory is measured separately.
+
+Try with `python bench_shuffle.py -n 5000 -d 60000`.
+'''
+
+import argparse
+import multiprocessing as mp
+import numpy as np
+import resource
+import time
+
+from cortex.datasets import BasicDataset
+from cortex.utils import floatX
+
+
+def max_rss():
+    '''Peak resident memory of this process in MB.
+
+    '''
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.
+
+def run_mode(queue, n, dim, batch_size, epochs, shuffle_mode, batch_buffers):
+    # Filled in chunks so the float64 draws do not set the peak.
+    X = np.empty((n, dim), dtype=floatX)
+    for i in xrange(0, n, 100):
+        X[i:i+100] = np.random.normal(size=X[i:i+100].shape)
+    Y = np.random.randint(0, 2, size=(n,)).astype(floatX)
+    rss0 = max_rss()
+
+    dataset = BasicDataset({'mri': X, 'group': Y}, name='mri', labels='group',
+                           batch_size=batch_size, shuffle_mode=shuffle_mode,
+                           batch_buffers=batch_buffers)
+
+    t0 = time.time()
+    for e in xrange(epochs):
+        while True:
+            try:
+                x = dataset.next()[dataset.name]
+            except StopIteration:
+                break
+    dt = (time.time() - t0) / epochs
+    queue.put((dt, max_rss() - rss0))
+
+def main(n=5000, dim=60000, batch_size=100, epochs=3):
+    print 'Data: %d x %d (%.1f MB)' % (
+        n, dim, n * dim * np.dtype(floatX).itemsize / 1024. ** 2)
+    for shuffle_mode, batch_buffers in [('copy', 0), ('index', 0),
+                                        ('index', 2)]:
+        queue = mp.Queue()
+        p = mp.Process(target=run_mode,
+                       args=(queue, n, dim, batch_size, epochs, shuffle_mode,
+                             batch_buffers))
+        p.start()
+        dt, rss = queue.get()
+        p.join()
+        print '%s (%d buffers):\t%.3f sec/epoch, +%.1f MB peak' % (
+            shuffle_mode, batch_buffers, dt, rss)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-n', '--n', type=int, default=5000)
+    parser.add_argument('-d', '--dim', type=int, default=60000)
+    parser.add_argument('-b', '--batch_size', type=int, default=100)
+    parser.add_argument('-e', '--epochs', type=int, default=3)
+    args = parser.parse_args()
+    main(**vars(args))
@@ -6,13 +6,15 @@ import readline, glob
 from os import path
 import urllib2
 
-from datasets import fetch_basic_data
-from datasets.neuroimaging import fetch_neuroimaging_data
-from utils.tools import get_paths
-from utils.extra import complete_path, query_yes_no, write_path_conf
-
 
 def main():
+    # Imported here so that Theano-free subpackages (e.g., `cortex.runtime`)
+    # can be imported without it.
+    from datasets import fetch_basic_data
+    from datasets.neuroimaging import fetch_neuroimaging_data
+    from utils.tools import get_paths
+    from utils.extra import complete_path, query_yes_no, write_path_conf
+
     readline.set_completer_delims(' \t\n;')
     readline.parse_and_bind('tab: complete')
     readline.set_completer(complete_path)
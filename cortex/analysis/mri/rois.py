@@ -7,7 +7,6 @@ Module for finding ROIS for MRI niftis
 import argparse
 import itertools
 import logging
-import multiprocessing as mp
 from nipy import load_image
 from nipy import save_image
 import numpy as np
@@ -20,9 +19,13 @@ from scipy import (
     argmax, sqrt, ceil, floor, sign,
     negative, linspace, double,
 )
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
 import subprocess
 from sys import stdout
 
+from ...utils.tools import resolve_path
+
 
 # These are general names of regions for use elsewhere.
 singles = ['Postcentral Gyrus',
@@ -82,15 +85,135 @@ def check_pair(toproi, rois, lr_cm):
 
     return toproi
 
-def find_clusters_from_3D(fnifti, thr):
-    '''Function to use afni command line to find clusters from a 3D nifti.
+def _connection_offsets(rmm):
+    '''Voxel offsets within a connection radius.
 
-    This currently calls afni functions from command line.
-    TODO(dhjelm): change this to use nipy functions.
+    Only one of each pair of opposite offsets is returned, as connections are
+    symmetric.
+
+    Args:
+        rmm (float): connection radius in voxels.
+
+    Returns:
+        list: list of (di, dj, dk) offsets.
+
+    '''
+    r = int(floor(rmm))
+    offsets = []
+    for d in itertools.product(range(-r, r + 1), repeat=3):
+        if d > (0, 0, 0) and sum(x ** 2 for x in d) <= rmm ** 2 + 1e-6:
+            offsets.append(d)
+    return offsets
+
+def find_clusters(data, affine, thr, lower=-2., rmm=2., min_volume=80):
+    '''Finds clusters in 3D maps by connected-component labeling.
+
+    Follows the conventions of AFNI's
+    `3dclust -2thresh lower thr -dxyz=1 rmm min_volume`: voxels with
+    `lower < value < thr` or value 0 are dropped, two voxels are connected if
+    they are within `rmm` voxels of each other, and clusters with fewer than
+    `min_volume` voxels are dropped. Coordinates are in mm in AFNI's RAI
+    (DICOM) order, as `3dclust` and `whereami` use.
+
+    All the maps of a 4D array are labeled in one pass: connections never
+    cross the last axis.
+
+    Args:
+        data (numpy.array): 3D map or 4D array of maps along the last axis.
+        affine (numpy.array): voxel to world (RAS) affine of the image.
+            Extra dimensions beyond the first 3 are ignored.
+        thr (float): upper threshold.
+        lower (float): lower threshold.
+        rmm (float): connection radius in voxels.
+        min_volume (int): minimum number of voxels in a cluster.
+
+    Returns:
+        list: for each map, list of cluster dictionaries with `volume`,
+            `cm` (centre of mass, weighted by absolute intensity),
+            `mean_intensity` (mean absolute intensity, as 3dclust without
+            `-noabs`) and `coords` (peak absolute intensity),
+            sorted by decreasing volume. A list of cluster dictionaries for
+            a 3D map.
+
+    '''
+    data = np.asarray(data)
+    if data.ndim == 3:
+        return find_clusters(data[..., None], affine, thr, lower=lower,
+                             rmm=rmm, min_volume=min_volume)[0]
+    elif data.ndim != 4:
+        raise ValueError('Data must be 3D or 4D (got shape %r)'
+                         % (data.shape,))
+
+    shape = data.shape
+    mask = ((data <= lower) | (data >= thr)) & (data != 0)
+    n_voxels = int(mask.sum())
+    if n_voxels == 0:
+        return [[] for _ in xrange(shape[3])]
+
+    # Connected components of the graph of voxels within rmm of each other.
+    lin = -np.ones(shape, dtype='int64')
+    lin[mask] = np.arange(n_voxels)
+    rows = []
+    cols = []
+    for d in _connection_offsets(rmm):
+        src = tuple(slice(max(0, -x), shape[i] - max(0, x))
+                    for i, x in enumerate(d))
+        dst = tuple(slice(max(0, x), shape[i] - max(0, -x))
+                    for i, x in enumerate(d))
+        a = lin[src]
+        b = lin[dst]
+        keep = (a >= 0) & (b >= 0)
+        rows.append(a[keep])
+        cols.append(b[keep])
+    rows = np.concatenate(rows)
+    cols = np.concatenate(cols)
+    graph = coo_matrix((np.ones(rows.shape[0], dtype='int8'), (rows, cols)),
+                       shape=(n_voxels, n_voxels))
+    n_labels, labels = connected_components(graph, directed=False)
+
+    # Per-cluster statistics.
+    i, j, k, f = np.nonzero(mask)
+    values = data[mask].astype('float64')
+    weights = abs(values)
+    volume = np.bincount(labels, minlength=n_labels)
+    weight_sum = np.bincount(labels, weights, minlength=n_labels)
+    mean = weight_sum / volume
+    ijk = np.array([i, j, k], dtype='float64')
+    cm = np.array([np.bincount(labels, weights * x, minlength=n_labels)
+                   for x in ijk]) / weight_sum
+    feature = np.zeros(n_labels, dtype='int64')
+    feature[labels] = f
+
+    order = np.lexsort((-weights, labels))
+    _, first = np.unique(labels[order], return_index=True)
+    peak = ijk[:, order[first]]
+
+    affine = np.asarray(affine, dtype='float64')
+    rai = np.array([-1., -1., 1.])[:, None]
+    def to_rai(x):
+        return rai * (affine[:3, :3].dot(x) + affine[:3, -1][:, None])
+    cm = to_rai(cm)
+    peak = to_rai(peak)
+
+    clusters = [[] for _ in xrange(shape[3])]
+    for c in np.argsort(-volume, kind='mergesort'):
+        if volume[c] < min_volume:
+            break
+        clusters[feature[c]].append(dict(
+            volume=int(volume[c]),
+            cm=tuple(cm[:, c]),
+            mean_intensity=mean[c],
+            coords=tuple(peak[:, c])
+        ))
+    return clusters
+
+def find_clusters_from_3D(fnifti, thr, **kwargs):
+    '''Finds clusters from a 3D nifti.
 
     Args:
         fnifti (str): Nifti file to process.
         thr (float): threshold used for clusters.
+        **kwargs: keyword arguments for `find_clusters`.
 
     Returns:
         list: clusters
@@ -99,31 +222,19 @@ def find_clusters_from_3D(fnifti, thr):
     if not path.isfile(fnifti):
         raise IOError('%s not found' % fnifti)
 
-    cmd = ('3dclust -1Dformat -quiet -nosum -2thresh -2 %.2f '
-           '-dxyz=1 2 80 2>/dev/null %s' % (thr, fnifti))
-    fields = [1, 2, 3, 4, 5, 6, 11, 14, 15, 16]
-    field_strs = ['$%d' % i for i in fields]
-    tab_str = '\"\\t\"'
-    awk = 'awk \'{ print ' + tab_str.join(field_strs) + '}\''
-    cmdline = '%s | %s' % (cmd, awk)
-
-    proc = subprocess.Popen(cmdline, stdout=subprocess.PIPE, shell=True)
-    (out, err) = proc.communicate()
-
-    if '#**' in out.split(): return []
+    nifti = load_image(fnifti)
+    return find_clusters(nifti.get_data(), nifti.affine, thr, **kwargs)
 
-    cluster = [float(o) for o in out.split()]
-    return cluster
+def find_clusters_from_4D(fnifti, i, thr, **kwargs):
+    '''Finds clusters from one feature of a 4D nifti.
 
-def find_clusters_from_4D(fnifti, i, thr):
-    '''Function to use afni command line to find clusters from a 4D nifti.
-
-    TODO(dhjelm): change this to use nipy functions.
+    Use `find_clusters` on the whole array to process all features at once.
 
     Args:
         fnifti (str): Nifti file to process.
         i (int): Index of the feature in the nifti file.
         thr (float): threshold used for clusters.
+        **kwargs: keyword arguments for `find_clusters`.
 
     Returns:
         list: List of 3d clusters.
@@ -132,19 +243,9 @@ def find_clusters_from_4D(fnifti, i, thr):
     assert isinstance(i, int)
     assert isinstance(thr, (int, float))
 
-    cmd = ("3dclust "
-           "-1Dformat -quiet -nosum -1dindex %d -1tindex %d -2thresh -2 %.2f "
-           "-dxyz=1 2 80 2>/dev/null" %
-           (i, i, thr))
-    awk = "awk '{ print $1\"\t\"$2\"\t\"$3\"\t\"$4\"\t\"$5\"\t\"$6\"\t\"$11\"\t\"$14\"\t\"$15\"\t\"$16}'"
-    cmdline = cmd + " '%s'| " % fnifti + awk
-    proc = subprocess.Popen(cmdline, stdout=subprocess.PIPE, shell=True)
-    (out, err) = proc.communicate()
-
-    if "#**" in out.split(): return []
-
-    clusters = float16(out.split())
-    return clusters
+    nifti = load_image(fnifti)
+    return find_clusters(nifti.get_data()[..., i], nifti.affine, thr,
+                         **kwargs)
 
 def check_grey(coords):
     '''Function to check if a particular cluster corresponds to grey matter.
@@ -203,10 +304,161 @@ def return_region(coords, atlas):
     return region
 
 
+class Atlas(object):
+    '''Atlas label volume held in memory for coordinate lookups.
+
+    Attributes:
+        name (str): name of the atlas.
+        labels (numpy.array): 3D integer label volume. 0 is unlabeled.
+        affine (numpy.array): voxel to MNI (RAS) affine.
+        names (dict): region name of each label.
+
+    '''
+    def __init__(self, name, nifti_file, labels_file):
+        '''Init function for Atlas.
+
+        Args:
+            name (str): name of the atlas.
+            nifti_file (str): nifti of integer labels, e.g. made with
+                `3dcopy CA_N27_ML+tlrc CA_N27_ML.nii.gz`.
+            labels_file (str): text file of `<label> <region name>` lines.
+
+        '''
+        nifti = load_image(nifti_file)
+        labels = np.asarray(nifti.get_data())
+        labels = labels.reshape(labels.shape[:3])
+        affine = np.asarray(nifti.affine, dtype='float64')
+
+        self.name = name
+        self.labels = np.round(labels).astype('int64')
+        self.affine = np.eye(4)
+        self.affine[:3, :3] = affine[:3, :3]
+        self.affine[:3, 3] = affine[:3, -1]
+        self._inv_affine = np.linalg.inv(self.affine)
+        self.names = read_atlas_labels(labels_file)
+
+    def lookup(self, coords):
+        '''Region names at a batch of coordinates.
+
+        Args:
+            coords (numpy.array): RAI coordinates in mm, shape (n, 3).
+
+        Returns:
+            list: region name for each coordinate, None if unlabeled.
+
+        '''
+        xyz = np.asarray(coords, dtype='float64').reshape((-1, 3))
+        xyz = xyz * np.array([-1., -1., 1.])
+        ijk = np.round(xyz.dot(self._inv_affine[:3, :3].T)
+                       + self._inv_affine[:3, 3]).astype('int64')
+        inside = np.all((ijk >= 0) & (ijk < self.labels.shape), axis=1)
+        labels = np.zeros(ijk.shape[0], dtype='int64')
+        labels[inside] = self.labels[tuple(ijk[inside].T)]
+        return [self.names.get(l, None) if l != 0 else None for l in labels]
+
+
+def read_atlas_labels(labels_file):
+    '''Reads the region names of an atlas.
+
+    Args:
+        labels_file (str): text file of `<label> <region name>` lines, as
+            printed by `whereami -show_atlas_code`. `#` lines are skipped.
+
+    Returns:
+        dict: region name of each label.
+
+    '''
+    names = {}
+    with open(labels_file, 'r') as f:
+        for line in f:
+            line = line.strip()
+            if len(line) == 0 or line.startswith('#'):
+                continue
+            label, name = re.split(r'[\s:]+', line, 1)
+            names[int(label)] = ' '.join(name.split())
+    return names
+
+
+class AtlasIndex(object):
+    '''Region name lookups over several atlases, with a cache.
+
+    Attributes:
+        atlases (list): list of Atlas.
+
+    '''
+    def __init__(self, atlases):
+        self.atlases = atlases
+        self._cache = {}
+
+    def region_names(self, coords):
+        '''Region names from all atlases for a batch of coordinates.
+
+        Coordinates already looked up are answered from the cache, the rest
+        are looked up in one batch per atlas.
+
+        Args:
+            coords (list): RAI coordinates in mm, each of length 3.
+
+        Returns:
+            list: for each coordinate, list of region names.
+
+        '''
+        keys = [tuple(np.round(np.asarray(c, dtype='float64'), 2))
+                for c in coords]
+        missing = list(set(k for k in keys if k not in self._cache))
+        if len(missing) > 0:
+            found = [atlas.lookup(missing) for atlas in self.atlases]
+            for i, k in enumerate(missing):
+                self._cache[k] = list(set(
+                    f[i] for f in found if f[i] is not None))
+        return [list(self._cache[k]) for k in keys]
+
+
+atlas_names = ['CA_N27_ML', 'CA_ML_18_MNIA', 'TT_Daemon']
+_atlas_indices = {}
+
+def get_atlas_index(atlas_dir=None):
+    '''Loads the atlases once per process.
+
+    Each atlas in `atlas_names` is read from `<atlas_dir>/<name>.nii.gz` (or
+    `.nii`) and `<atlas_dir>/<name>.txt`.
+
+    Args:
+        atlas_dir (Optional[str]): directory of atlas files. Defaults to
+            `$data/atlases`.
+
+    Returns:
+        AtlasIndex: or None if any atlas file is missing.
+
+    '''
+    if atlas_dir is None:
+        try:
+            atlas_dir = resolve_path(path.join('$data', 'atlases'))
+        except ValueError:
+            return None
+
+    if atlas_dir in _atlas_indices:
+        return _atlas_indices[atlas_dir]
+
+    atlases = []
+    for name in atlas_names:
+        nifti_files = [path.join(atlas_dir, name + ext)
+                       for ext in ['.nii.gz', '.nii']]
+        nifti_files = [f for f in nifti_files if path.isfile(f)]
+        labels_file = path.join(atlas_dir, name + '.txt')
+        if len(nifti_files) == 0 or not path.isfile(labels_file):
+            return None
+        atlases.append(Atlas(name, nifti_files[0], labels_file))
+
+    _atlas_indices[atlas_dir] = AtlasIndex(atlases)
+    return _atlas_indices[atlas_dir]
+
 def find_region_names(coords):
     '''Get region names from a set of atlases.
 
-    Only 3 atlases are currently supported, but more could be added in the future.
+    Only 3 atlases are currently supported, but more could be added in the
+    future. Atlases are looked up in memory if their files are found (see
+    `get_atlas_index`), otherwise with AFNI's `whereami`.
 
     Args:
         coords (tuple or list): coordinates, chould be length 3.
@@ -216,41 +468,62 @@ def find_region_names(coords):
 
     '''
     assert len(coords) == 3
+    return find_all_region_names([coords])[0]
 
-    n27 = 'CA_N27_ML'
-    mnia = 'CA_ML_18_MNIA'
-    tt = 'TT_Daemon'
+def find_all_region_names(coords):
+    '''Get region names for a batch of coordinates.
 
-    rois = []
-    for atlas in [n27, mnia, tt]:
-        rois += return_region(coords, atlas)
+    Args:
+        coords (list): coordinates, each of length 3.
+
+    Returns:
+        list: for each coordinate, list of regions of interest.
+
+    '''
+    atlas_index = get_atlas_index()
+    if atlas_index is not None:
+        return atlas_index.region_names(coords)
 
-    rois = list(set(rois))
+    all_rois = []
+    for c in coords:
+        rois = []
+        for atlas in atlas_names:
+            rois += return_region(c, atlas)
+        all_rois.append(list(set(rois)))
+    return all_rois
 
-    return rois
+def get_cluster_info(clusters, region_names=None):
+    '''Adds region names to clusters and finds the top cluster.
+
+    Args:
+        clusters (list): cluster dictionaries from `find_clusters`.
+        region_names (Optional[list]): region names at the peak of each
+            cluster. Looked up if not given.
+
+    Returns:
+        dict: cluster dictionaries by index, plus `top_clust`.
 
-def get_cluster_info(clusters):
+    '''
     if len(clusters) == 0:
         return {}
 
+    if region_names is None:
+        region_names = find_all_region_names([c['coords'] for c in clusters])
+
     cluster_dict = {}
     intensity_sum = 0
     # Retrieve information on all the clusters.
-    for c in range(len(clusters) // 10):
-        cs = clusters[c * 10: (c+1) * 10]
-        intensity_sum += abs(cs[0] * cs[6])
+    for c, cluster in enumerate(clusters):
+        intensity_sum += abs(cluster['volume'] * cluster['mean_intensity'])
 
-        cm = tuple([cs[x] for x in [1, 2, 3]])
-        coords = tuple([cs[x] for x in [7, 8, 9]])
-
-        rois = find_region_names(coords)
+        rois = region_names[c]
 #            grey_value = check_grey(coords)
 
         cluster_dict[c] = dict(
-            coords = coords,
-            volume = cs[0],
-            cm = cm,
-            mean_intensity = abs(cs[6]),
+            coords = cluster['coords'],
+            volume = cluster['volume'],
+            cm = cluster['cm'],
+            mean_intensity = abs(cluster['mean_intensity']),
             rois = rois
             )
 #                             'grey_value': grey_value}
@@ -272,23 +545,24 @@ def get_cluster_info(clusters):
 
     return cluster_dict
 
-def cluster_worker(fnifti, thr, roi_dict):
-    clusters = find_clusters_from_3D(fnifti, thr)
-    try:
-        idx = int(fnifti.split('/')[-1].split('.')[0])
-    except:
-        idx = int(fnifti.split('/')[-1].split('.')[0].split('_')[-1])
-    roi_dict[idx] = get_cluster_info(clusters)
+def nifti_index(fnifti):
+    '''Feature index from a nifti file name, e.g. `tmp_image_3.nii.gz`.
 
-def worker_helper(args):
-    cluster_worker(*args)
+    '''
+    try:
+        return int(fnifti.split('/')[-1].split('.')[0])
+    except ValueError:
+        return int(fnifti.split('/')[-1].split('.')[0].split('_')[-1])
 
-def find_rois(fnifti, thr, test=False):
+def find_rois(fnifti, thr, test=False, **kwargs):
     '''Function for finding regions of interest from a nifti file.
 
+    Clusters of all features are found in one pass, then named.
+
     Args:
         fnifti (str): path to the nifti file or list of paths to files
         thr (float): threshold for clusters.
+        **kwargs: keyword arguments for `find_clusters`.
 
     Returns
         dict: regions of interest
@@ -299,27 +573,35 @@ def find_rois(fnifti, thr, test=False):
 
     if isinstance(fnifti, str):
         nifti = load_image(fnifti)
-        num_features = nifti.shape[-1]
-        roi_dict = {}
-
-        for i in xrange(num_features):
-            clusters = find_clusters_from_4D(fnifti, i, thr)
-            roi_dict[i] = get_cluster_info(clusters)
+        clusters = find_clusters(nifti.get_data(), nifti.affine, thr,
+                                 **kwargs)
+        idx = range(len(clusters))
 
     elif isinstance(fnifti, list):
-        num_features = len(fnifti)
-        roi_dict = mp.Manager().dict()
-        p = mp.Pool(num_features)
-        args_iter = itertools.izip(fnifti,
-                                   itertools.repeat(thr),
-                                   itertools.repeat(roi_dict))
-        p.map(worker_helper, args_iter)
-        p.close()
-        p.join()
-        roi_dict = dict(roi_dict)
+        niftis = [load_image(f) for f in fnifti]
+        idx = [nifti_index(f) for f in fnifti]
+        if len(set(n.shape for n in niftis)) == 1:
+            data = np.concatenate(
+                [n.get_data().reshape(n.shape[:3] + (-1,)) for n in niftis],
+                axis=3)
+            if data.shape[3] != len(niftis):
+                raise ValueError('Expected 3D niftis when a list is given.')
+            clusters = find_clusters(data, niftis[0].affine, thr, **kwargs)
+        else:
+            clusters = [find_clusters(n.get_data(), n.affine, thr, **kwargs)
+                        for n in niftis]
     else:
         raise NotImplementedError('Type %s not supported' % type(fnifti))
 
+    # Region names of all the clusters are looked up at once.
+    region_names = find_all_region_names(
+        [c['coords'] for cs in clusters for c in cs])
+    roi_dict = {}
+    start = 0
+    for i, cs in zip(idx, clusters):
+        roi_dict[i] = get_cluster_info(
+            cs, region_names=region_names[start:start + len(cs)])
+        start += len(cs)
     roi_dict = dict((k, v) for k, v in roi_dict.iteritems() if len(v) > 0)
 
     print('Finished. Found %d clusters' % len(roi_dict))
@@ -0,0 +1,110 @@
+'''
+Tests for cluster finding on synthetic maps.
+'''
+
+from nipy import save_image
+from nipy.core.api import Image, vox2mni
+import numpy as np
+from os import path
+import shutil
+import tempfile
+
+from cortex.analysis.mri.rois import atlas_names, find_clusters, get_atlas_index
+
+
+def make_maps(shape=(20, 20, 20)):
+    '''Two maps with known clusters.
+
+    '''
+    data = np.zeros(shape + (2,), dtype='float32')
+    # Positive 5x5x5 cube, peak at (3, 4, 5).
+    data[2:7, 2:7, 2:7, 0] = 3.
+    data[3, 4, 5, 0] = 5.
+    # Negative 4x4x4 cube.
+    data[10:14, 10:14, 10:14, 0] = -4.
+    # Too small.
+    data[17, 17, 17, 0] = 10.
+    # Two 4x4x8 slabs with a 1 voxel gap: one cluster at rmm=2, two at rmm=1.
+    data[2:6, 2:6, 2:10, 1] = 2.5
+    data[2:6, 2:6, 11:19, 1] = 2.5
+    return data
+
+def test_find_clusters(min_volume=10):
+    data = make_maps()
+    affine = np.eye(4)
+    affine[:3, 3] = [-10., -10., -10.]
+
+    clusters = find_clusters(data, affine, 2., min_volume=min_volume)
+    assert len(clusters) == 2
+
+    assert [c['volume'] for c in clusters[0]] == [125, 64]
+    c = clusters[0][0]
+    assert np.allclose(c['mean_intensity'], (124 * 3. + 5.) / 125)
+    assert np.allclose(c['coords'], (-(3 - 10.), -(4 - 10.), 5 - 10.))
+    cm = (4 * 125 * 3. + np.array([3., 4., 5.]) * 2.) / (124 * 3. + 5.)
+    assert np.allclose(c['cm'], (-(cm[0] - 10.), -(cm[1] - 10.), cm[2] - 10.))
+    # Means of absolute values, as 3dclust.
+    assert np.allclose(clusters[0][1]['mean_intensity'], 4.)
+    assert np.allclose(clusters[0][1]['cm'], (-1.5, -1.5, 1.5))
+
+    assert [c['volume'] for c in clusters[1]] == [256]
+    clusters_1 = find_clusters(data, affine, 2., min_volume=min_volume,
+                               rmm=1.)
+    assert [c['volume'] for c in clusters_1[1]] == [128, 128]
+
+    # Thresholds
+    assert [c['volume'] for c in find_clusters(
+        data, affine, 6., lower=-5., min_volume=1)[0]] == [1]
+    assert len(find_clusters(data, affine, 2., lower=-5.,
+                             min_volume=min_volume)[0]) == 1
+
+    # One map at a time gives the same clusters.
+    for i in xrange(data.shape[3]):
+        clusters_i = find_clusters(data[..., i], affine, 2.,
+                                   min_volume=min_volume)
+        assert len(clusters_i) == len(clusters[i])
+        for c, c_i in zip(clusters[i], clusters_i):
+            for k in c.keys():
+                assert np.allclose(c[k], c_i[k])
+
+def test_mixed_signs(shape=(10, 10, 10)):
+    # One cluster with both signs, as with a lower threshold.
+    data = np.zeros(shape, dtype='float32')
+    data[2:4, 2:4, 2:4] = 3.
+    data[4:6, 2:4, 2:4] = -5.
+    clusters = find_clusters(data, np.eye(4), 2., lower=-2., min_volume=1)
+    assert [c['volume'] for c in clusters] == [16]
+    assert np.allclose(clusters[0]['mean_intensity'], 4.)
+
+def test_atlas_index():
+    out_dir = tempfile.mkdtemp()
+    try:
+        affine = np.eye(4) * 2.
+        affine[3, 3] = 1.
+        affine[:3, 3] = [-10., -10., -10.]
+        for name in atlas_names:
+            labels = np.zeros((10, 10, 10), dtype='int16')
+            labels[:5] = 1
+            labels[5:, :5] = 2
+            save_image(Image(labels, vox2mni(affine)),
+                       path.join(out_dir, name + '.nii.gz'))
+            with open(path.join(out_dir, name + '.txt'), 'w') as f:
+                f.write('# %s\n1 : Left %s\n2    Right  %s\n'
+                        % (name, name, name))
+
+        atlas_index = get_atlas_index(out_dir)
+        assert atlas_index is get_atlas_index(out_dir)
+        assert get_atlas_index(path.join(out_dir, 'missing')) is None
+
+        # RAI coordinates: x and y are negated MNI.
+        coords = [(6., 0., 0.), (-6., 6., 0.), (-6., -6., 0.), (100., 0., 0.),
+                  (6., 0., 0.)]
+        names = atlas_index.region_names(coords)
+        assert sorted(names[0]) == sorted('Left ' + n for n in atlas_names)
+        assert sorted(names[1]) == sorted('Right ' + n for n in atlas_names)
+        assert names[2] == []
+        assert names[3] == []
+        assert names[4] == names[0]
+        assert len(atlas_index._cache) == 4
+    finally:
+        shutil.rmtree(out_dir)
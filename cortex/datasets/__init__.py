@@ -3,9 +3,12 @@ Generic dataset class
 '''
 
 from collections import OrderedDict
+import copy
+import hashlib
 import numpy as np
 import os
 from os import path
+import pprint
 import random
 
 from ..utils.tools import resolve_path
@@ -83,7 +86,8 @@ def load_data(dataset=None,
 
     For these datasets, train/valid/test split has already been made.
     For the batch sizes, if any are None, the corresponding dataset
-    will also be None.
+    will also be None. Datasets loaded with `share_data` are not loaded
+    again.
 
     Args:
         dataset (str): name of the dataset
@@ -106,30 +110,102 @@ def load_data(dataset=None,
     else:
         C = dataset
 
-    if train_batch_size is not None:
-        train = C(batch_size=train_batch_size,
-                  mode='train',
-                  inf=False,
-                  **dataset_args)
-    else:
-        train = None
-    if valid_batch_size is not None:
-        valid = C(batch_size=valid_batch_size,
-                  mode='valid',
-                  inf=False,
-                  **dataset_args)
-    else:
-        valid = None
-    if test_batch_size is not None:
-        test = C(batch_size=test_batch_size,
-                 mode='test',
-                 inf=False,
-                 **dataset_args)
-    else:
-        test = None
+    def make(batch_size, mode):
+        if batch_size is None:
+            return None
+        shared = _shared_data.get(_shared_key(dataset, mode, dataset_args))
+        if shared is not None:
+            return _copy_shared(shared, batch_size)
+        return C(batch_size=batch_size, mode=mode, inf=False, **dataset_args)
+
+    train = make(train_batch_size, 'train')
+    valid = make(valid_batch_size, 'valid')
+    test = make(test_batch_size, 'test')
 
     return train, valid, test
 
+# Datasets loaded by `share_data`, by dataset arguments and mode.
+_shared_data = dict()
+
+def _shared_key(dataset, mode, dataset_args):
+    return pprint.pformat(dict(dataset_args, dataset=dataset, mode=mode))
+
+def _copy_shared(shared, batch_size):
+    '''Iterator over a shared dataset.
+
+    The arrays are not copied. Shuffling permutes the sample order only.
+
+    '''
+    template, shuffle = shared
+    d = copy.copy(template)
+    d.data = dict(template.data)
+    d.batch_size = batch_size
+    d.shuffle = shuffle
+    d.inf = False
+    d.pos = 0
+    d.shuffle_mode = 'index'
+    d.order = np.arange(d.n)
+    d._buffers = dict()
+    d._buffer_i = 0
+    if d.shuffle:
+        d.randomize()
+    return d
+
+def share_data(out_dir, dataset=None, modes=('train', 'valid', 'test'),
+               resolve_dataset=None, **dataset_args):
+    '''Loads a dataset once for `load_data` calls with the same arguments.
+
+    The arrays of each mode are saved to `out_dir` and memory-mapped, so
+    processes forked afterwards (e.g., the trials of `utils.sweep`) share one
+    read-only copy through the page cache. `load_data` with the same dataset
+    arguments then returns iterators over these arrays, whatever the batch
+    size. Only `BasicDataset` subclasses are shared.
+
+    Args:
+        out_dir (str): directory for the arrays.
+        dataset (str): name of the dataset.
+        modes (list): modes to load.
+        resolve_dataset (Optional[function]): see `load_data`.
+        **dataset_args: dataset arguments, as passed to `load_data`.
+
+    Returns:
+        bool: True if the dataset is shared.
+
+    '''
+    if resolve_dataset is None:
+        resolve_dataset = resolve
+
+    if isinstance(dataset, str):
+        C = resolve_dataset(dataset)
+    else:
+        C = dataset
+
+    if not issubclass(C, BasicDataset):
+        print 'Dataset %s cannot be shared' % C.__name__
+        return False
+
+    if not path.isdir(out_dir):
+        os.makedirs(out_dir)
+
+    kwargs = dict(dataset_args)
+    shuffle = kwargs.pop('shuffle', True)
+    for mode in modes:
+        key = _shared_key(dataset, mode, dataset_args)
+        if key in _shared_data:
+            continue
+        template = C(batch_size=1, mode=mode, inf=False, shuffle=False,
+                     **kwargs)
+        prefix = path.join(out_dir, hashlib.sha1(key).hexdigest()[:16])
+        for k, v in template.data.iteritems():
+            data_file = '%s_%s.npy' % (prefix, k)
+            np.save(data_file, v)
+            template.data[k] = np.load(data_file, mmap_mode='r')
+        template.X = template.data[template.name]
+        if template.labels in template.data.keys():
+            template.Y = template.data[template.labels]
+        _shared_data[key] = (template, shuffle)
+    return True
+
 def load_data_split(C, idx=None, dataset=None, **dataset_args):
     '''Load dataset and split.
 
@@ -220,10 +296,13 @@ class Dataset(object):
         stop (int): stop the dataset at this index when loading.
         mode (str): usually train, test, valid.
         balance (bool): replicate samples to balance the dataset.
+        drop_last (bool): end the epoch before a last batch shorter than the
+            batch size.
 
     '''
     def __init__(self, batch_size=None, shuffle=True, inf=False, name='dataset',
-                 mode=None, stop=None, balance=False, **kwargs):
+                 mode=None, stop=None, balance=False, drop_last=True,
+                 **kwargs):
         '''Init function for Dataset
 
         Args:
@@ -235,6 +314,7 @@ class Dataset(object):
             stop (int): stop the dataset at this index when loading.
             mode (str): usually train, test, valid.
             balance (bool): replicate samples to balance the dataset.
+            drop_last (bool): end the epoch before a short last batch.
             **kwargs: keyword arguments not used
 
         Returns:
@@ -252,6 +332,7 @@ class Dataset(object):
         self.stop = stop
         self.mode = mode
         self.balance = balance
+        self.drop_last = drop_last
 
         return kwargs
 
@@ -296,10 +377,22 @@ class BasicDataset(Dataset):
         X (numpy.array): MRI data.
         Y (Optional[numpy.array]): If not None, lables.
         mean_image (numpy.array): mean image of primary data.
+        shuffle_mode (str): `copy` permutes the arrays in `data` on each
+            shuffle, `index` leaves them in place and permutes `order`.
+        order (numpy.array or None): sample order used by `next` in `index`
+            mode.
+        batch_buffers (int): number of reused output buffers per array in
+            `index` mode. If 0, each batch is newly allocated.
+        index_key (str or None): if not None, batches also have the positions
+            of their samples in the dataset under this key, e.g., for caches
+            indexed by sample (see `inference.cache`).
+        positions (numpy.array or None): positions of the samples in `data`
+            in `copy` mode, permuted along with them.
 
     '''
     def __init__(self, data, distributions=None, labels='label', name=None,
-                **kwargs):
+                 shuffle_mode='copy', batch_buffers=0, index_key=None,
+                 **kwargs):
         '''Init function for BasicDataset.
 
         Args:
@@ -309,6 +402,12 @@ class BasicDataset(Dataset):
             labels (str): key for the labels.
             name: (Optional[str]): Name of the dataset. Should be one of the
                 keys in data.
+            shuffle_mode (str): `copy` or `index`.
+            batch_buffers (int): number of output buffers to cycle through in
+                `index` mode. Batches are only valid until the buffer is
+                reused, `batch_buffers` calls to `next` later.
+            index_key (Optional[str]): key for the positions of the samples
+                in batches.
             **kwargs: extra arguments to pass to Dataset constructor.
 
         '''
@@ -317,10 +416,19 @@ class BasicDataset(Dataset):
             raise ValueError('array argument must be a dict.')
         if name is None:
             name = data.keys()[0]
+        if shuffle_mode not in ['copy', 'index']:
+            raise ValueError('Shuffle mode %s not supported' % shuffle_mode)
 
         super(BasicDataset, self).__init__(name=name, **kwargs)
         self.data = data
         self.n = None
+        self.shuffle_mode = shuffle_mode
+        self.batch_buffers = batch_buffers
+        self.index_key = index_key
+        self.order = None
+        self.positions = None
+        self._buffers = dict()
+        self._buffer_i = 0
 
         self.dims = dict()
         if distributions is None:
@@ -362,6 +470,11 @@ class BasicDataset(Dataset):
         if labels in self.data.keys():
             self.Y = self.data[labels]
 
+        if self.shuffle_mode == 'index':
+            self.order = np.arange(self.n)
+        elif self.index_key is not None:
+            self.positions = np.arange(self.n).astype('int32')
+
     def balance_labels(self):
         '''Balanced the dataset.
 
@@ -393,10 +506,45 @@ class BasicDataset(Dataset):
     def randomize(self):
         '''Randomizes the dataset
 
+        In `index` mode only the sample order is permuted.
+
         '''
         rnd_idx = np.random.permutation(np.arange(0, self.n, 1))
+        if self.shuffle_mode == 'index':
+            self.order = rnd_idx
+            return
         for k in self.data.keys():
             self.data[k] = self.data[k][rnd_idx]
+        if self.positions is not None:
+            self.positions = self.positions[rnd_idx]
+
+    def _gather(self, k, idx):
+        '''Gathers the samples at idx from an array of data.
+
+        Indices are sorted so rows are read in memory order.
+
+        Args:
+            k (str): key of the array in data.
+            idx (numpy.array): sorted sample indices.
+
+        Returns:
+            numpy.array: gathered samples.
+
+        '''
+        v = self.data[k]
+        if not self.batch_buffers:
+            return v.take(idx, axis=0)
+
+        shape = (idx.shape[0],) + v.shape[1:]
+        buffers = self._buffers.get(k, None)
+        if (buffers is None or len(buffers) != self.batch_buffers
+            or buffers[0].shape != shape):
+            buffers = [np.empty(shape, dtype=v.dtype)
+                       for _ in xrange(self.batch_buffers)]
+            self._buffers[k] = buffers
+
+        out = buffers[self._buffer_i % self.batch_buffers]
+        return v.take(idx, axis=0, out=out, mode='clip')
 
     def next(self, batch_size=None):
         '''Draws the next batch of data samples.
@@ -420,11 +568,26 @@ class BasicDataset(Dataset):
 
         rval = OrderedDict()
 
-        for k, v in self.data.iteritems():
-            rval[k] = v[self.pos:self.pos+batch_size]
+        if self.order is None:
+            for k, v in self.data.iteritems():
+                rval[k] = v[self.pos:self.pos+batch_size]
+            if self.index_key is not None:
+                rval[self.index_key] = self.positions[
+                    self.pos:self.pos+batch_size]
+        else:
+            idx = np.sort(self.order[self.pos:self.pos+batch_size])
+            for k in self.data.keys():
+                rval[k] = self._gather(k, idx)
+            self._buffer_i += 1
+            if self.index_key is not None:
+                rval[self.index_key] = idx.astype('int32')
 
         self.pos += batch_size
-        if self.pos + batch_size > self.n:
+        if self.drop_last:
+            end = self.pos + batch_size > self.n
+        else:
+            end = self.pos >= self.n
+        if end:
             self.pos = -1
 
         return rval
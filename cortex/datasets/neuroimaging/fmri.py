@@ -19,6 +19,7 @@ from ...analysis.mri import rois
 from .. import Dataset, make_one_hot
 from .mri import MRI
 from . import nifti_viewer
+from .out_of_core import ConcatenatedArray
 from ...utils import floatX
 from ...utils.tools import resolve_path
 
@@ -84,6 +85,7 @@ class FMRI_IID(MRI):
             self.pca = None
 
         self.extras = dict((k, np.load(v)) for k, v in extras.iteritems())
+        self.sites = None
 
         if isinstance(data_files, str):
             data_files = [data_files]
@@ -91,15 +93,26 @@ class FMRI_IID(MRI):
         Y = []
         for i, data_file in enumerate(data_files):
             print 'Loading %s' % data_file
-            X_ = np.load(data_file)
-            X.append(X_.astype(floatX))
+            if self._mmap_data:
+                X_ = np.load(data_file, mmap_mode='r')
+                X.append(X_)
+            else:
+                X_ = np.load(data_file)
+                X.append(X_.astype(floatX))
             Y.append((np.zeros((X_.shape[0] * X_.shape[1],)) + i).astype(floatX))
 
-        X = np.concatenate(X, axis=0)
         Y = np.concatenate(Y, axis=0)
 
-        self.n_subjects, self.n_scans, _, _, _ = X.shape
-        X = X.reshape((X.shape[0] * X.shape[1],) + X.shape[2:])
+        if self._mmap_data:
+            self.n_subjects = sum(X_.shape[0] for X_ in X)
+            self.n_scans = X[0].shape[1]
+            X = ConcatenatedArray(
+                [X_.reshape((X_.shape[0] * X_.shape[1],) + X_.shape[2:])
+                 for X_ in X])
+        else:
+            X = np.concatenate(X, axis=0)
+            self.n_subjects, self.n_scans, _, _, _ = X.shape
+            X = X.reshape((X.shape[0] * X.shape[1],) + X.shape[2:])
 
         return X, Y
 
@@ -112,8 +125,8 @@ class FMRI(FMRI_IID):
     Attributes:
         window (int): window size of fMRI batches.
         stride (int): stride of fMRI batches.
-        n (int): number of subjects.
-        idx (list): indices of subject, scan-window pairs.
+        n (int): number of windows.
+        idx (numpy.array): (subject, scan) pair of the start of each window.
 
     '''
 
@@ -136,20 +149,24 @@ class FMRI(FMRI_IID):
         self.X = self.X.reshape((self.n_subjects, self.n_scans, self.X.shape[1]))
         self.Y = self.Y.reshape((self.n_subjects, self.n_scans, self.Y.shape[1]))
 
+        subject_idx = range(self.n_subjects)
         if idx is not None:
-            self.X = self.X[idx]
-            self.Y = self.Y[idx]
+            if self.out_of_core:
+                # Windows are drawn from the selected subjects in place.
+                subject_idx = list(idx)
+            else:
+                self.X = self.X[idx]
+                self.Y = self.Y[idx]
+                subject_idx = range(len(idx))
             self.n_subjects = len(idx)
 
-        scan_idx = range(0, self.n_scans - window + 1, stride)
-        scan_idx_e = scan_idx * self.n_subjects
-        subject_idx = range(self.n_subjects)
-        # Similar to np.repeat, but using list comprehension.
-        subject_idx_e = [i for j in [[s] * len(scan_idx) for s in subject_idx]
-                         for i in j]
-        # idx is list of (subject, scan)
-        self.idx = zip(subject_idx_e, scan_idx_e)
-        self.n = len(self.idx)
+        scan_idx = np.arange(0, self.n_scans - window + 1, stride)
+        # idx is array of (subject, scan)
+        self.idx = np.zeros((len(subject_idx) * len(scan_idx), 2), dtype='int64')
+        self.idx[:, 0] = np.repeat(subject_idx, len(scan_idx))
+        self.idx[:, 1] = np.tile(scan_idx, len(subject_idx))
+        self.n = self.idx.shape[0]
+        self._window_offsets = np.arange(window)
 
         if self.shuffle:
             self.randomize()
@@ -161,7 +178,43 @@ class FMRI(FMRI_IID):
 
         '''
         rnd_idx = np.random.permutation(np.arange(0, self.n, 1))
-        self.idx = [self.idx[i] for i in rnd_idx]
+        self.idx = self.idx[rnd_idx]
+
+    def _gather_windows(self, k, A, idx):
+        '''Gathers windows from an array of sequences.
+
+        All windows are read with one `take` on the flattened
+        (subject * scan) axis. The result is time-major, so no transpose is
+        needed.
+
+        Args:
+            k (str): key for the output buffers.
+            A (numpy.array): array of shape (subjects, scans, dim).
+            idx (numpy.array): (subject, scan) pairs of the window starts.
+
+        Returns:
+            numpy.array: windows of shape (window, batch, dim).
+
+        '''
+        A_flat = A.reshape((A.shape[0] * A.shape[1],) + A.shape[2:])
+        starts = idx[:, 0] * A.shape[1] + idx[:, 1]
+        rows = self._window_offsets[:, None] + starts[None, :]
+
+        if A.dtype != floatX:
+            return A_flat.take(rows, axis=0).astype(floatX)
+        if not self.batch_buffers:
+            return A_flat.take(rows, axis=0)
+
+        shape = rows.shape + A.shape[2:]
+        buffers = self._buffers.get(k, None)
+        if (buffers is None or len(buffers) != self.batch_buffers
+            or buffers[0].shape != shape):
+            buffers = [np.empty(shape, dtype=floatX)
+                       for _ in xrange(self.batch_buffers)]
+            self._buffers[k] = buffers
+
+        out = buffers[self._buffer_i % self.batch_buffers]
+        return A_flat.take(rows, axis=0, out=out, mode='clip')
 
     def next(self, batch_size=None):
         '''Draws the next batch of windowed fMRI.
@@ -180,9 +233,10 @@ class FMRI(FMRI_IID):
             self.reset()
             raise StopIteration
 
-        idxs = [self.idx[i] for i in range(self.pos, self.pos+batch_size)]
-        x = np.array([self.X[i][j:j+self.window] for i, j in idxs]).astype(floatX).transpose(1, 0, 2)
-        y = np.array([self.Y[i][j:j+self.window] for i, j in idxs]).astype(floatX).transpose(1, 0, 2)
+        idx = self.idx[self.pos:self.pos+batch_size]
+        x = self._gather_windows(self.name, self.X, idx)
+        y = self._gather_windows('group', self.Y, idx)
+        self._buffer_i += 1
 
         self.pos += batch_size
 
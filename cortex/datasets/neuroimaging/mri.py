@@ -3,19 +3,22 @@ Module for the MRI dataset
 '''
 
 import cPickle
+import hashlib
 import nipy
 from nipy.core.api import Image
 import numpy as np
 import os
 from os import path
 import pprint
-from sklearn.decomposition import PCA
+from sklearn.decomposition import IncrementalPCA, PCA
+import tempfile
 import warnings
 import yaml
 
 from ...analysis.mri import rois
 from .. import BasicDataset
 from . import nifti_viewer
+from .out_of_core import ConcatenatedArray, iter_chunks
 from ...utils import floatX
 from ...utils.tools import resolve_path
 
@@ -32,16 +35,26 @@ class MRI(BasicDataset):
             decomposition of the data.
         pca_components (Optional[int]): number of PCA components if self.pca
             is not None
+        pca_backend (str): `full`, `randomized` or `incremental`.
         tmp_path (str): path for temporary niftis in visualization.
         base_nifti_file (str): path for base nifti for forming niftis from arrays.
         anat_file (str): path for anatomical nifti file for visualization.
         sites (Optional[list]): list of sites where data was collected.
         mask (numpy.array): mask
+        out_of_core (bool): data files are memory-mapped and preprocessed
+            in chunks into a memory-mapped temporary file.
+        chunk_size (int): number of samples per chunk in out-of-core passes.
+        pca_file (Optional[str]): path where the fitted PCA is pickled.
 
     '''
 
+    # Entries of the source yaml that are inputs of the preprocessing.
+    cache_inputs = ['data', 'mask', 'sites', 'nifti', 'anat_file']
+
     def __init__(self, source=None, name='mri', idx=None,
-                 pca_components=0, distribution='gaussian', **kwargs):
+                 pca_components=0, distribution='gaussian', out_of_core=False,
+                 chunk_size=256, cache_dir=None, pca_backend='full',
+                 **kwargs):
         '''Init function for MRI.
 
         Args:
@@ -50,30 +63,94 @@ class MRI(BasicDataset):
             idx (list): indices from the original dataset.
             pca_components: (Optional[int]): if not 0, decompose the data
                 using PCA.
+            pca_backend (str): `full` for exact PCA, `randomized` for
+                randomized SVD or `incremental` for batch-wise fitting with
+                `chunk_size` samples per batch. Out-of-core PCA must be
+                `incremental`. Ignored if the PCA is loaded from `pca_file`.
             distribution (Optional[str]): distribution of the primary data.
                 See `models.distributions` for details.
+            out_of_core (bool): if True, only the current batch is loaded in
+                memory. Masking, site regression and normalization are done
+                in chunked passes over memory-mapped data files. Shuffling is
+                done by index.
+            chunk_size (int): number of samples per chunk when out-of-core.
+            cache_dir (Optional[str]): if not None, the preprocessed data is
+                saved here as `.npy` files and memory-mapped on later loads
+                with the same source and preprocessing arguments.
             **kwargs: extra keyword arguments passed to BasicDataset
 
         '''
         print 'Loading %s from %s' % (name, source)
         source = resolve_path(source)
+        self.out_of_core = out_of_core
+        self.chunk_size = chunk_size
+        self.pca_components = pca_components
+        if pca_backend not in ['full', 'randomized', 'incremental']:
+            raise ValueError('PCA backend %s not supported' % pca_backend)
+        if out_of_core and pca_components and pca_backend != 'incremental':
+            raise ValueError('Out-of-core PCA requires the `incremental` '
+                             'backend.')
+        self.pca_backend = pca_backend
+
+        if cache_dir is not None:
+            # Out-of-core entries hold all rows, with raw labels, while
+            # in-memory ones are truncated and balanced, so they are kept
+            # apart. Incremental PCA also depends on the chunk size.
+            if pca_components and pca_backend == 'incremental':
+                pca_chunk_size = chunk_size
+            else:
+                pca_chunk_size = None
+            cache_files = self._cache_files(
+                resolve_path(cache_dir), source,
+                pca_components=pca_components, pca_backend=pca_backend,
+                distribution=distribution, stop=kwargs.get('stop', None),
+                balance=kwargs.get('balance', False), out_of_core=out_of_core,
+                chunk_size=pca_chunk_size)
+            from_cache = path.isfile(cache_files['Y'])
+        else:
+            cache_files = None
+            from_cache = False
+
+        # Data files are only memory-mapped if they will not be read whole.
+        self._mmap_data = self.out_of_core or from_cache
         X, Y = self.get_data(source)
 
         self.image_shape = self.mask.shape
-        X = self._mask(X)
-        self.pca_components = pca_components
 
-        if self.pca_components:
-            if self.pca is None:
-                print 'Forming PCA'
-                self.pca = PCA(pca_components)
-                print 'Fitting PCA... (please wait)'
-                self.pca.fit(X)
-                if self.pca_file is not None:
-                    with open(self.pca_file, 'wb') as pf:
-                        cPickle.dump(self.pca, pf)
-            print 'Performing PCA'
-            X = self.pca.transform(X)
+        if from_cache:
+            print 'Loading preprocessed data from %s' % cache_files['X']
+            X, Y = self._load_cache(cache_files)
+            if not self.out_of_core:
+                # Cached in-memory data is already truncated and balanced.
+                stop = kwargs.pop('stop', None)
+                balance = kwargs.pop('balance', False)
+        elif self.out_of_core:
+            if cache_files is None:
+                X, Y = self._preprocess_out_of_core(X, Y, distribution,
+                                                    idx=idx)
+                idx = None
+            else:
+                X, Y = self._preprocess_out_of_core(
+                    X, Y, distribution, out_file=cache_files['X'])
+                self._save_cache(cache_files, Y=Y)
+        else:
+            X = self._mask(X)
+
+            if self.pca_components:
+                if self.pca is None:
+                    self.pca = self._make_pca()
+                    print 'Fitting PCA... (please wait)'
+                    self.pca.fit(X)
+                    self._save_pca()
+                print 'Performing PCA'
+                X = self.pca.transform(X)
+
+        if self.out_of_core:
+            if idx is not None:
+                X = self._take_rows(X, idx)
+                Y = Y[idx]
+                idx = None
+            kwargs['shuffle_mode'] = 'index'
 
         data = {name: X, 'group': Y}
         distributions = {name: distribution, 'group': 'multinomial'}
@@ -81,16 +158,25 @@ class MRI(BasicDataset):
         super(MRI, self).__init__(data, distributions=distributions, name=name,
                                   labels='group', **kwargs)
 
-        if distribution == 'gaussian':
-            self.X -= self.X.mean(axis=0)
-            self.X /= self.X.std()
-        elif distribution in ['continuous_binomial', 'binomial']:
-            self.X -= self.X.min()
-            self.X /= (self.X.max() - self.X.min())
-        else:
-            raise ValueError(distribution)
-
-        self.mean_image = self.X.mean(axis=0)
+        if from_cache and not self.out_of_core:
+            self.stop = stop
+            self.balance = balance
+        elif not self.out_of_core:
+            # Out-of-core data is normalized in `_preprocess_out_of_core`.
+            if distribution == 'gaussian':
+                self.X -= self.X.mean(axis=0)
+                self.X /= self.X.std()
+            elif distribution in ['continuous_binomial', 'binomial']:
+                self.X -= self.X.min()
+                self.X /= (self.X.max() - self.X.min())
+            else:
+                raise ValueError(distribution)
+
+            if cache_files is not None:
+                self._save_cache(cache_files, X=self.X, Y=self.Y)
+
+        if not self.out_of_core:
+            self.mean_image = self.X.mean(axis=0)
 
         if idx is not None:
             self.X = self.X[idx]
@@ -98,6 +184,127 @@ class MRI(BasicDataset):
 
         self.n = self.X.shape[0]
 
+    def _make_pca(self):
+        '''Forms an unfitted PCA for `pca_backend`.
+
+        Returns:
+            sklearn.decomposition.PCA or sklearn.decomposition.IncrementalPCA
+
+        '''
+        print 'Forming PCA (%s)' % self.pca_backend
+        if self.pca_backend == 'full':
+            return PCA(self.pca_components)
+        elif self.pca_backend == 'randomized':
+            return PCA(self.pca_components, svd_solver='randomized')
+        elif self.pca_backend == 'incremental':
+            return IncrementalPCA(
+                self.pca_components,
+                batch_size=max(self.chunk_size, self.pca_components))
+        else:
+            raise ValueError(self.pca_backend)
+
+    def _save_pca(self):
+        '''Pickles the fitted PCA to `pca_file` if set.
+
+        '''
+        if self.pca_file is not None:
+            with open(self.pca_file, 'wb') as pf:
+                cPickle.dump(self.pca, pf)
+
+    def _cache_files(self, cache_dir, source, **params):
+        '''Paths of the cached preprocessed data for a source.
+
+        The key is a hash of the source yaml, the modification times of the
+        input files it lists (see `cache_inputs`), the dataset class and the
+        preprocessing parameters. Outputs, such as the `pca` file written by
+        the first run, are left out so that later runs find the entry.
+
+        Args:
+            cache_dir (str): cache directory.
+            source (str): path of the source yaml.
+            **params: preprocessing parameters.
+
+        Returns:
+            dict: paths of the cached `X`, `Y`, and `pca`.
+
+        '''
+        with open(source, 'rb') as f:
+            source_str = f.read()
+        source_dict = yaml.load(source_str)
+
+        files = []
+        for k in self.cache_inputs:
+            v = source_dict.get(k, [])
+            if not isinstance(v, list):
+                v = [v]
+            files += [f for f in v if isinstance(f, str) and path.isfile(f)]
+
+        h = hashlib.sha1(source_str)
+        for f in sorted(set(files)):
+            h.update('%s:%r' % (f, path.getmtime(f)))
+        h.update(self.__class__.__name__)
+        for k in sorted(params.keys()):
+            h.update('%s:%r' % (k, params[k]))
+        key = h.hexdigest()
+
+        if not path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+
+        return dict((k, path.join(cache_dir, '%s_%s.%s' % (key, k, ext)))
+                    for k, ext in [('X', 'npy'), ('Y', 'npy'), ('pca', 'pkl')])
+
+    def _load_cache(self, cache_files):
+        '''Loads cached preprocessed data.
+
+        Out-of-core data is opened read-only, otherwise copy-on-write.
+
+        Args:
+            cache_files (dict): see `_cache_files`.
+
+        Returns:
+            numpy.memmap: preprocessed data.
+            numpy.array: group labels.
+
+        '''
+        if self.out_of_core:
+            X = np.load(cache_files['X'], mmap_mode='r')
+        else:
+            X = np.load(cache_files['X'], mmap_mode='c')
+        Y = np.load(cache_files['Y'])
+
+        if path.isfile(cache_files['pca']):
+            with open(cache_files['pca'], 'rb') as f:
+                self.pca = cPickle.load(f)
+
+        return X, Y
+
+    def _save_cache(self, cache_files, X=None, Y=None):
+        '''Saves preprocessed data to the cache.
+
+        `Y` is written last and marks the entry as complete. Files are
+        written under a temporary name and renamed.
+
+        Args:
+            cache_files (dict): see `_cache_files`.
+            X (Optional[numpy.array]): preprocessed data. If None, it has
+                already been written.
+            Y (numpy.array): group labels.
+
+        '''
+        print 'Caching preprocessed data to %s' % cache_files['X']
+
+        def save(out_file, f_save):
+            tmp_file = out_file + '.tmp'
+            with open(tmp_file, 'wb') as f:
+                f_save(f)
+            os.rename(tmp_file, out_file)
+
+        if self.pca is not None and self.pca_components:
+            save(cache_files['pca'], lambda f: cPickle.dump(self.pca, f))
+        if X is not None:
+            save(cache_files['X'], lambda f: np.save(f, X))
+        save(cache_files['Y'], lambda f: np.save(f, Y))
+
     def get_data(self, source):
         '''Fetch the MRI dataset.
 
@@ -129,7 +336,7 @@ class MRI(BasicDataset):
         self.pca_file = source_dict.get('pca', None)
         if self.pca_file is not None:
             try:
-                with open(pca_file, 'rb') as f:
+                with open(self.pca_file, 'rb') as f:
                     self.pca = cPickle.load(f)
             except (IOError, EOFError):
                 self.pca = None
@@ -144,11 +351,18 @@ class MRI(BasicDataset):
         Y = []
         for i, data_file in enumerate(data_files):
             print 'Loading %s' % data_file
-            X_ = np.load(data_file)
-            X.append(X_.astype(floatX))
+            if self._mmap_data:
+                X_ = np.load(data_file, mmap_mode='r')
+                X.append(X_)
+            else:
+                X_ = np.load(data_file)
+                X.append(X_.astype(floatX))
             Y.append((np.zeros((X_.shape[0],)) + i).astype(floatX))
 
-        X = np.concatenate(X, axis=0)
+        if self._mmap_data:
+            X = ConcatenatedArray(X)
+        else:
+            X = np.concatenate(X, axis=0)
         Y = np.concatenate(Y, axis=0)
 
         mask = np.load(mask_file)
@@ -158,12 +372,15 @@ class MRI(BasicDataset):
         self.mask = mask
         self.base_nifti_file = nifti_file
 
+        self.sites = None
         if 'sites' in source_dict.keys():
             sites_file = source_dict['sites']
             self.sites = np.load(sites_file).tolist()
             n_sites = len(np.unique(self.sites).tolist())
 
-            if n_sites > 1:
+            # Memory-mapped data is regressed in `_preprocess_out_of_core`
+            # or was regressed before caching.
+            if n_sites > 1 and not self._mmap_data:
                 print 'Regressing out site'
 
                 for site in xrange(n_sites):
@@ -173,12 +390,229 @@ class MRI(BasicDataset):
 
         return X, Y
 
-    def _mask(self, X, mask=None):
+    def _preprocess_out_of_core(self, X, Y, distribution, idx=None,
+                                out_file=None):
+        '''Masks, regresses out site and normalizes data in chunks.
+
+        Per-site sums are accumulated in a first pass over the data files.
+        Binomial data needs a second pass for the range. With PCA, the
+        components are computed by `_pca_out_of_core` and scaled in memory
+        instead. The last pass writes
+        the processed samples to `out_file` or, if None, to a memory-mapped
+        temporary file in `tmp_path` which is removed when the dataset is
+        deleted.
+
+        Args:
+            X (ConcatenatedArray): memory-mapped data.
+            Y (numpy.array): group labels.
+            distribution (str): distribution of the primary data.
+            idx (Optional[list]): if not None, only these samples are kept.
+            out_file (Optional[str]): path of the `.npy` output.
+
+        Returns:
+            numpy.memmap: processed data.
+            numpy.array: group labels.
+
+        '''
+        if distribution not in ['gaussian', 'continuous_binomial',
+                                'binomial']:
+            raise ValueError(distribution)
+
+        n = X.shape[0]
+        dim = int(self.mask.sum())
+
+        if self.sites is not None and len(np.unique(self.sites)) > 1:
+            print 'Regressing out site'
+            _, groups = np.unique(self.sites, return_inverse=True)
+            regress = True
+        else:
+            groups = np.zeros((n,), dtype='int64')
+            regress = False
+        n_groups = groups.max() + 1
+        counts = np.bincount(groups, minlength=n_groups).astype('float64')
+
+        if regress or not self.pca_components:
+            print 'Computing statistics for %s (%d chunks)' % (
+                self.__class__.__name__, (n - 1) // self.chunk_size + 1)
+            sums = np.zeros((n_groups, dim))
+            sums2 = np.zeros((n_groups, dim))
+            for start, stop in iter_chunks(n, self.chunk_size):
+                x = self._mask(X[start:stop]).astype('float64')
+                g = groups[start:stop]
+                for k in np.unique(g):
+                    x_k = x[g == k]
+                    sums[k] += x_k.sum(axis=0)
+                    sums2[k] += (x_k ** 2).sum(axis=0)
+
+        if regress:
+            offsets = sums / counts[:, None]
+        else:
+            offsets = np.zeros((n_groups, dim))
+
+        if self.pca_components:
+            # Components fit in memory and are scaled as in-memory data.
+            Z = self._pca_out_of_core(X, groups, offsets)
+            if distribution == 'gaussian':
+                Z -= Z.mean(axis=0)
+                Z /= Z.std()
+            else:
+                Z -= Z.min()
+                Z /= Z.max()
+            dim = self.pca_components
+
+            def transform(r):
+                return Z[r]
+        else:
+            if distribution == 'gaussian':
+                center = (sums - counts[:, None] * offsets).sum(axis=0) / n
+                shifts = offsets + center[None, :]
+                ss = (sums2 - 2. * shifts * sums
+                      + counts[:, None] * shifts ** 2).sum()
+                scale = np.sqrt(ss / (n * dim))
+            else:
+                x_min = np.inf
+                x_max = -np.inf
+                for start, stop in iter_chunks(n, self.chunk_size):
+                    x = (self._mask(X[start:stop])
+                         - offsets[groups[start:stop]])
+                    x_min = min(x_min, x.min())
+                    x_max = max(x_max, x.max())
+                shifts = offsets + x_min
+                scale = x_max - x_min
+
+            def transform(r):
+                return (self._mask(X[r]) - shifts[groups[r]]) / scale
+
+        if idx is None:
+            rows = np.arange(n)
+        else:
+            rows = np.asarray(idx)
+            Y = Y[rows]
+
+        shape = (rows.shape[0], dim)
+        if out_file is None:
+            X_out = self._open_tmp_memmap(shape)
+        else:
+            tmp_file = out_file + '.tmp'
+            X_out = np.lib.format.open_memmap(tmp_file, mode='w+',
+                                              dtype=floatX, shape=shape)
+
+        print 'Writing preprocessed data to %s' % X_out.filename
+        for start, stop in iter_chunks(rows.shape[0], self.chunk_size):
+            X_out[start:stop] = transform(rows[start:stop]).astype(floatX)
+        X_out.flush()
+
+        if out_file is not None:
+            del X_out
+            os.rename(tmp_file, out_file)
+            X_out = np.load(out_file, mmap_mode='r')
+
+        return X_out, Y
+
+    def _pca_out_of_core(self, X, groups, offsets):
+        '''Fits and applies PCA in chunks.
+
+        The PCA is fit with `partial_fit` unless it was loaded from
+        `pca_file`. Chunks smaller than the number of components are merged
+        into the previous chunk.
+
+        Args:
+            X (ConcatenatedArray): memory-mapped data.
+            groups (numpy.array): site index of each sample.
+            offsets (numpy.array): mean to subtract for each site.
+
+        Returns:
+            numpy.array: PCA components of all samples.
+
+        '''
+        n = X.shape[0]
+        chunk_size = max(self.chunk_size, self.pca_components)
+
+        def chunks():
+            for start, stop in iter_chunks(n, chunk_size,
+                                           min_size=self.pca_components):
+                yield start, stop, (self._mask(X[start:stop])
+                                    - offsets[groups[start:stop]])
+
+        if self.pca is None:
+            self.pca = self._make_pca()
+            print 'Fitting PCA in %d chunks... (please wait)' % (
+                (n - 1) // chunk_size + 1)
+            for _, _, x in chunks():
+                self.pca.partial_fit(x)
+            self._save_pca()
+
+        print 'Performing PCA'
+        Z = np.zeros((n, self.pca_components))
+        for start, stop, x in chunks():
+            Z[start:stop] = self.pca.transform(x)
+        return Z
+
+    def _open_tmp_memmap(self, shape):
+        '''Opens a memory-mapped temporary `.npy` file in `tmp_path`.
+
+        The file is removed when the dataset is deleted.
+
+        Args:
+            shape (tuple): shape of the array.
+
+        Returns:
+            numpy.memmap
+
+        '''
+        self._X_file = tempfile.NamedTemporaryFile(
+            dir=self.tmp_path, prefix='%s_' % self.__class__.__name__,
+            suffix='.npy')
+        return np.lib.format.open_memmap(
+            self._X_file.name, mode='w+', dtype=floatX, shape=shape)
+
+    def _take_rows(self, X, idx):
+        '''Copies rows of memory-mapped data to a temporary file in chunks.
+
+        Args:
+            X (numpy.memmap): data.
+            idx (list): rows to copy.
+
+        Returns:
+            numpy.memmap
+
+        '''
+        rows = np.asarray(idx)
+        X_out = self._open_tmp_memmap((rows.shape[0],) + X.shape[1:])
+        for start, stop in iter_chunks(rows.shape[0], self.chunk_size):
+            X_out[start:stop] = X[rows[start:stop]]
+        X_out.flush()
+        return X_out
+
+    def _mask_index(self, mask=None):
+        '''Flat indices of the voxels in a mask.
+
+        The indices for `self.mask` are computed once and cached.
+
+        Args:
+            mask (Optional[numpy.array]): mask
+
+        Returns:
+            numpy.array: flat indices into a volume of shape `mask.shape`.
+
+        '''
+        if mask is not None and mask is not self.mask:
+            return np.flatnonzero(mask.ravel() == 1)
+
+        cache = getattr(self, '_mask_cache', None)
+        if cache is None or cache[0] is not self.mask:
+            cache = (self.mask, np.flatnonzero(self.mask.ravel() == 1))
+            self._mask_cache = cache
+        return cache[1]
+
+    def _mask(self, X, mask=None, out=None):
         '''Mask the data.
 
         Args:
             X (numpy.array): data to be masked
             mask (Optional[numpy.array]): mask
+            out (Optional[numpy.array]): preallocated output of shape
+                (X.shape[0], number of voxels in mask).
 
         Return:
             numpy.array: masked array.
@@ -194,21 +628,29 @@ class MRI(BasicDataset):
         if X.shape[1:] != mask.shape:
             raise ValueError((X.shape, mask.shape))
 
-        mask_f = mask.flatten()
-        mask_idx = np.where(mask_f == 1)[0].tolist()
-        X_masked = np.zeros((X.shape[0], int(mask.sum()))).astype(floatX)
+        mask_idx = self._mask_index(mask)
+        X_f = X.reshape((X.shape[0], -1))
+        if out is None:
+            out = np.empty((X.shape[0], mask_idx.shape[0]), dtype=floatX)
+        elif out.shape != (X.shape[0], mask_idx.shape[0]):
+            raise ValueError('Output does not fit masked data %r vs %r'
+                             % (out.shape, (X.shape[0], mask_idx.shape[0])))
 
-        for i, x in enumerate(X):
-            X_masked[i] = x.flatten()[mask_idx]
+        if X_f.dtype == out.dtype:
+            X_f.take(mask_idx, axis=1, out=out, mode='clip')
+        else:
+            out[:] = X_f.take(mask_idx, axis=1)
 
-        return X_masked
+        return out
 
-    def _unmask(self, X_masked, mask=None):
+    def _unmask(self, X_masked, mask=None, out=None):
         '''Unmask data.
 
         Args:
             X_masked (numpy.array): array to be unmasked.
             mask (Optional[numpy.array]): mask
+            out (Optional[numpy.array]): preallocated C-contiguous output of
+                shape (X_masked.shape[0],) + mask.shape.
 
         Returns:
             numpy.array: unmasked data.
@@ -220,15 +662,19 @@ class MRI(BasicDataset):
         if X_masked.shape[1] != mask.sum():
             raise ValueError('Masked data does not fit mask %r vs %r' % (X_masked.shape, mask.sum()))
 
-        mask_f = mask.flatten()
-        mask_idx = np.where(mask_f == 1)[0].tolist()
-        X = np.zeros((X_masked.shape[0],) + self.image_shape).astype(floatX)
-        for i, x_m in enumerate(X_masked):
-            x_f = X[i].flatten()
-            x_f[mask_idx] = x_m
-            X[i] = x_f.reshape(self.image_shape)
+        mask_idx = self._mask_index(mask)
+        shape = (X_masked.shape[0],) + mask.shape
+        if out is None:
+            out = np.zeros(shape, dtype=floatX)
+        elif out.shape != shape or not out.flags.c_contiguous:
+            raise ValueError('Output must be C-contiguous with shape %r '
+                             '(got %r)' % (shape, out.shape))
+        else:
+            out[:] = 0
+
+        out.reshape((shape[0], -1))[:, mask_idx] = X_masked
 
-        return X
+        return out
 
     def make_image(self, X, base_nifti):
         '''Create a nitfi image from array.
@@ -285,7 +731,7 @@ class MRI(BasicDataset):
 
         '''
         if self.pca is not None and self.pca_components:
-            X = self.pca.inverse_transform(X)
+            x = self.pca.inverse_transform(x)
 
         if len(x.shape) == 3:
             x = x[:, 0, :]
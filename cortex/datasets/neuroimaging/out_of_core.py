@@ -0,0 +1,116 @@
+'''
+Utilities for neuroimaging data that does not fit in memory.
+'''
+
+import numpy as np
+
+
+def iter_chunks(n, chunk_size, min_size=0):
+    '''Iterates over (start, stop) pairs covering range(n).
+
+    Args:
+        n (int): total number of samples.
+        chunk_size (int): maximum number of samples per chunk.
+        min_size (int): if the last chunk is smaller than this, it is merged
+            into the previous one.
+
+    '''
+    for start in xrange(0, n, chunk_size):
+        stop = min(start + chunk_size, n)
+        if stop < n and n - stop < min_size:
+            yield start, n
+            return
+        yield start, stop
+
+
+class ConcatenatedArray(object):
+    '''Read-only view of several arrays concatenated along the first axis.
+
+    Meant for memory-mapped arrays: nothing is read until the view is
+    indexed, and only the requested rows are loaded.
+
+    Attributes:
+        arrays (list): list of numpy.array or numpy.memmap.
+        offsets (numpy.array): first row of each array in the concatenation.
+        shape (tuple): shape of the concatenated array.
+        dtype (numpy.dtype): dtype of the arrays.
+
+    '''
+    def __init__(self, arrays):
+        '''Init function for ConcatenatedArray.
+
+        Args:
+            arrays (list): arrays with the same shape after the first axis.
+
+        '''
+        if len(arrays) == 0:
+            raise ValueError('At least one array must be given.')
+        for a in arrays[1:]:
+            if a.shape[1:] != arrays[0].shape[1:]:
+                raise ValueError('All arrays must have the same shape after '
+                                 'the first axis (%r vs %r)'
+                                 % (arrays[0].shape, a.shape))
+            if a.dtype != arrays[0].dtype:
+                raise ValueError('All arrays must have the same dtype '
+                                 '(%s vs %s)' % (arrays[0].dtype, a.dtype))
+
+        self.arrays = arrays
+        self.offsets = np.cumsum([0] + [a.shape[0] for a in arrays])
+        self.shape = (int(self.offsets[-1]),) + arrays[0].shape[1:]
+        self.dtype = arrays[0].dtype
+        self.ndim = len(self.shape)
+
+    def __len__(self):
+        return self.shape[0]
+
+    def _take(self, rows):
+        '''Gathers rows in the given order.
+
+        '''
+        out = np.empty((rows.shape[0],) + self.shape[1:], dtype=self.dtype)
+        which = np.searchsorted(self.offsets, rows, side='right') - 1
+        for i in np.unique(which):
+            sel = np.where(which == i)[0]
+            local = rows[sel] - self.offsets[i]
+            order = np.argsort(local)
+            # Read in file order, then put rows back where they were asked.
+            out[sel[order]] = self.arrays[i][local[order]]
+        return out
+
+    def __getitem__(self, key):
+        if isinstance(key, tuple):
+            rows = self[key[0]]
+            if isinstance(key[0], (int, long, np.integer)):
+                return rows[key[1:]]
+            return rows[(slice(None),) + key[1:]]
+
+        n = self.shape[0]
+        if isinstance(key, (int, long, np.integer)):
+            if key < 0:
+                key += n
+            if not 0 <= key < n:
+                raise IndexError('Index %d out of range (%d)' % (key, n))
+            i = np.searchsorted(self.offsets, key, side='right') - 1
+            return self.arrays[i][key - self.offsets[i]]
+
+        if isinstance(key, slice):
+            start, stop, step = key.indices(n)
+            if step != 1:
+                return self._take(np.arange(start, stop, step))
+            pieces = []
+            for i, a in enumerate(self.arrays):
+                a_start = max(start - self.offsets[i], 0)
+                a_stop = min(stop - self.offsets[i], a.shape[0])
+                if a_start < a_stop:
+                    pieces.append(np.asarray(a[a_start:a_stop]))
+            if len(pieces) == 0:
+                return np.zeros((0,) + self.shape[1:], dtype=self.dtype)
+            return np.concatenate(pieces, axis=0)
+
+        rows = np.asarray(key)
+        if rows.dtype == bool:
+            rows = np.where(rows)[0]
+        rows = np.where(rows < 0, rows + n, rows)
+        if rows.size > 0 and (rows.min() < 0 or rows.max() >= n):
+            raise IndexError('Index out of range (%d)' % n)
+        return self._take(rows)
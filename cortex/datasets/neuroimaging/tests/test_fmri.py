@@ -0,0 +1,86 @@
+'''
+Tests for fMRI datasets with synthetic data.
+'''
+
+import numpy as np
+from os import path
+import shutil
+import tempfile
+import yaml
+
+from cortex.datasets.neuroimaging.fmri import FMRI
+
+
+def make_source(out_dir, n_per_file=(3, 2), n_scans=12, shape=(4, 5, 3),
+                seed=0):
+    '''Writes synthetic fMRI files and the source yaml.
+
+    '''
+    rng = np.random.RandomState(seed)
+    data_files = []
+    for i, n in enumerate(n_per_file):
+        data_file = path.join(out_dir, 'fmri_%d.npy' % i)
+        np.save(data_file, rng.normal(loc=i, size=(n, n_scans) + shape))
+        data_files.append(data_file)
+
+    mask = (rng.uniform(size=shape) > 0.3).astype('float32')
+    mask_file = path.join(out_dir, 'mask.npy')
+    np.save(mask_file, mask)
+
+    source = path.join(out_dir, 'fmri.yaml')
+    with open(source, 'w') as f:
+        f.write(yaml.dump(dict(
+            data=data_files,
+            mask=mask_file,
+            nifti=path.join(out_dir, 'base.nii'),
+            anat_file=path.join(out_dir, 'anat.nii'),
+            tmp_path=path.join(out_dir, 'tmp'),
+            name='fmri')))
+    return source
+
+def windows_loop(fmri, pos, batch_size):
+    '''Reference window extraction with a loop over (subject, scan) pairs.
+
+    '''
+    idxs = [fmri.idx[i] for i in range(pos, pos + batch_size)]
+    x = np.array([fmri.X[i][j:j+fmri.window] for i, j in idxs]).transpose(1, 0, 2)
+    y = np.array([fmri.Y[i][j:j+fmri.window] for i, j in idxs]).transpose(1, 0, 2)
+    return x, y
+
+def test_windows(window=4, stride=3, batch_size=3, batch_buffers=2,
+                 out_of_core=False):
+    out_dir = tempfile.mkdtemp()
+    try:
+        source = make_source(out_dir)
+        for idx in [None, [4, 1, 2]]:
+            fmri = FMRI(source=source, batch_size=batch_size, window=window,
+                        stride=stride, idx=idx, batch_buffers=batch_buffers,
+                        out_of_core=out_of_core)
+            n_windows = len(range(0, 12 - window + 1, stride))
+            n_subjects = 5 if idx is None else len(idx)
+            assert fmri.n == n_subjects * n_windows
+            if idx is not None:
+                assert set(fmri.idx[:, 0]) == set(
+                    idx if out_of_core else range(len(idx)))
+
+            batches = []
+            while True:
+                pos = fmri.pos
+                try:
+                    rval = fmri.next()
+                except StopIteration:
+                    break
+                x, y = windows_loop(fmri, pos, batch_size)
+                assert rval['fmri'].shape == (window, batch_size,
+                                              fmri.X.shape[2])
+                assert np.allclose(rval['fmri'], x)
+                assert np.allclose(rval['group'], y)
+                batches.append(rval['fmri'])
+            assert len(batches) == fmri.n // batch_size
+            if batch_buffers:
+                assert batches[0] is batches[batch_buffers]
+    finally:
+        shutil.rmtree(out_dir)
+
+def test_windows_out_of_core():
+    test_windows(out_of_core=True)
@@ -0,0 +1,174 @@
+'''
+Tests for MRI datasets with synthetic data.
+'''
+
+import numpy as np
+import os
+from os import path
+import shutil
+import tempfile
+import yaml
+
+from cortex.datasets.neuroimaging.mri import MRI
+
+
+def make_source(out_dir, n_sites=2, n_per_file=(11, 7), shape=(5, 6, 4),
+                seed=0, pca_file=None):
+    '''Writes synthetic MRI files and the source yaml.
+
+    '''
+    rng = np.random.RandomState(seed)
+    data_files = []
+    for i, n in enumerate(n_per_file):
+        data_file = path.join(out_dir, 'mri_%d.npy' % i)
+        np.save(data_file, rng.normal(loc=i, size=(n,) + shape))
+        data_files.append(data_file)
+
+    mask = (rng.uniform(size=shape) > 0.3).astype('float32')
+    mask_file = path.join(out_dir, 'mask.npy')
+    np.save(mask_file, mask)
+
+    sites_file = path.join(out_dir, 'sites.npy')
+    np.save(sites_file, rng.randint(0, n_sites, size=(sum(n_per_file),)))
+
+    source = path.join(out_dir, 'mri.yaml')
+    source_dict = dict(
+        data=data_files,
+        mask=mask_file,
+        sites=sites_file,
+        nifti=path.join(out_dir, 'base.nii'),
+        anat_file=path.join(out_dir, 'anat.nii'),
+        tmp_path=path.join(out_dir, 'tmp'),
+        name='mri')
+    if pca_file is not None:
+        source_dict['pca'] = pca_file
+    with open(source, 'w') as f:
+        f.write(yaml.dump(source_dict))
+    return source
+
+def test_out_of_core(distribution='gaussian'):
+    out_dir = tempfile.mkdtemp()
+    try:
+        source = make_source(out_dir)
+        idx = [3, 0, 17, 5, 9]
+
+        mri = MRI(source=source, batch_size=5, distribution=distribution,
+                  shuffle=False)
+        mri_ooc = MRI(source=source, batch_size=5, distribution=distribution,
+                      shuffle=False, out_of_core=True, chunk_size=4)
+        assert isinstance(mri_ooc.X, np.memmap)
+        assert np.allclose(mri.X, mri_ooc.X, atol=1e-4)
+        assert np.allclose(mri.Y, mri_ooc.Y)
+
+        mri_ooc = MRI(source=source, batch_size=5, distribution=distribution,
+                      shuffle=False, out_of_core=True, chunk_size=4, idx=idx)
+        assert np.allclose(mri.data[mri.name][idx], mri_ooc.X, atol=1e-4)
+    finally:
+        shutil.rmtree(out_dir)
+
+def test_out_of_core_binomial():
+    test_out_of_core(distribution='binomial')
+
+def test_mask_unmask():
+    out_dir = tempfile.mkdtemp()
+    try:
+        source = make_source(out_dir)
+        mri = MRI(source=source, batch_size=5)
+        x = mri.X[:7]
+
+        X = mri._unmask(x)
+        assert X.shape == (7,) + mri.mask.shape
+        assert np.all(X[:, mri.mask == 0] == 0)
+        assert np.allclose(X[:, mri.mask == 1], x)
+
+        out = np.ones((7, x.shape[1]), dtype=x.dtype)
+        x_m = mri._mask(X, out=out)
+        assert x_m is out
+        assert np.allclose(x_m, x)
+    finally:
+        shutil.rmtree(out_dir)
+
+def test_cache(out_of_core=False):
+    out_dir = tempfile.mkdtemp()
+    try:
+        source = make_source(out_dir)
+        cache_dir = path.join(out_dir, 'cache')
+        idx = [3, 0, 17, 5, 9]
+
+        mri = MRI(source=source, batch_size=5, shuffle=False, idx=idx,
+                  out_of_core=out_of_core, cache_dir=cache_dir)
+        mri_cached = MRI(source=source, batch_size=5, shuffle=False, idx=idx,
+                         out_of_core=out_of_core, cache_dir=cache_dir)
+        assert isinstance(mri_cached.data[mri_cached.name], np.memmap)
+        assert np.allclose(mri.X, mri_cached.X)
+        assert np.allclose(mri.Y, mri_cached.Y)
+        assert np.allclose(mri.mean_image, mri_cached.mean_image)
+
+        mri_other = MRI(source=source, batch_size=5, shuffle=False,
+                        out_of_core=out_of_core, cache_dir=cache_dir,
+                        distribution='binomial')
+        assert not np.allclose(mri_other.X[idx], mri.X)
+    finally:
+        shutil.rmtree(out_dir)
+
+def test_cache_out_of_core():
+    test_cache(out_of_core=True)
+
+def test_cache_pca_file(pca_components=3):
+    out_dir = tempfile.mkdtemp()
+    try:
+        pca_file = path.join(out_dir, 'pca.pkl')
+        source = make_source(out_dir, pca_file=pca_file)
+        cache_dir = path.join(out_dir, 'cache')
+
+        mri = MRI(source=source, batch_size=5, shuffle=False,
+                  pca_components=pca_components, cache_dir=cache_dir)
+        assert path.isfile(pca_file)
+        # Writing the PCA file does not change the key.
+        mri_cached = MRI(source=source, batch_size=5, shuffle=False,
+                         pca_components=pca_components, cache_dir=cache_dir)
+        assert isinstance(mri_cached.data[mri_cached.name], np.memmap)
+        assert np.allclose(mri.X, mri_cached.X)
+        assert len([f for f in os.listdir(cache_dir)
+                    if f.endswith('_Y.npy')]) == 1
+    finally:
+        shutil.rmtree(out_dir)
+
+def test_cache_modes(stop=10):
+    out_dir = tempfile.mkdtemp()
+    try:
+        source = make_source(out_dir)
+        cache_dir = path.join(out_dir, 'cache')
+
+        mri_ooc = MRI(source=source, batch_size=5, shuffle=False,
+                      out_of_core=True, cache_dir=cache_dir, stop=stop)
+        mri = MRI(source=source, batch_size=5, shuffle=False,
+                  cache_dir=cache_dir, stop=stop)
+        mri_ = MRI(source=source, batch_size=5, shuffle=False, stop=stop)
+        assert mri.n == mri_.n == stop
+        assert mri.Y.shape == mri_.Y.shape
+        assert np.allclose(mri.X, mri_.X)
+        assert len([f for f in os.listdir(cache_dir)
+                    if f.endswith('_Y.npy')]) == 2
+    finally:
+        shutil.rmtree(out_dir)
+
+def test_pca(pca_components=3):
+    out_dir = tempfile.mkdtemp()
+    try:
+        source = make_source(out_dir)
+        mri = MRI(source=source, batch_size=5, pca_components=pca_components)
+        assert mri.X.shape == (mri.n, pca_components)
+        evr = mri.pca.explained_variance_ratio_.sum()
+
+        for backend, out_of_core in [('randomized', False),
+                                     ('incremental', False),
+                                     ('incremental', True)]:
+            mri_b = MRI(source=source, batch_size=5, chunk_size=4,
+                        pca_components=pca_components, pca_backend=backend,
+                        out_of_core=out_of_core)
+            assert mri_b.X.shape == (mri.n, pca_components)
+            evr_b = mri_b.pca.explained_variance_ratio_.sum()
+            assert np.allclose(evr, evr_b, rtol=0.25), (backend, evr, evr_b)
+    finally:
+        shutil.rmtree(out_dir)
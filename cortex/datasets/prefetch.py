@@ -0,0 +1,179 @@
+'''
+Background prefetching for dataset iterators.
+'''
+
+import Queue
+import threading
+
+
+class _EndOfEpoch(object):
+    '''Marker put on the queue when the wrapped dataset raises StopIteration.
+
+    '''
+    pass
+
+
+class _WorkerError(object):
+    '''Carries an exception raised in the worker back to the consumer.
+
+    '''
+    def __init__(self, error):
+        self.error = error
+
+
+class PrefetchDataset(object):
+    '''Wraps a dataset and draws batches from it in a background thread.
+
+    The worker keeps a bounded queue of ready batches so that slicing,
+    shuffling and type conversion overlap with the training step. The wrapper
+    keeps the iterator contract of `Dataset`: `pos` is the position of the
+    wrapped dataset after the last batch handed out (-1 at the end of an
+    epoch), `n` is unchanged, and `StopIteration` is raised at the end of each
+    epoch. Any other attribute is looked up on the wrapped dataset.
+
+    The worker stops at the end of each epoch and is restarted on the next
+    call to `next`, so `reset` between epochs (as in `training.test`) behaves
+    as it does without prefetching.
+
+    Attributes:
+        dataset (Dataset): wrapped dataset.
+        depth (int): maximum number of ready batches.
+        pos (int): position of the wrapped dataset after the last batch.
+
+    '''
+    def __init__(self, dataset, depth=2):
+        '''Init function for PrefetchDataset.
+
+        Args:
+            dataset (Dataset): dataset to wrap.
+            depth (int): maximum number of batches to keep ready.
+
+        '''
+        if depth < 1:
+            raise ValueError('Prefetch depth must be at least 1 (got %d)'
+                             % depth)
+        self.dataset = dataset
+        self.depth = depth
+        # Batches in the queue, the one being put and the one in use must
+        # not share an output buffer.
+        if getattr(dataset, 'batch_buffers', 0):
+            dataset.batch_buffers = max(dataset.batch_buffers, depth + 2)
+        self.pos = dataset.pos
+        self._queue = None
+        self._worker = None
+        self._halt = None
+
+    def __getattr__(self, k):
+        if k == 'dataset':
+            raise AttributeError(k)
+        return getattr(self.dataset, k)
+
+    def __iter__(self):
+        '''Iterator.
+
+        '''
+        return self
+
+    def _fill(self, queue, halt):
+        '''Worker loop. Runs until end of epoch or until halted.
+
+        '''
+        while not halt.is_set():
+            try:
+                rval = self.dataset.next()
+                item = (rval, self.dataset.pos)
+            except StopIteration:
+                item = _EndOfEpoch()
+            except Exception as e:
+                item = _WorkerError(e)
+
+            while not halt.is_set():
+                try:
+                    queue.put(item, timeout=0.1)
+                    break
+                except Queue.Full:
+                    continue
+
+            if not isinstance(item, tuple):
+                return
+
+    def _start(self):
+        '''Starts the worker thread.
+
+        '''
+        self._queue = Queue.Queue(maxsize=self.depth)
+        self._halt = threading.Event()
+        self._worker = threading.Thread(target=self._fill,
+                                        args=(self._queue, self._halt),
+                                        name='prefetch_%s' % self.dataset.name)
+        self._worker.daemon = True
+        self._worker.start()
+
+    def close(self):
+        '''Stops the worker thread and drops any prefetched batches.
+
+        '''
+        if self._worker is None:
+            return
+        self._halt.set()
+        while True:
+            try:
+                self._queue.get_nowait()
+            except Queue.Empty:
+                break
+        self._worker.join()
+        self._worker = None
+        self._queue = None
+        self._halt = None
+
+    def reset(self):
+        '''Reset the dataset post-epoch.
+
+        Prefetched batches are discarded.
+
+        '''
+        self.close()
+        self.dataset.reset()
+        self.pos = self.dataset.pos
+
+    def randomize(self):
+        '''Randomize the wrapped dataset.
+
+        Prefetched batches are discarded.
+
+        '''
+        self.close()
+        self.dataset.randomize()
+
+    def next(self, batch_size=None):
+        '''Draws the next prefetched batch.
+
+        Args:
+            batch_size (Optional[int]): must be None or the batch size of
+                the wrapped dataset. Other sizes are drawn synchronously.
+
+        Returns:
+            dict: Dictionary of data.
+
+        '''
+        if batch_size is not None and batch_size != self.dataset.batch_size:
+            self.close()
+            rval = self.dataset.next(batch_size=batch_size)
+            self.pos = self.dataset.pos
+            return rval
+
+        if self._worker is None:
+            self._start()
+
+        item = self._queue.get()
+
+        if isinstance(item, _EndOfEpoch):
+            self.close()
+            self.pos = self.dataset.pos
+            raise StopIteration
+        elif isinstance(item, _WorkerError):
+            self.close()
+            raise item.error
+
+        rval, self.pos = item
+        return rval
@@ -0,0 +1,119 @@
+'''
+Tests for BasicDataset.
+'''
+
+from glob import glob
+import numpy as np
+from os import path
+import shutil
+import tempfile
+
+from cortex.datasets import BasicDataset, load_data, share_data
+from cortex.utils import floatX
+
+
+def make_dataset(n=50, dim=13, batch_size=7, **kwargs):
+    X = np.arange(n * dim).reshape((n, dim)).astype(floatX)
+    Y = (np.arange(n) % 3).astype(floatX)
+    return BasicDataset({'x': X, 'label': Y}, name='x', batch_size=batch_size,
+                        **kwargs)
+
+def test_index_shuffle(batch_size=7, batch_buffers=2):
+    data_iter = make_dataset(batch_size=batch_size, shuffle_mode='index',
+                             batch_buffers=batch_buffers)
+    X = data_iter.X.copy()
+    data_iter.randomize()
+
+    seen = []
+    while True:
+        try:
+            rval = data_iter.next()
+        except StopIteration:
+            break
+        x = rval['x']
+        assert x.shape == (batch_size, X.shape[1])
+        rows = (x[:, 0] // X.shape[1]).astype('int64')
+        assert np.allclose(x, X[rows])
+        assert np.allclose(rval['label'].argmax(axis=1), rows % 3)
+        seen += rows.tolist()
+
+    assert len(set(seen)) == len(seen)
+    assert len(seen) == (data_iter.n // batch_size) * batch_size
+    assert np.allclose(data_iter.X, X), 'Data was moved in index mode.'
+
+def test_index_key(batch_size=7):
+    for shuffle_mode in ['copy', 'index']:
+        data_iter = make_dataset(batch_size=batch_size,
+                                 shuffle_mode=shuffle_mode, index_key='idx')
+        X = data_iter.X.copy()
+        data_iter.randomize()
+        rval = data_iter.next()
+        assert rval['idx'].dtype == np.int32
+        assert np.allclose(rval['x'], X[rval['idx']]), shuffle_mode
+
+    rval = make_dataset(batch_size=batch_size).next()
+    assert 'idx' not in rval.keys()
+
+class Shared(BasicDataset):
+    loads = 0
+
+    def __init__(self, n=50, dim=13, mode='train', **kwargs):
+        Shared.loads += 1
+        X = np.arange(n * dim).reshape((n, dim)).astype(floatX)
+        if mode == 'valid':
+            X = -X
+        Y = (np.arange(n) % 3).astype(floatX)
+        super(Shared, self).__init__({'x': X, 'label': Y}, name='x',
+                                     mode=mode, **kwargs)
+
+def test_drop_last(batch_size=7):
+    for shuffle_mode in ['copy', 'index']:
+        data_iter = make_dataset(batch_size=batch_size, drop_last=False,
+                                 shuffle_mode=shuffle_mode)
+        sizes = []
+        labels = []
+        while True:
+            try:
+                rval = data_iter.next()
+            except StopIteration:
+                break
+            sizes.append(rval['x'].shape[0])
+            labels += list(rval['label'])
+        assert sizes == [batch_size] * 7 + [1], (shuffle_mode, sizes)
+        assert len(labels) == data_iter.n
+
+        data_iter.drop_last = True
+        n_batches = 0
+        while True:
+            try:
+                data_iter.next()
+            except StopIteration:
+                break
+            n_batches += 1
+        assert n_batches == 7
+
+def test_share_data(batch_size=7):
+    out_dir = tempfile.mkdtemp()
+    try:
+        assert share_data(out_dir, dataset=Shared, modes=('train', 'valid'),
+                          n=40)
+        assert Shared.loads == 2
+        assert len(glob(path.join(out_dir, '*.npy'))) == 4
+
+        train, valid, _ = load_data(dataset=Shared, n=40,
+                                    train_batch_size=batch_size,
+                                    valid_batch_size=batch_size * 2)
+        train_, _, _ = load_data(dataset=Shared, n=40,
+                                 train_batch_size=batch_size)
+        assert Shared.loads == 2
+        assert isinstance(train, Shared) and train.shuffle_mode == 'index'
+        assert isinstance(train.X, np.memmap) and train.X is train_.X
+        assert valid.n == 40 and np.all(valid.X <= 0)
+        assert train.next()['x'].shape == (batch_size, 13)
+        assert valid.next()['x'].shape == (batch_size * 2, 13)
+
+        # Other arguments are loaded as usual.
+        train, _, _ = load_data(dataset=Shared, n=30, train_batch_size=1)
+        assert Shared.loads == 3 and train.n == 30
+    finally:
+        shutil.rmtree(out_dir)
@@ -0,0 +1,46 @@
+'''
+Tests for prefetching datasets.
+'''
+
+import numpy as np
+
+from cortex.datasets.basic.euclidean import Euclidean
+from cortex.datasets.prefetch import PrefetchDataset
+
+
+def test_prefetch_epoch(batch_size=7, n_samples=50, depth=3):
+    data_iter = Euclidean(batch_size=batch_size, n_samples=n_samples,
+                          shuffle=False)
+    prefetched = PrefetchDataset(
+        Euclidean(batch_size=batch_size, n_samples=n_samples, shuffle=False),
+        depth=depth)
+    prefetched.dataset.X = data_iter.X.copy()
+
+    for e in xrange(2):
+        while True:
+            try:
+                x = data_iter.next()[data_iter.name]
+            except StopIteration:
+                try:
+                    prefetched.next()
+                    assert False, 'Prefetched dataset did not stop.'
+                except StopIteration:
+                    pass
+                break
+            x_p = prefetched.next()[prefetched.name]
+            assert np.allclose(x, x_p)
+            assert data_iter.pos == prefetched.pos, (data_iter.pos,
+                                                     prefetched.pos)
+    prefetched.close()
+
+def test_prefetch_reset(batch_size=7, n_samples=50):
+    prefetched = PrefetchDataset(
+        Euclidean(batch_size=batch_size, n_samples=n_samples, shuffle=False))
+    x0 = prefetched.next()[prefetched.name]
+    prefetched.next()
+    prefetched.reset()
+    assert prefetched.pos == 0
+    x = prefetched.next()[prefetched.name]
+    assert np.allclose(x0, x)
+    assert prefetched.n == n_samples
+    prefetched.close()
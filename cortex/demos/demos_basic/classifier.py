@@ -16,13 +16,14 @@ import time
 from cortex.datasets import load_data
 from cortex.models.mlp import MLP
 from cortex.utils import floatX
-from cortex.utils.monitor import SimpleMonitor
+from cortex.utils.monitor import StreamingMonitor
 from cortex.utils.preprocessor import Preprocessor
 from cortex.utils.tools import get_trng, print_profile, print_section
 from cortex.utils.training import (
     main_loop,
     make_argument_parser,
     set_experiment,
+    set_functions,
     set_model,
     set_optimizer,
     set_params
@@ -35,7 +36,12 @@ def init_learning_args(
     dropout=0.,
     optimizer='rmsprop',
     optimizer_args=dict(),
+    nan_policy='abort',
+    nan_check_every=1,
+    n_workers=1,
     learning_rate_schedule=None,
+    reduce_on_plateau=None,
+    early_stopping=None,
     batch_size=100,
     valid_batch_size=100,
     epochs=100,
@@ -51,7 +57,16 @@ def init_learning_args(
         dropout: float, dropout_rate.
         optimizer: str, see utils.op
         optimizer_args: dict, extra kwargs for op.
+        nan_policy: str, abort, skip or rollback on NaN or Inf, see
+            utils.op.StepGuard.
+        nan_check_every: int, steps between checks for NaN or Inf.
+        n_workers: int, processes for data-parallel training, see
+            utils.parallel.
         learning_rate_schedule: OrderedDict, schedule for learning rate.
+        reduce_on_plateau: dict, decay of the learning rate when validation
+            stops improving, see utils.learning_scheduler.ReduceOnPlateau.
+        early_stopping: dict, stopping criterion on validation, see
+            utils.learning_scheduler.make_stopping.
         batch_size: int
         valid_batch_size: int
         epochs: int
@@ -67,7 +82,9 @@ def train(
     out_path=None, name='', model_to_load=None, test_every=None,
     classifier=None, preprocessing=None,
     learning_args=None,
-    dataset_args=None):
+    dataset_args=None,
+    input_keys=None,
+    function_cache=None):
     '''Basic training script.
 
     Args:
@@ -77,7 +94,11 @@ def train(
             every 1 epoch.
         classifier: dict, kwargs for MLP factory.
         learning_args: dict or None, see `init_learning_args` above for options.
-        dataset_args: dict, arguments for Dataset class.
+        dataset_args: dict, arguments for Dataset class, passed as is to
+            `load_data` (so that sweeps can share the data).
+        input_keys: list, keys of the input and label in the dataset.
+        function_cache: str (optional), directory for caching compiled
+            functions. See `utils.training.set_functions`.
     '''
 
     # ========================================================================
@@ -91,7 +112,10 @@ def train(
 
     # ========================================================================
     print_section('Setting up data')
-    input_keys = dataset_args.pop('keys')
+    if input_keys is None:
+        # Older experiments have the keys in the dataset arguments.
+        dataset_args = dict(dataset_args)
+        input_keys = dataset_args.pop('keys')
     batch_size = learning_args.pop('batch_size')
     valid_batch_size = learning_args.pop('valid_batch_size')
     train, valid, test = load_data(
@@ -137,59 +161,97 @@ def train(
     tparams = model.set_tparams()
     print_profile(tparams)
 
-    # ==========================================================================
-    print_section('Getting cost')
-    outs = model(X_i)
-    p = outs['p']
-    base_cost = model.neg_log_prob(Y, p).sum(axis=0)
-    cost = base_cost
-
-    updates = theano.OrderedUpdates()
-
     l2_decay = learning_args.pop('l2_decay')
-    if l2_decay > 0.:
-        print 'Adding %.5f L2 weight decay' % l2_decay
-        l2_rval = model.l2_decay(l2_decay)
-        l2_cost = l2_rval.pop('cost')
-        cost += l2_cost
-
-    constants = []
-    extra_outs = []
-    extra_outs_keys = ['cost']
-
-    # ==========================================================================
-    print_section('Test functions')
-    error = (Y * (1 - p)).sum(axis=1).mean()
-
-    f_test_keys = ['error', 'cost']
-    f_test_vals = [error, base_cost]
-
-    if l2_decay > 0.:
-        f_test_keys.append('L2 cost')
-        f_test_vals.append(l2_cost)
-    f_test = theano.function([X, Y], f_test_vals)
+    optimizer = learning_args.pop('optimizer')
+    optimizer_args = learning_args.pop('optimizer_args')
+    nan_policy = learning_args.pop('nan_policy')
+    nan_check_every = learning_args.pop('nan_check_every')
+    n_workers = learning_args.pop('n_workers')
+
+    def build():
+        # ======================================================================
+        print_section('Getting cost')
+        outs = model(X_i)
+        p = outs['p']
+        base_cost = model.neg_log_prob(Y, p).sum(axis=0)
+        cost = base_cost
+
+        updates = theano.OrderedUpdates()
+
+        if l2_decay > 0.:
+            print 'Adding %.5f L2 weight decay' % l2_decay
+            l2_rval = model.l2_decay(l2_decay)
+            l2_cost = l2_rval.pop('cost')
+            cost += l2_cost
+
+        constants = []
+        extra_outs = []
+        extra_outs_keys = ['cost']
+
+        # ======================================================================
+        print_section('Test functions')
+        error = (Y * (1 - p)).sum(axis=1).mean()
+
+        f_test_keys = ['error', 'cost']
+        f_test_vals = [error, base_cost]
+
+        if l2_decay > 0.:
+            f_test_keys.append('L2 cost')
+            f_test_vals.append(l2_cost)
+        f_test = theano.function([X, Y], f_test_vals)
+
+        # ======================================================================
+        print_section('Getting gradients and building optimizer.')
+        learned_params, _ = set_params(tparams, updates)
+        f_grad_shared, f_grad_updates, extra_args = set_optimizer(
+            inps, cost, learned_params, constants, updates, extra_outs,
+            optimizer=optimizer, optimizer_args=optimizer_args,
+            nan_policy=nan_policy, nan_check_every=nan_check_every,
+            n_workers=n_workers)
+
+        return OrderedDict(
+            f_grad_shared=f_grad_shared,
+            f_grad_updates=f_grad_updates,
+            guard=extra_args['guard'],
+            f_test=f_test,
+            f_test_keys=f_test_keys,
+            extra_outs_keys=extra_outs_keys)
+
+    functions = set_functions(
+        build, tparams, function_cache=function_cache,
+        demo='classifier', dim_in=dim_in, dim_out=dim_out,
+        batch_size=batch_size, classifier=classifier, dropout=dropout,
+        preprocessing=preprocessing, dataset_args=dataset_args,
+        l2_decay=l2_decay, optimizer=optimizer, optimizer_args=optimizer_args,
+        nan_policy=nan_policy, nan_check_every=nan_check_every,
+        n_workers=n_workers)
+    f_grad_shared = functions['f_grad_shared']
+    f_grad_updates = functions['f_grad_updates']
+    guard = functions['guard']
+    f_test = functions['f_test']
+    f_test_keys = functions['f_test_keys']
+    extra_outs_keys = functions['extra_outs_keys']
 
      # ========================================================================
     print_section('Setting final tparams and save function')
-    tparams, all_params = set_params(tparams, updates)
+    all_params = tparams
 
-    def save(tparams, outfile):
+    def save(tparams, outfile, savez=np.savez):
         d = dict((k, v.get_value()) for k, v in all_params.items())
         d.update(
             dim_in=dim_in,
             dim_out=dim_out,
             mlp=classifier
         )
-        np.savez(outfile, **d)
-
-    # ========================================================================
-    print_section('Getting gradients and building optimizer.')
-    f_grad_shared, f_grad_updates, learning_args = set_optimizer(
-        inps, cost, tparams, constants, updates, extra_outs, **learning_args)
+        savez(outfile, **d)
 
     # ========================================================================
     print_section('Actually running (main loop)')
-    monitor = SimpleMonitor()
+    if out_path is not None:
+        log_file = path.join(out_path, 'stats.jsonl')
+    else:
+        log_file = None
+    monitor = StreamingMonitor(log_file)
 
     main_loop(
         train, valid, tparams,
@@ -201,6 +263,7 @@ def train(
         out_path=out_path,
         name=name,
         extra_outs_keys=extra_outs_keys,
+        guard=guard,
         **learning_args)
 
 if __name__ == '__main__':
@@ -28,6 +28,10 @@ def evaluate(
     dataset_args=None,
     out_path=None,
     mode='test',
+    K=10000,
+    M=100,
+    chunk_size=1000,
+    ais_batch_size=100,
     **kwargs):
 
     if dataset_args is None: dataset_args = dict()
@@ -77,10 +81,8 @@ def evaluate(
 
     # ========================================================================
     print_section('Testing')
-    results, z_updates = model.update_partition_function(M=20, K=10000)
-    f_update_partition = theano.function([], results.values(), updates=z_updates)
-    outs = f_update_partition()
-    out_dict = dict((k, v) for k, v in zip(results.keys(), outs))
+    out_dict = model.run_ais(K=K, M=M, chunk_size=chunk_size,
+                             batch_size=ais_batch_size)
     for k, v in out_dict.iteritems():
         if k == 'log_ws':
             print k, v[-10:]
@@ -14,13 +14,14 @@ from theano import tensor as T
 from cortex.datasets import load_data
 from cortex.models.rbm import RBM, unpack
 from cortex.utils import floatX
-from cortex.utils.monitor import SimpleMonitor
+from cortex.utils.monitor import StreamingMonitor
 from cortex.utils.preprocessor import Preprocessor
 from cortex.utils.tools import get_trng, print_profile, print_section
 from cortex.utils.training import (
     main_loop,
     make_argument_parser,
     set_experiment,
+    set_functions,
     set_model,
     set_optimizer,
     set_params
@@ -31,7 +32,12 @@ def init_learning_args(
     learning_rate=0.0001,
     optimizer='sgd',
     optimizer_args=None,
+    nan_policy='abort',
+    nan_check_every=1,
+    n_workers=1,
     learning_rate_schedule=None,
+    reduce_on_plateau=None,
+    early_stopping=None,
     batch_size=100,
     valid_batch_size=100,
     epochs=100,
@@ -52,7 +58,8 @@ def train(
     dim_h=None, preprocessing=None,
     learning_args=None,
     inference_args=None,
-    dataset_args=None):
+    dataset_args=None,
+    function_cache=None):
 
     # ========================================================================
     if preprocessing is None: preprocessing = []
@@ -103,55 +110,99 @@ def train(
     tparams = model.set_tparams()
     print_profile(tparams)
 
-    # ==========================================================================
-    print_section('Getting cost')
-
     persistent = inference_args.pop('persistent')
-    if persistent:
-        H_p = theano.shared(
-            np.zeros((inference_args['n_chains'], model.h_dist.dim)).astype(floatX),
-            name='h_p')
-    else:
-        H_p = None
-    results, samples, updates, constants = model(
-        X_i, h_p=H_p, **inference_args)
-
-    updates = theano.OrderedUpdates()
-    if persistent:
-        updates += theano.OrderedUpdates([(H_p, samples['hs'][-1])])
-
-    cost = results['cost']
-    extra_outs = [results['free_energy']]
-    extra_outs_keys = ['cost', 'free_energy']
-
-    # ==========================================================================
-    print_section('Test functions')
-    f_test_keys = results.keys()
-    f_test = theano.function([X], results.values())
-
-    try:
-        _, z_updates = model.update_partition_function(K=1000)
-        f_update_partition = theano.function([], [], updates=z_updates)
-    except NotImplementedError:
-        f_update_partition = None
-
-    H0 = model.trng.binomial(size=(10, model.h_dist.dim), dtype=floatX)
-    s_outs, s_updates = model.sample(H0, n_steps=100)
-    f_chain = theano.function(
-        [], model.v_dist.get_center(s_outs['pvs']), updates=s_updates)
-
-     # ========================================================================
-    print_section('Setting final tparams and save function')
     excludes = learning_args.pop('excludes')
-    tparams, all_params = set_params(tparams, updates, excludes=excludes)
+    optimizer = learning_args.pop('optimizer')
+    optimizer_args = learning_args.pop('optimizer_args')
+    nan_policy = learning_args.pop('nan_policy')
+    nan_check_every = learning_args.pop('nan_check_every')
+    n_workers = learning_args.pop('n_workers')
+
+    def build():
+        # ======================================================================
+        print_section('Getting cost')
+
+        if persistent:
+            H_p = theano.shared(
+                np.zeros((inference_args['n_chains'], model.h_dist.dim)).astype(floatX),
+                name='h_p')
+        else:
+            H_p = None
+        results, samples, updates, constants = model(
+            X_i, h_p=H_p, **inference_args)
+
+        updates = theano.OrderedUpdates()
+        if persistent:
+            updates += theano.OrderedUpdates([(H_p, samples['hs'][-1])])
+
+        cost = results['cost']
+        extra_outs = [results['free_energy']]
+        extra_outs_keys = ['cost', 'free_energy']
+
+        # ======================================================================
+        print_section('Test functions')
+        f_test_keys = results.keys()
+        f_test = theano.function([X], results.values())
+
+        try:
+            _, z_updates = model.update_partition_function(K=1000)
+            f_update_partition = theano.function([], [], updates=z_updates)
+        except NotImplementedError:
+            f_update_partition = None
+
+        H0 = model.trng.binomial(size=(10, model.h_dist.dim), dtype=floatX)
+        s_outs, s_updates = model.sample(H0, n_steps=100)
+        f_chain = theano.function(
+            [], model.v_dist.get_center(s_outs['pvs']), updates=s_updates)
+
+        # ======================================================================
+        print_section('Getting gradients and building optimizer.')
+        learned_params, _ = set_params(tparams, updates, excludes=excludes)
+        f_grad_shared, f_grad_updates, extra_args = set_optimizer(
+            [X], cost, learned_params, constants, updates, extra_outs,
+            optimizer=optimizer, optimizer_args=optimizer_args,
+            nan_policy=nan_policy, nan_check_every=nan_check_every,
+            n_workers=n_workers)
+
+        return OrderedDict(
+            f_grad_shared=f_grad_shared,
+            f_grad_updates=f_grad_updates,
+            guard=extra_args['guard'],
+            f_test=f_test,
+            f_test_keys=f_test_keys,
+            f_update_partition=f_update_partition,
+            f_chain=f_chain,
+            extra_outs_keys=extra_outs_keys)
+
+    functions = set_functions(
+        build, tparams, function_cache=function_cache,
+        demo='rbm', dim_in=dim_in, dim_h=dim_h, batch_size=batch_size,
+        v_dist=train.distributions[train.name],
+        preprocessing=preprocessing, dataset_args=dataset_args,
+        persistent=persistent, inference_args=inference_args,
+        excludes=excludes, optimizer=optimizer, optimizer_args=optimizer_args,
+        nan_policy=nan_policy, nan_check_every=nan_check_every,
+        n_workers=n_workers)
+    f_grad_shared = functions['f_grad_shared']
+    f_grad_updates = functions['f_grad_updates']
+    guard = functions['guard']
+    f_test = functions['f_test']
+    f_test_keys = functions['f_test_keys']
+    f_update_partition = functions['f_update_partition']
+    f_chain = functions['f_chain']
+    extra_outs_keys = functions['extra_outs_keys']
 
-    def save(tparams, outfile):
+    # ========================================================================
+    print_section('Setting final tparams and save function')
+    all_params = tparams
+
+    def save(tparams, outfile, savez=np.savez):
         d = dict((k, v.get_value()) for k, v in all_params.items())
         d.update(
             dim_in=dim_in,
             dim_h=dim_h
         )
-        np.savez(outfile, **d)
+        savez(outfile, **d)
 
     def save_images():
         w = model.W.get_value().T
@@ -161,14 +212,13 @@ def train(
         chain = f_chain()
         train.save_images(chain, path.join(out_path, 'chain.png'))
 
-    # ========================================================================
-    print_section('Getting gradients and building optimizer.')
-    f_grad_shared, f_grad_updates, learning_args = set_optimizer(
-        [X], cost, tparams, constants, updates, extra_outs, **learning_args)
-
     # ========================================================================
     print_section('Actually running (main loop)')
-    monitor = SimpleMonitor()
+    if out_path is not None:
+        log_file = path.join(out_path, 'stats.jsonl')
+    else:
+        log_file = None
+    monitor = StreamingMonitor(log_file)
 
     main_loop(
         train, valid, tparams,
@@ -181,6 +231,7 @@ def train(
         out_path=out_path,
         name=name,
         extra_outs_keys=extra_outs_keys,
+        guard=guard,
         **learning_args)
 
 if __name__ == '__main__':
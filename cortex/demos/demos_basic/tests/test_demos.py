@@ -1,11 +1,15 @@
 '''Tests the demos.
 '''
 
+from glob import glob
 from os import path
+import shutil
+import tempfile
 
 from cortex.demos.demos_basic import classifier
 from cortex.demos.demos_basic import rbm_mnist
 from cortex.demos.demos_basic import vae
+from cortex.utils.sweep import run_sweep
 from cortex.utils.tools import load_experiment
 
 d = path.abspath(path.dirname(path.realpath(__file__)) + '/..')
@@ -32,4 +36,43 @@ def test_vae(epochs=5):
     exp_dict = load_experiment(yaml)
     exp_dict['learning_args']['epochs'] = epochs
     exp_dict['dataset_args']['stop'] = 100
-    vae.train(**exp_dict)
\ No newline at end of file
+    vae.train(**exp_dict)
+
+def test_function_cache(epochs=1):
+    cache_dir = tempfile.mkdtemp()
+    try:
+        for _ in xrange(2):
+            yaml = path.join(d, 'vae_mnist.yaml')
+            exp_dict = load_experiment(yaml)
+            exp_dict['learning_args']['epochs'] = epochs
+            exp_dict['dataset_args']['stop'] = 100
+            exp_dict['function_cache'] = cache_dir
+            vae.train(**exp_dict)
+        assert len(glob(path.join(cache_dir, '*.pkl'))) == 1
+    finally:
+        shutil.rmtree(cache_dir)
+
+def test_sweep(n_jobs=2):
+    out_path = tempfile.mkdtemp()
+    try:
+        sweep = dict(grid={'learning_args.epochs': [1],
+                           'dataset_args.stop': [100],
+                           'learning_args.learning_rate': [0.01, 0.001]})
+        rows = run_sweep('cortex.demos.demos_basic.classifier',
+                         path.join(d, 'classifier_mnist.yaml'), sweep,
+                         out_path=out_path, n_jobs=n_jobs, sort_key='error')
+        assert len(rows) == 2
+        for row in rows:
+            assert row['status'] == 'done', row
+            assert row['epochs'] == 2
+            assert 'error' in row.keys()
+        assert rows[0]['error'] <= rows[1]['error']
+        sweep_path = path.join(out_path, 'classifier_mnist_sweep')
+        assert path.isfile(path.join(sweep_path, 'summary.tsv'))
+        assert len(glob(path.join(sweep_path, 'data', '*.npy'))) == 6
+        # Trials use the shared data instead of loading MNIST again.
+        for log_file in glob(path.join(sweep_path, '*', 'log.txt')):
+            with open(log_file) as f:
+                assert 'Loading mnist' not in f.read(), log_file
+    finally:
+        shutil.rmtree(out_path)
@@ -14,13 +14,14 @@ from theano import tensor as T
 from cortex.datasets import load_data
 from cortex.models.helmholtz import Helmholtz, unpack
 from cortex.utils import floatX
-from cortex.utils.monitor import SimpleMonitor
+from cortex.utils.monitor import StreamingMonitor
 from cortex.utils.preprocessor import Preprocessor
 from cortex.utils.tools import get_trng, print_profile, print_section
 from cortex.utils.training import (
     main_loop,
     make_argument_parser,
     set_experiment,
+    set_functions,
     set_model,
     set_optimizer,
     set_params
@@ -30,9 +31,14 @@ from cortex.utils.training import (
 def init_learning_args(
     learning_rate=0.0001,
     learning_rate_schedule=None,
+    reduce_on_plateau=None,
+    early_stopping=None,
     l2_decay=0.,
     optimizer='rmsprop',
     optimizer_args=None,
+    nan_policy='abort',
+    nan_check_every=1,
+    n_workers=1,
     n_posterior_samples=20,
     reweight=False,
     batch_size=100,
@@ -49,7 +55,8 @@ def train(
     dim_h=None, rec_args=None, gen_args=None, prior='gaussian',
     preprocessing=None,
     learning_args=None,
-    dataset_args=None):
+    dataset_args=None,
+    function_cache=None):
 
     # ========================================================================
     if preprocessing is None: preprocessing = []
@@ -104,56 +111,102 @@ def train(
     tparams = model.set_tparams()
     print_profile(tparams)
 
-    # ==========================================================================
-    print_section('Getting cost')
-    constants = []
-    updates = theano.OrderedUpdates()
     n_posterior_samples = learning_args.pop('n_posterior_samples')
     reweight = learning_args.pop('reweight')
-    results, samples, constants, updates = model(
-        X_i, X, qk=None, pass_gradients=True,
-        n_posterior_samples=n_posterior_samples, reweight=reweight)
-
-    cost = results['cost']
-    extra_outs = []
-    extra_outs_keys = ['cost']
-
     l2_decay = learning_args.pop('l2_decay')
-    if l2_decay is not False and l2_decay > 0.:
-        print 'Adding %.5f L2 weight decay' % l2_decay
-        l2_rval = model.l2_decay(l2_decay)
-        cost += l2_rval.pop('cost')
-        extra_outs += l2_rval.values()
-        extra_outs_keys += l2_rval.keys()
-
-    # ==========================================================================
-    print_section('Test functions')
-    f_test_keys = results.keys()
-    f_test = theano.function([X], results.values())
-
-    prior_samples, p_updates = model.sample_from_prior()
-    f_prior = theano.function([], prior_samples, updates=p_updates)
-
-    latent_vis = model.visualize_latents()
-    f_latent = theano.function([], latent_vis)
-
-    py = samples['py']
-    f_py_h = theano.function([X], py)
+    excludes = learning_args.pop('excludes')
+    optimizer = learning_args.pop('optimizer')
+    optimizer_args = learning_args.pop('optimizer_args')
+    nan_policy = learning_args.pop('nan_policy')
+    nan_check_every = learning_args.pop('nan_check_every')
+    n_workers = learning_args.pop('n_workers')
+
+    def build():
+        # ======================================================================
+        print_section('Getting cost')
+        constants = []
+        updates = theano.OrderedUpdates()
+        results, samples, constants, updates = model(
+            X_i, X, qk=None, pass_gradients=True,
+            n_posterior_samples=n_posterior_samples, reweight=reweight)
+
+        cost = results['cost']
+        extra_outs = []
+        extra_outs_keys = ['cost']
+
+        if l2_decay is not False and l2_decay > 0.:
+            print 'Adding %.5f L2 weight decay' % l2_decay
+            l2_rval = model.l2_decay(l2_decay)
+            cost += l2_rval.pop('cost')
+            extra_outs += l2_rval.values()
+            extra_outs_keys += l2_rval.keys()
+
+        # ======================================================================
+        print_section('Test functions')
+        f_test_keys = results.keys()
+        f_test = theano.function([X], results.values())
+
+        prior_samples, p_updates = model.sample_from_prior()
+        f_prior = theano.function([], prior_samples, updates=p_updates)
+
+        latent_vis = model.visualize_latents()
+        f_latent = theano.function([], latent_vis)
+
+        py = samples['py']
+        f_py_h = theano.function([X], py)
+
+        # ======================================================================
+        print_section('Getting gradients and building optimizer.')
+        learned_params, _ = set_params(tparams, updates, excludes=excludes)
+        f_grad_shared, f_grad_updates, extra_args = set_optimizer(
+            inps, cost, learned_params, constants, updates, extra_outs,
+            optimizer=optimizer, optimizer_args=optimizer_args,
+            nan_policy=nan_policy, nan_check_every=nan_check_every,
+            n_workers=n_workers)
+
+        return OrderedDict(
+            f_grad_shared=f_grad_shared,
+            f_grad_updates=f_grad_updates,
+            guard=extra_args['guard'],
+            f_test=f_test,
+            f_test_keys=f_test_keys,
+            f_prior=f_prior,
+            f_latent=f_latent,
+            f_py_h=f_py_h,
+            extra_outs_keys=extra_outs_keys)
+
+    functions = set_functions(
+        build, tparams, function_cache=function_cache,
+        demo='vae', dim_in=dim_in, batch_size=batch_size, dim_h=dim_h,
+        prior=prior, rec_args=rec_args, gen_args=gen_args,
+        preprocessing=preprocessing, dataset_args=dataset_args,
+        n_posterior_samples=n_posterior_samples, reweight=reweight,
+        l2_decay=l2_decay, excludes=excludes, optimizer=optimizer,
+        optimizer_args=optimizer_args,
+        nan_policy=nan_policy, nan_check_every=nan_check_every,
+        n_workers=n_workers)
+    f_grad_shared = functions['f_grad_shared']
+    f_grad_updates = functions['f_grad_updates']
+    guard = functions['guard']
+    f_test = functions['f_test']
+    f_test_keys = functions['f_test_keys']
+    f_prior = functions['f_prior']
+    f_latent = functions['f_latent']
+    f_py_h = functions['f_py_h']
+    extra_outs_keys = functions['extra_outs_keys']
 
     # ========================================================================
     print_section('Setting final tparams and save function')
-    excludes = learning_args.pop('excludes')
-    tparams, all_params = set_params(
-        tparams, updates, excludes=excludes)
+    all_params = tparams
 
-    def save(tparams, outfile):
+    def save(tparams, outfile, savez=np.savez):
         d = dict((k, v.get_value()) for k, v in all_params.items())
         d.update(
             dim_h=dim_h,
             rec_args=rec_args,
             gen_args=gen_args
         )
-        np.savez(outfile, **d)
+        savez(outfile, **d)
 
     def save_images():
         p_samples = f_prior()
@@ -168,14 +221,13 @@ def train(
         py_h = f_py_h(train.X[:100])
         train.save_images(py_h, path.join(out_path, 'py_h.png'))
 
-    # ========================================================================
-    print_section('Getting gradients and building optimizer.')
-    f_grad_shared, f_grad_updates, learning_args = set_optimizer(
-        inps, cost, tparams, constants, updates, extra_outs, **learning_args)
-
     # ========================================================================
     print_section('Actually running (main loop)')
-    monitor = SimpleMonitor()
+    if out_path is not None:
+        log_file = path.join(out_path, 'stats.jsonl')
+    else:
+        log_file = None
+    monitor = StreamingMonitor(log_file)
 
     main_loop(
         train, valid, tparams,
@@ -187,6 +239,7 @@ def train(
         out_path=out_path,
         name=name,
         extra_outs_keys=extra_outs_keys,
+        guard=guard,
         **learning_args)
 
 if __name__ == '__main__':
@@ -15,7 +15,7 @@ from cortex.datasets import load_data_split
 from cortex.datasets.neuroimaging import resolve as resolve_dataset
 from cortex.models.rbm import RBM, unpack
 from cortex.utils import floatX
-from cortex.utils.monitor import SimpleMonitor
+from cortex.utils.monitor import StreamingMonitor
 from cortex.utils.preprocessor import Preprocessor
 from cortex.utils.tools import get_trng, print_profile, print_section
 from cortex.utils.training import (
@@ -33,7 +33,12 @@ def init_learning_args(
     l2_decay=0.,
     l1_decay=0.,
     optimizer_args=None,
+    nan_policy='abort',
+    nan_check_every=1,
+    n_workers=1,
     learning_rate_schedule=None,
+    reduce_on_plateau=None,
+    early_stopping=None,
     batch_size=100,
     valid_batch_size=100,
     epochs=100,
@@ -165,14 +170,14 @@ def train(
     excludes = learning_args.pop('excludes')
     tparams, all_params = set_params(tparams, updates, excludes=excludes)
 
-    def save(tparams, outfile):
+    def save(tparams, outfile, savez=np.savez):
         d = dict((k, v.get_value()) for k, v in all_params.items())
         d.update(
             dim_in=dim_in,
             dim_h=dim_h,
             dataset_args=dataset_args
         )
-        np.savez(outfile, **d)
+        savez(outfile, **d)
 
     def save_images():
         w = model.W.get_value().T
@@ -185,7 +190,11 @@ def train(
 
     # ========================================================================
     print_section('Actually running (main loop)')
-    monitor = SimpleMonitor()
+    if out_path is not None:
+        log_file = path.join(out_path, 'stats.jsonl')
+    else:
+        log_file = None
+    monitor = StreamingMonitor(log_file)
 
     main_loop(
         train, valid, tparams,
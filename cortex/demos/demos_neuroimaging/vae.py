@@ -15,7 +15,7 @@ from cortex.datasets import load_data_split
 from cortex.datasets.neuroimaging import resolve as resolve_dataset
 from cortex.models.helmholtz import Helmholtz, unpack
 from cortex.utils import floatX
-from cortex.utils.monitor import SimpleMonitor
+from cortex.utils.monitor import StreamingMonitor
 from cortex.utils.preprocessor import Preprocessor
 from cortex.utils.tools import get_trng, print_profile, print_section
 from cortex.utils.training import (
@@ -31,9 +31,14 @@ from cortex.utils.training import (
 def init_learning_args(
     learning_rate=0.0001,
     learning_rate_schedule=None,
+    reduce_on_plateau=None,
+    early_stopping=None,
     l2_decay=0.,
     optimizer='rmsprop',
     optimizer_args=None,
+    nan_policy='abort',
+    nan_check_every=1,
+    n_workers=1,
     n_posterior_samples=20,
     batch_size=100,
     valid_batch_size=100,
@@ -150,14 +155,14 @@ def train(
     tparams, all_params = set_params(
         tparams, updates, excludes=excludes)
 
-    def save(tparams, outfile):
+    def save(tparams, outfile, savez=np.savez):
         d = dict((k, v.get_value()) for k, v in all_params.items())
         d.update(
             dim_h=dim_h,
             rec_args=rec_args,
             gen_args=gen_args
         )
-        np.savez(outfile, **d)
+        savez(outfile, **d)
 
     def save_images():
         p_samples = f_prior()
@@ -176,7 +181,11 @@ def train(
 
     # ========================================================================
     print_section('Actually running (main loop)')
-    monitor = SimpleMonitor()
+    if out_path is not None:
+        log_file = path.join(out_path, 'stats.jsonl')
+    else:
+        log_file = None
+    monitor = StreamingMonitor(log_file)
 
     main_loop(
         train, valid, tparams,
@@ -4,6 +4,7 @@
 
 from .air import AIR, DeepAIR
 from .gdir import MomentumGDIR
+from .importance import ImportanceSampler
 from .rws import RWS, DeepRWS
 
 
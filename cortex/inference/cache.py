@@ -0,0 +1,136 @@
+'''
+Warm-start cache of refined posteriors.
+
+IRVI methods start each batch from the recognition network (or the prior)
+and refine it for `n_inference_steps`, so the same samples are refined from
+scratch every epoch. `PosteriorCache` keeps the refined parameters `qk` of
+each sample, indexed by its position in the dataset, to start from them the
+next time the sample is seen. The cache lives in shared variables and is
+read and written in the inference graph.
+
+Entries are reused at most `max_age` times in a row before the sample is
+started again from the recognition network, so they do not drift away from
+a model that keeps changing. With `max_mbytes`, the cache holds fewer slots
+than samples: samples share slots by position modulo the number of slots,
+and a sample whose slot was taken by another starts from scratch.
+
+Use it with `warm_start` in the inference arguments, e.g.:
+
+    inference_args: {
+      inference_method: 'air',
+      n_inference_steps: 5,
+      warm_start: {n: 60000, max_age: 10, max_mbytes: 100}
+    }
+
+and feed the dataset positions of the batch (see `index_key` of
+`datasets.BasicDataset`) as `idx` to the training function only: positions in
+the validation and test sets would take the slots of training samples.
+Without `idx`, the cache is not used, and calling the inference method warns.
+
+'''
+
+import numpy as np
+import theano
+from theano import tensor as T
+
+from ..utils import floatX
+
+
+class PosteriorCache(object):
+    '''Cache of posterior parameters indexed by dataset position.
+
+    Attributes:
+        n (int): number of samples in the dataset.
+        dim (int): dimension of the posterior parameters.
+        capacity (int): number of slots.
+        max_age (int or None): number of times an entry is reused in a row.
+            If None, entries are always reused.
+        q (theano.shared): cached parameters, one row per slot.
+        keys (theano.shared): position of the sample in each slot, -1 if
+            empty.
+        ages (theano.shared): number of times the entry of each slot was
+            reused.
+
+    '''
+    def __init__(self, n, dim, max_age=None, max_mbytes=None,
+                 name='posterior_cache'):
+        '''Init function for PosteriorCache.
+
+        Args:
+            n (int): number of samples in the dataset.
+            dim (int): dimension of the posterior parameters.
+            max_age (Optional[int]): number of times an entry is reused in a
+                row.
+            max_mbytes (Optional[float]): memory cap in megabytes.
+            name (str): name of the shared variables.
+
+        '''
+        self.n = n
+        self.dim = dim
+        self.max_age = max_age
+        self.name = name
+
+        slot_bytes = dim * np.dtype(floatX).itemsize + 2 * 4
+        capacity = n
+        if max_mbytes is not None:
+            capacity = min(n, int(max_mbytes * 2 ** 20 // slot_bytes))
+        if capacity < 1:
+            raise ValueError('Cache of %.3f MB cannot hold a sample of %d '
+                             'bytes' % (max_mbytes, slot_bytes))
+        self.capacity = capacity
+        print ('Caching posteriors of %d samples in %d slots (%.1f MB)'
+               % (n, capacity, capacity * slot_bytes / 2. ** 20))
+
+        self.q = theano.shared(np.zeros((capacity, dim), dtype=floatX),
+                               name=name + '_q')
+        self.keys = theano.shared(-np.ones((capacity,), dtype='int32'),
+                                  name=name + '_keys')
+        self.ages = theano.shared(np.zeros((capacity,), dtype='int32'),
+                                  name=name + '_ages')
+
+    def reset(self):
+        '''Empties the cache.
+
+        '''
+        self.keys.set_value(-np.ones((self.capacity,), dtype='int32'))
+        self.ages.set_value(np.zeros((self.capacity,), dtype='int32'))
+
+    def lookup(self, idx, q0):
+        '''Initial posterior parameters from the cache.
+
+        Args:
+            idx (T.ivector): dataset positions of the batch.
+            q0 (T.tensor): parameters for samples not in the cache.
+
+        Returns:
+            T.tensor: initial parameters.
+            T.vector: 1 for samples found in the cache, 0 otherwise.
+
+        '''
+        slots = idx % self.capacity
+        hits = T.eq(self.keys[slots], idx)
+        if self.max_age is not None:
+            hits = hits * T.lt(self.ages[slots], self.max_age)
+        q0 = T.switch(hits[:, None], self.q[slots], q0).astype(floatX)
+        return q0, hits
+
+    def store(self, idx, qk, hits):
+        '''Updates that store refined parameters.
+
+        Args:
+            idx (T.ivector): dataset positions of the batch.
+            qk (T.tensor): refined parameters.
+            hits (T.vector): from `lookup`.
+
+        Returns:
+            theano.OrderedUpdates.
+
+        '''
+        slots = idx % self.capacity
+        ages = T.switch(hits, self.ages[slots] + 1, 0).astype('int32')
+        updates = theano.OrderedUpdates()
+        updates[self.q] = T.set_subtensor(
+            self.q[slots], theano.gradient.disconnected_grad(qk))
+        updates[self.keys] = T.set_subtensor(self.keys[slots], idx)
+        updates[self.ages] = T.set_subtensor(self.ages[slots], ages)
+        return updates
@@ -0,0 +1,149 @@
+'''
+Importance-sampled estimates with many posterior samples.
+
+`Helmholtz.__call__` and `RWS.__call__` draw all posterior samples in one
+graph, so memory grows with the number of samples. `ImportanceSampler`
+instead draws them in chunks of fixed size and folds the log weights into
+running log-sum-exps, so that :math:`-\log p(x)` and the log effective sample
+size can be estimated with thousands of samples in bounded memory:
+
+    sampler = ImportanceSampler(model, chunk_size=100)
+    results = sampler(x, n_posterior_samples=5000)
+
+'''
+
+from collections import OrderedDict
+import numpy as np
+import theano
+from theano import tensor as T
+import time
+
+from ..utils import floatX
+
+
+class LogSumExp(object):
+    '''Running log-sum-exp over the first axis.
+
+    Attributes:
+        value (numpy.array or None): log-sum-exp so far.
+        n (int): number of rows folded in.
+
+    '''
+    def __init__(self):
+        self.value = None
+        self.n = 0
+
+    def update(self, x):
+        '''Folds in rows.
+
+        Args:
+            x (numpy.array): values, rows on the first axis.
+
+        '''
+        x = np.asarray(x, dtype='float64')
+        x_max = x.max(axis=0)
+        if self.value is not None:
+            x_max = np.maximum(x_max, self.value)
+        # Rows of -inf only (no mass yet) must not give nans.
+        x_max = np.where(np.isfinite(x_max), x_max, 0.)
+        s = np.exp(x - x_max).sum(axis=0)
+        if self.value is not None:
+            s += np.exp(self.value - x_max)
+        self.value = np.log(s) + x_max
+        self.n += x.shape[0]
+
+
+class ImportanceSampler(object):
+    '''Estimates the log marginal with posterior samples drawn in chunks.
+
+    Attributes:
+        model (Helmholtz): model with `log_importance_weights`.
+        chunk_size (int): number of posterior samples drawn at a time.
+        f_q (theano.function): approximate posterior of the inputs.
+        f_log_w (theano.function): log weights of a chunk, from the outputs,
+            the approximate posterior and the number of samples.
+
+    '''
+    def __init__(self, model, chunk_size=100):
+        '''Init function for ImportanceSampler.
+
+        Args:
+            model (Helmholtz): model with `log_importance_weights`.
+            chunk_size (int): number of posterior samples drawn at a time.
+                Memory of the graph scales with `chunk_size` times the batch
+                size.
+
+        '''
+        if chunk_size < 1:
+            raise ValueError('chunk_size must be at least 1 (got %d)'
+                             % chunk_size)
+        self.model = model
+        self.chunk_size = chunk_size
+
+        X = T.matrix('x', dtype=floatX)
+        Y = T.matrix('y', dtype=floatX)
+        Q = T.matrix('q', dtype=floatX)
+        N = T.iscalar('n')
+        self.f_q = theano.function([X], model.posterior.feed(X))
+        self.f_log_w = theano.function(
+            [Y, Q, N],
+            model.log_importance_weights(Y, Q, n_posterior_samples=N))
+
+    def log_weights(self, x, y=None, qk=None, n_posterior_samples=1000):
+        '''Iterates over the log weights, chunk by chunk.
+
+        Args:
+            x (numpy.array): input to the recognition network.
+            y (Optional[numpy.array]): output of the conditional. Defaults to
+                `x`.
+            qk (Optional[numpy.array]): approximate posterior parameters,
+                e.g., after iterative refinement. If None, computed from the
+                recognition network.
+            n_posterior_samples (int): total number of samples.
+
+        Yields:
+            numpy.array: log weights, with shape (chunk, batch).
+
+        '''
+        if y is None:
+            y = x
+        if qk is None:
+            qk = self.f_q(x)
+        for start in xrange(0, n_posterior_samples, self.chunk_size):
+            n = min(self.chunk_size, n_posterior_samples - start)
+            yield self.f_log_w(y, qk, n)
+
+    def __call__(self, x, y=None, qk=None, n_posterior_samples=1000):
+        '''Estimates :math:`-\log p(x)` and the log effective sample size.
+
+        Args:
+            x (numpy.array): input to the recognition network.
+            y (Optional[numpy.array]): output of the conditional. Defaults to
+                `x`.
+            qk (Optional[numpy.array]): approximate posterior parameters.
+            n_posterior_samples (int): total number of samples.
+
+        Returns:
+            OrderedDict: batch means of `-log p(x)` and `log ESS`, and the
+                throughput in samples/sec (posterior samples times rows).
+
+        '''
+        t0 = time.time()
+        lse = LogSumExp()
+        lse2 = LogSumExp()
+        for log_w in self.log_weights(x, y=y, qk=qk,
+                                      n_posterior_samples=n_posterior_samples):
+            lse.update(log_w)
+            lse2.update(2 * log_w)
+        elapsed = time.time() - t0
+
+        log_p = lse.value - np.log(lse.n)
+        # ESS = (sum w)^2 / sum w^2, as 1 / sum w_tilde^2 in `Helmholtz`.
+        log_ess = 2 * lse.value - lse2.value
+        n_rows = lse.value.shape[0]
+
+        return OrderedDict([
+            ('-log p(x)', float(-log_p.mean())),
+            ('log ESS', float(log_ess.mean())),
+            ('samples/sec', lse.n * n_rows / max(elapsed, 1e-12))
+        ])
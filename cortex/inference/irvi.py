@@ -3,9 +3,12 @@ Iterative refinement of the approximate posterior
 '''
 
 from collections import OrderedDict
+import numpy as np
 import theano
 from theano import tensor as T
+import warnings
 
+from .cache import PosteriorCache
 from ..utils import floatX
 from ..utils.tools import (
     scan,
@@ -30,6 +33,11 @@ class IRVI(object):
         n_inference_samples (int): Number of samples to draw from the approximate posterior.
         pass_gradients (bool): Pass gradients during inference.
         use_all_samples (bool): Use all the samples rather than just last.
+        cache (PosteriorCache or None): warm-start cache of refined posteriors.
+        tolerance (float or None): stop refining once the inference cost of
+            the batch improves less than this.
+        sample_tolerance (float or None): stop refining a sample once its
+            posterior parameters change less than this.
 
     '''
     def __init__(self,
@@ -41,6 +49,9 @@ class IRVI(object):
                  pass_gradients=True,
                  init_inference='recognition_network',
                  use_all_samples=False,
+                 warm_start=None,
+                 tolerance=None,
+                 sample_tolerance=None,
                  **kwargs):
         '''Initialization function for IRVI.
 
@@ -53,6 +64,15 @@ class IRVI(object):
                 posterior.
             pass_gradients (bool): Pass gradients during inference.
             use_all_samples (bool): Use all the samples rather than just last.
+            warm_start (Optional[dict or PosteriorCache]): cache of refined
+                posteriors used to initialize inference, or its arguments
+                (see `PosteriorCache`).
+            tolerance (Optional[float]): stop refining once the inference
+                cost of the batch improves less than this. At most
+                `n_inference_steps` are done.
+            sample_tolerance (Optional[float]): stop refining a sample once
+                the largest change of its posterior parameters is less than
+                this. Refinement stops when all samples have stopped.
 
         '''
 
@@ -64,6 +84,14 @@ class IRVI(object):
         self.n_inference_samples = n_inference_samples
         self.pass_gradients = pass_gradients
         self.use_all_samples = use_all_samples
+        self.tolerance = tolerance
+        self.sample_tolerance = sample_tolerance
+        self.adaptive = tolerance is not None or sample_tolerance is not None
+        if isinstance(warm_start, dict):
+            warm_start = PosteriorCache(
+                dim=model.posterior.dim_out, name=name + '_cache',
+                **warm_start)
+        self.cache = warm_start
 
         warn_kwargs(self, **kwargs)
 
@@ -101,6 +129,47 @@ class IRVI(object):
         '''
         raise NotImplementedError()
 
+    def step_adaptive(self, n_states, epsilon, *params):
+        '''Step inference with early termination for `scan`.
+
+        Wraps `step_infer`, which returns the new states (the posterior
+        parameters first) followed by the cost. Samples that stopped keep
+        their states.
+
+        Args:
+            n_states (int): number of states of `step_infer`.
+            epsilon (T.tensor): random variables of the step.
+            *params: states, previous cost, active samples, then the
+                non-sequences of `step_infer`.
+
+        Returns:
+            list: new states, cost and active samples.
+            theano.scan_module.until: stopping condition.
+
+        '''
+        params = list(params)
+        states = params[:n_states]
+        cost_, active = params[n_states:n_states + 2]
+        non_seqs = params[n_states + 2:]
+
+        outs = self.step_infer(*([epsilon] + states + non_seqs))
+        new_states = list(outs[:n_states])
+        cost = outs[n_states].astype(floatX)
+
+        q = states[0]
+        if self.sample_tolerance is not None:
+            dq = abs(new_states[0] - q).max(axis=q.ndim - 1)
+            for i, (state, new_state) in enumerate(zip(states, new_states)):
+                if state.ndim == q.ndim:
+                    new_states[i] = T.switch(
+                        active[:, None], new_state, state).astype(state.dtype)
+            active = (active * T.gt(dq, self.sample_tolerance)).astype(floatX)
+
+        stop = T.eq(active.sum(), 0)
+        if self.tolerance is not None:
+            stop = T.or_(stop, T.lt(cost_ - cost, self.tolerance))
+        return new_states + [cost, active], theano.scan_module.until(stop)
+
     def init_variational_inference(self, x):
         '''Initialize variational inference.
 
@@ -124,13 +193,16 @@ class IRVI(object):
 
         return q0
 
-    def inference(self, x, y, q0=None):
+    def inference(self, x, y, q0=None, idx=None):
         '''Perform inference
 
         Args:
             x (T.tensor): Input data sample for posterior, p(h|x)
             y (T.tensor): Output data sample for conditional, p(x|h)
             q0 (Optional[T.tensor]): Initial posterior parameters.
+            idx (Optional[T.ivector]): Dataset positions of the samples. If
+                given with a warm-start cache, inference starts from the
+                cached posteriors and the refined ones are stored.
 
         Returns:
             OrderedDict: Results from inference.
@@ -144,6 +216,11 @@ class IRVI(object):
         # Initialize inference.
         if q0 is None:
             q0 = self.init_variational_inference(x)
+        if idx is not None and self.cache is not None:
+            print 'Warm-starting %s inference from cache' % self.name
+            q0, hits = self.cache.lookup(idx, q0)
+        else:
+            hits = None
 
         # Set random variables.
         epsilons = model.init_inference_samples(
@@ -161,7 +238,28 @@ class IRVI(object):
                   self.inference_rate, self.n_inference_samples))
 
         # Perform inference.
-        if self.n_inference_steps > 1:
+        n_steps = None
+        if self.n_inference_steps > 1 and self.adaptive:
+            print ('Adaptive inference steps (tolerance %s, sample tolerance '
+                   '%s). Using `scan`' % (self.tolerance, self.sample_tolerance))
+            n_states = len(outputs_info) - 1
+            outputs_info = outputs_info[:-1] + [
+                T.constant(np.inf).astype(floatX),
+                T.ones((x.shape[0],), dtype=floatX)]
+            outs, updates_i = scan(
+                lambda *args: self.step_adaptive(n_states, *args), seqs,
+                outputs_info, non_seqs, self.n_inference_steps,
+                self.name + '_infer'
+            )
+            updates.update(updates_i)
+            qs, i_costs = self.unpack_infer(outs[:-1])
+            actives = outs[-1]
+            n_steps = qs.shape[0].astype(floatX)
+            # Samples are refined in a step if active before it.
+            sample_steps = T.concatenate(
+                [T.ones_like(actives[:1]), actives[:-1]], axis=0).sum(0)
+            qs = T.concatenate([q0[None, :, :], qs], axis=0)
+        elif self.n_inference_steps > 1:
             print 'Multiple inference steps. Using `scan`'
             outs, updates_i = scan(
                 self.step_infer, seqs, outputs_info, non_seqs, self.n_inference_steps,
@@ -198,12 +296,22 @@ class IRVI(object):
             i_costs=i_costs
         )
 
+        if hits is not None:
+            updates.update(self.cache.store(idx, qs[-1], hits))
+            rval['cache_hits'] = hits.mean().astype(floatX)
+
+        if n_steps is not None:
+            rval['n_steps'] = n_steps
+            rval['sample_steps'] = sample_steps.mean().astype(floatX)
+
         return rval, constants, updates
 
     def test(self, x, y, stride=1, **model_args):
         '''Testing function for inference.
 
         Returns a larger summary across different number of inference steps.
+        The posteriors of the summary steps are stacked and evaluated by the
+        model at once, so the graph does not grow with the number of steps.
 
         Args:
             x (T.tensor): Input data sample for posterior, p(h|x)
@@ -235,16 +343,33 @@ class IRVI(object):
         else:
             steps = [0]
 
-        # Extract results from model
+        # Extract results from model, with all summary steps in one pass.
+        idx = T.constant(steps, dtype='int64')
+        if 'n_steps' in inference_outs:
+            # Adaptive inference can stop before the summary step.
+            q_idx = T.minimum(idx, qs.shape[0] - 1)
+            c_idx = T.minimum(idx, i_costs.shape[0] - 1)
+        else:
+            q_idx = c_idx = idx
+        results_s, samples_s, _, _ = model(x, y, qs[q_idx], **model_args)
+
         full_results = OrderedDict()
         full_results['i_cost'] = []
         samples = OrderedDict()
-        for i in steps:
-            qk  = qs[i]
-            results_k, samples_k, _, _ = model(x, y, qk, **model_args)
-            samples_k['q'] = qk
+        for j in xrange(len(steps)):
+            results_k = OrderedDict(
+                (k, v[j] if v.ndim > 0 else v)
+                for k, v in results_s.iteritems())
+            samples_k = OrderedDict(
+                (k, v[:, j] if v.ndim > 1 else v[j])
+                for k, v in samples_s.iteritems())
+            samples_k['q'] = qs[q_idx[j]]
             update_dict_of_lists(full_results, **results_k)
-            full_results['i_cost'].append(i_costs[i])
+            if isinstance(i_costs, list):
+                # Without `scan`, costs are a list of the steps done.
+                full_results['i_cost'].append(i_costs[steps[j]])
+            else:
+                full_results['i_cost'].append(i_costs[c_idx[j]])
             update_dict_of_lists(samples, **samples_k)
 
         # Final results are from first and last steps
@@ -256,15 +381,19 @@ class IRVI(object):
                 results['d_' + k] = v[0] - v[-1]
             except:
                 print k, v[0], v[-1]
+        for k in ['n_steps', 'sample_steps']:
+            if k in inference_outs:
+                results[k] = inference_outs[k]
 
         return results, samples, full_results, updates
 
-    def __call__(self, x, y, **model_args):
+    def __call__(self, x, y, idx=None, **model_args):
         '''Call function for performing inference.
 
         Args:
             x (T.tensor): Input data sample for posterior, p(h|x)
             y (T.tensor): Output data sample for conditional, p(x|h)
+            idx (Optional[T.ivector]): Dataset positions for warm starts.
             model_args (dict): dictionary of arguments for model results.
 
         Returns:
@@ -275,9 +404,16 @@ class IRVI(object):
 
         '''
         model = self.model
-        inference_outs, constants, updates = self.inference(x, y)
+        if idx is None and self.cache is not None:
+            warnings.warn('%s has a warm-start cache, but no dataset positions '
+                          '(`idx`) were given: the cache is not used.'
+                          % self.name, RuntimeWarning)
+        inference_outs, constants, updates = self.inference(x, y, idx=idx)
         qk = inference_outs['qk']
         results, samples, constants_m, updates_m = model(x, y, qk=qk, **model_args)
+        for k in ['cache_hits', 'n_steps', 'sample_steps']:
+            if k in inference_outs:
+                results[k] = inference_outs[k]
         constants += constants_m
         updates += updates_m
         return results, samples, constants, updates
@@ -300,6 +436,8 @@ class DeepIRVI(object):
             approximate posterior.
         pass_gradients (bool): Pass gradients during inference.
         use_all_samples (bool): Use all the samples rather than just last.
+        caches (list or None): warm-start caches of refined posteriors, one
+            per layer.
 
     '''
 
@@ -312,6 +450,7 @@ class DeepIRVI(object):
                  pass_gradients=True,
                  sample_posterior=False,
                  init_inference='recognition_network',
+                 warm_start=None,
                  **kwargs):
         '''Initialization function for DeepIRVI.
 
@@ -324,6 +463,8 @@ class DeepIRVI(object):
                 approximate posterior.
             pass_gradients (bool): Pass gradients during inference.
             use_all_samples (bool): Use all the samples rather than just last.
+            warm_start (Optional[dict or list]): caches of refined posteriors
+                for each layer, or their arguments (see `PosteriorCache`).
 
         '''
 
@@ -335,6 +476,12 @@ class DeepIRVI(object):
         self.n_inference_samples = n_inference_samples
         self.pass_gradients = pass_gradients
         self.sample_posterior = sample_posterior
+        if isinstance(warm_start, dict):
+            warm_start = [
+                PosteriorCache(dim=model.posteriors[l].dim_out,
+                               name='%s_cache%d' % (name, l), **warm_start)
+                for l in xrange(model.n_layers)]
+        self.caches = warm_start
         warn_kwargs(self, **kwargs)
 
     def step_infer(self, *params):
@@ -399,13 +546,15 @@ class DeepIRVI(object):
 
         return q0s
 
-    def inference(self, x, y, q0s=None):
+    def inference(self, x, y, q0s=None, idx=None):
         '''Perform inference
 
         Args:
             x (T.tensor): Input data sample for posterior, p(h|x)
             y (T.tensor): Output data sample for conditional, p(x|h)
             q0s (Optional[list]): Initial posterior parameters.
+            idx (Optional[T.ivector]): Dataset positions of the samples, for
+                the warm-start caches.
 
         Returns:
             OrderedDict: Results from inference.
@@ -418,6 +567,13 @@ class DeepIRVI(object):
 
         if q0s is None:
             q0s = self.init_variational_inference(x)
+        if idx is not None and self.caches is not None:
+            print 'Warm-starting %s inference from cache' % self.name
+            q0s, hitss = zip(*[cache.lookup(idx, q0)
+                               for cache, q0 in zip(self.caches, q0s)])
+            q0s = list(q0s)
+        else:
+            hitss = None
 
         epsilons = []
 
@@ -469,6 +625,11 @@ class DeepIRVI(object):
             i_costs=i_costs
         )
 
+        if hitss is not None:
+            for cache, qs, hits in zip(self.caches, qss, hitss):
+                updates.update(cache.store(idx, qs[-1], hits))
+            rval['cache_hits'] = hitss[0].mean().astype(floatX)
+
         return rval, constants, updates
 
     def test(self, x, y, stride=10, **model_args):
@@ -523,12 +684,13 @@ class DeepIRVI(object):
 
         return results, samples, full_results, updates
 
-    def __call__(self, x, y, **model_args):
+    def __call__(self, x, y, idx=None, **model_args):
         '''Call function for performing inference.
 
         Args:
             x (T.tensor): Input data sample for posterior, p(h|x)
             y (T.tensor): Output data sample for conditional, p(x|h)
+            idx (Optional[T.ivector]): Dataset positions for warm starts.
             model_args (dict): dictionary of arguments for model results.
 
         Returns:
@@ -539,9 +701,15 @@ class DeepIRVI(object):
 
         '''
         model = self.model
-        inference_outs, constants, updates = self.inference(x, y)
+        if idx is None and self.caches is not None:
+            warnings.warn('%s has warm-start caches, but no dataset positions '
+                          '(`idx`) were given: the caches are not used.'
+                          % self.name, RuntimeWarning)
+        inference_outs, constants, updates = self.inference(x, y, idx=idx)
         qks = inference_outs['qks']
         results, samples, constants_m, updates_m = model(x, y, qks=qks, **model_args)
+        if 'cache_hits' in inference_outs:
+            results['cache_hits'] = inference_outs['cache_hits']
         constants += constants_m
         updates += updates_m
         return results, samples, constants, updates
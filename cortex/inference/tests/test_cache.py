@@ -0,0 +1,89 @@
+'''
+Tests for the warm-start cache of IRVI.
+'''
+
+import numpy as np
+import theano
+from theano import tensor as T
+import warnings
+
+from cortex.datasets.basic.euclidean import Euclidean
+from cortex.inference.cache import PosteriorCache
+from cortex.inference.gdir import MomentumGDIR
+from cortex.models.tests import test_vae
+from cortex.utils import floatX
+
+
+def make_inference(n, batch_size=9, **warm_start):
+    data_iter = Euclidean(batch_size=batch_size, dim_in=17)
+    gbn = test_vae.test_build_GBN(dim_in=data_iter.dims[data_iter.name])
+    gdir = MomentumGDIR(gbn, n_inference_steps=3, inference_rate=0.5,
+                        warm_start=dict(n=n, **warm_start))
+
+    X = T.matrix('x', dtype=floatX)
+    I = T.ivector('idx')
+    rval, _, updates = gdir.inference(X, X, idx=I)
+    f = theano.function([X, I], [rval['qs'][0], rval['qk'], rval['cache_hits']],
+                        updates=updates)
+    x = data_iter.next()[data_iter.name]
+    return gdir, f, x
+
+def test_warm_start(n=20, batch_size=9):
+    gdir, f, x = make_inference(n, batch_size=batch_size, max_age=2)
+    idx = np.arange(batch_size).astype('int32')
+
+    q0, qk, hits = f(x, idx)
+    assert hits == 0
+    q0_, qk_, hits_ = f(x, idx)
+    assert hits_ == 1
+    assert np.allclose(q0_, qk)
+    assert not np.allclose(qk_, qk)
+    _, _, hits_ = f(x, idx)
+    assert hits_ == 1
+
+    # Stale after 2 reuses.
+    q0_, _, hits_ = f(x, idx)
+    assert hits_ == 0
+    assert np.allclose(q0_, q0)
+
+    # Other samples miss.
+    _, _, hits_ = f(x, idx + batch_size)
+    assert hits_ == 0
+
+    gdir.cache.reset()
+    _, _, hits_ = f(x, idx)
+    assert hits_ == 0
+
+def test_memory_cap(n=100, dim=26, slots=10):
+    slot_bytes = dim * np.dtype(floatX).itemsize + 8
+    cache = PosteriorCache(n, dim, max_mbytes=slots * slot_bytes / 2. ** 20)
+    assert cache.capacity == slots
+    assert cache.q.get_value().shape == (slots, dim)
+
+    dim = test_vae.test_build_GBN().posterior.dim_out
+    slot_bytes = dim * np.dtype(floatX).itemsize + 8
+    gdir, f, x = make_inference(n, batch_size=4,
+                                max_mbytes=slots * slot_bytes / 2. ** 20)
+    assert gdir.cache.capacity == slots
+    f(x, np.array([0, 1, 2, 3], dtype='int32'))
+    # 10 and 11 take the slots of 0 and 1.
+    _, _, hits = f(x, np.array([10, 11, 2, 3], dtype='int32'))
+    assert hits == 0.5
+    _, _, hits = f(x, np.array([0, 1, 2, 3], dtype='int32'))
+    assert hits == 0.5
+
+def test_no_idx(n=20):
+    gdir, _, _ = make_inference(n)
+    X = T.matrix('x', dtype=floatX)
+    with warnings.catch_warnings(record=True) as w:
+        warnings.simplefilter('always')
+        results, _, _, _ = gdir(X, X)
+        assert 'cache_hits' not in results
+        assert any(issubclass(w_.category, RuntimeWarning)
+                   and 'idx' in str(w_.message) for w_ in w)
+
+    with warnings.catch_warnings(record=True) as w:
+        warnings.simplefilter('always')
+        results, _, _, _ = gdir(X, X, idx=T.ivector('idx'))
+        assert 'cache_hits' in results
+        assert not any('idx' in str(w_.message) for w_ in w)
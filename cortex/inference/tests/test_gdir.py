@@ -41,3 +41,96 @@ def test_infer():
     f = theano.function([X], results.values(), updates=updates)
 
     print f(x)
+
+def test_adaptive(n_inference_steps=7):
+    data_iter = Euclidean(batch_size=27, dim_in=17)
+    gbn = test_vae.test_build_GBN(dim_in=data_iter.dims[data_iter.name])
+    x = data_iter.next()[data_iter.name]
+    X = T.matrix('x', dtype=floatX)
+
+    def run(**inference_args):
+        gdir = test_build_gdir(gbn, n_inference_steps=n_inference_steps,
+                               **inference_args)
+        rval, constants, updates = gdir.inference(X, X)
+        f = theano.function(
+            [X], [rval['qs'], rval['n_steps'], rval['sample_steps']],
+            updates=updates)
+        return f(x)
+
+    # The first step always improves on the infinite initial cost.
+    _, n_steps, sample_steps = run(tolerance=1e6)
+    assert n_steps == 2 and sample_steps == 2
+
+    # All samples stop after the first step.
+    qs, n_steps, sample_steps = run(sample_tolerance=1e6)
+    assert n_steps == 1 and sample_steps == 1
+    assert qs.shape[0] == 2
+
+    qs, n_steps, sample_steps = run(sample_tolerance=0.)
+    assert n_steps == n_inference_steps
+    assert qs.shape[0] == n_inference_steps + 1
+
+    # Summaries stop at the last step done.
+    gdir = test_build_gdir(gbn, n_inference_steps=n_inference_steps,
+                           tolerance=1e6)
+    results, samples, full_results, updates = gdir.test(X, X, stride=2)
+    f = theano.function([X], [results['n_steps'], results['i_cost']],
+                        updates=updates)
+    n_steps, i_cost = f(x)
+    assert n_steps == 2 and np.isfinite(i_cost)
+
+def test_summary_steps(n_inference_steps=7):
+    data_iter = Euclidean(batch_size=27, dim_in=17)
+    gbn = test_vae.test_build_GBN(dim_in=data_iter.dims[data_iter.name])
+    x = data_iter.next()[data_iter.name]
+    X = T.matrix('x', dtype=floatX)
+    gdir = test_build_gdir(gbn, n_inference_steps=n_inference_steps)
+
+    # Stacked posteriors give the results of separate evaluations.
+    Q = T.tensor3('q', dtype=floatX)
+    results, samples, _, _ = gbn(X, X, Q)
+    keys = [k for k in ['KL(q_k||p)', 'KL(q_k||q_0)', 'H(q)'] if k in results]
+    f = theano.function([X, Q], [results[k] for k in keys] + [samples['py']])
+    Q_ = T.matrix('q_', dtype=floatX)
+    results_, samples_, _, _ = gbn(X, X, Q_)
+    f_ = theano.function([X, Q_], [results_[k] for k in keys],
+                         on_unused_input='ignore')
+
+    q = np.random.uniform(size=(3, x.shape[0], gbn.posterior.dim_out)).astype(
+        floatX)
+    outs = f(x, q)
+    assert len(keys) > 0
+    assert outs[-1].shape[:3] == (10, 3, x.shape[0])
+    for j in xrange(3):
+        for o, o_ in zip(outs[:-1], f_(x, q[j])):
+            assert np.allclose(o[j], o_, atol=1e-5)
+
+    # The model is evaluated once, whatever the stride.
+    def n_dots(stride):
+        _, _, full_results, _ = gdir.test(X, X, stride=stride)
+        nodes = theano.gof.graph.io_toposort(
+            [X], [v for vs in full_results.values() for v in vs])
+        return sum(isinstance(n.op, T.basic.Dot) for n in nodes)
+
+    assert n_dots(1) == n_dots(n_inference_steps)
+
+    results, samples, full_results, updates = gdir.test(X, X, stride=2)
+    f = theano.function([X], [results['lower_bound'], samples['py'][0]],
+                        updates=updates)
+    lower_bound, py = f(x)
+    assert np.isfinite(lower_bound) and lower_bound.ndim == 0
+    assert py.shape[1] == x.shape[0]
+    assert len(full_results['i_cost']) == 5
+
+def test_single_step():
+    data_iter = Euclidean(batch_size=27, dim_in=17)
+    gbn = test_vae.test_build_GBN(dim_in=data_iter.dims[data_iter.name])
+    x = data_iter.next()[data_iter.name]
+    X = T.matrix('x', dtype=floatX)
+
+    gdir = test_build_gdir(gbn, n_inference_steps=1)
+    results, samples, full_results, updates = gdir.test(X, X)
+    f = theano.function([X], [results['i_cost'], results['lower_bound']],
+                        updates=updates)
+    i_cost, lower_bound = f(x)
+    assert np.isfinite(i_cost) and np.isfinite(lower_bound)
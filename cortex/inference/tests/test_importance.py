@@ -0,0 +1,48 @@
+'''
+Tests for chunked importance sampling.
+'''
+
+import numpy as np
+import theano
+from theano import tensor as T
+
+from cortex.datasets.basic.euclidean import Euclidean
+from cortex.inference.importance import ImportanceSampler, LogSumExp
+from cortex.models.tests import test_vae
+from cortex.utils import floatX
+
+
+def test_log_sum_exp(chunk_size=3):
+    x = np.random.RandomState(0).normal(scale=10., size=(20, 4))
+    lse = LogSumExp()
+    for start in xrange(0, x.shape[0], chunk_size):
+        lse.update(x[start:start + chunk_size])
+    x_max = x.max(0)
+    assert lse.n == x.shape[0]
+    assert np.allclose(lse.value, np.log(np.exp(x - x_max).sum(0)) + x_max)
+
+def test_importance_sampler(n_posterior_samples=400):
+    data_iter = Euclidean(batch_size=11, dim_in=17)
+    gbn = test_vae.test_build_GBN(dim_in=data_iter.dims[data_iter.name])
+    x = data_iter.next()[data_iter.name]
+
+    X = T.matrix('x', dtype=floatX)
+    results, _, _, updates = gbn(X, X, n_posterior_samples=n_posterior_samples)
+    f = theano.function([X], [results['-log p(x)'], results['log ESS']],
+                        updates=updates)
+    nll, log_ess = f(x)
+
+    for chunk_size in [7, n_posterior_samples]:
+        sampler = ImportanceSampler(gbn, chunk_size=chunk_size)
+        rval = sampler(x, n_posterior_samples=n_posterior_samples)
+        assert rval.keys() == ['-log p(x)', 'log ESS', 'samples/sec']
+        assert np.allclose(rval['-log p(x)'], nll, rtol=1e-2), (
+            chunk_size, rval['-log p(x)'], nll)
+        assert np.allclose(rval['log ESS'], log_ess, rtol=1e-2), (
+            chunk_size, rval['log ESS'], log_ess)
+        assert rval['log ESS'] <= np.log(n_posterior_samples) + 1e-5
+        assert rval['samples/sec'] > 0
+
+        chunks = list(sampler.log_weights(x, n_posterior_samples=15))
+        assert sum(c.shape[0] for c in chunks) == 15
+        assert all(c.shape[1] == x.shape[0] for c in chunks)
@@ -308,6 +308,27 @@ class Helmholtz(Layer):
         '''Initializes the samples for inference.'''
         return self.posterior.distribution.prototype_samples(size)
 
+    def log_importance_weights(self, y, q, n_posterior_samples=10):
+        '''Log importance weights of samples from the approximate posterior.
+
+        Args:
+            y: T.tensor, output from conditional.
+            q: T.tensor, approximate posterior parameters used as proposal.
+            n_posterior_samples: int or T.scalar, number of samples.
+        Returns:
+            T.tensor: :math:`\log p(y | h) + \log p(h) - \log q(h)`, with
+                shape (n_posterior_samples, batch).
+        '''
+        r = self.init_inference_samples(
+            (n_posterior_samples, y.shape[0], self.dim_h))
+        h = self.posterior.distribution.step_sample(r, q[None, :, :])
+        py_h = self.conditional.feed(h)
+
+        log_py_h = -self.conditional.neg_log_prob(y[None, :, :], py_h)
+        log_ph = -self.prior.neg_log_prob(h)
+        log_qh = -self.posterior.neg_log_prob(h, q[None, :, :])
+        return log_py_h + log_ph - log_qh
+
     def __call__(self, x, y, qk=None, n_posterior_samples=10,
                  pass_gradients=False, reweight=False, reweight_gen_only=False,
                  sleep_phase=False):
@@ -321,7 +342,10 @@ class Helmholtz(Layer):
             x: T.tensor, input to recogntion network.
             y: T.tensor, output from conditional.
             qk: T.tensor (optional), approximate posterior parameters.
-                If None, calculate from recognition network.
+                If None, calculate from recognition network. Parameters
+                stacked along a leading axis (e.g., from several inference
+                steps) are evaluated in a single pass: results then have a
+                leading axis for the stack, and samples a second one.
             n_posterior_samples: int, number of samples to use for lower bound
                 and log marginal estimates.
             pass_gradients: bool, for priors with continuous distributions,
@@ -342,6 +366,38 @@ class Helmholtz(Layer):
         elif not pass_gradients:
             constants.append(qk)
 
+        n_stack = None
+        if qk.ndim == 3:
+            if sleep_phase:
+                raise NotImplementedError('Sleep phase with stacked posteriors')
+            # Stacked rows are evaluated as one larger batch.
+            n_stack = qk.shape[0]
+            x = T.tile(x, (n_stack, 1), ndim=2)
+            y = T.tile(y, (n_stack, 1), ndim=2)
+            q0 = T.tile(q0, (n_stack, 1), ndim=2)
+            qk = qk.reshape((qk.shape[0] * qk.shape[1], qk.shape[2]))
+
+        def split(v, axis=None):
+            '''Splits the batch axis (default last) by stack.'''
+            if n_stack is None:
+                return v
+            if axis is None:
+                axis = v.ndim - 1
+            shape = ([v.shape[a] for a in xrange(axis)] + [n_stack, -1]
+                     + [v.shape[a] for a in xrange(axis + 1, v.ndim)])
+            return v.reshape(shape, ndim=v.ndim + 1)
+
+        def mean(v):
+            '''Mean over samples, for each stacked posterior.'''
+            if n_stack is None:
+                return v.mean()
+            v = split(v)
+            return v.mean(axis=[a for a in xrange(v.ndim) if a != v.ndim - 2])
+
+        def sum_rows(v):
+            '''Sum over the batch, for each stacked posterior.'''
+            return split(v).sum(axis=v.ndim - 1 + int(n_stack is not None))
+
         r = self.init_inference_samples(
             (n_posterior_samples, y.shape[0], self.dim_h))
         h = self.posterior.distribution.step_sample(r, qk[None, :, :])
@@ -363,11 +419,11 @@ class Helmholtz(Layer):
         # Some prior distributions have a tractable KL divergence.
         if self.prior.has_kl and not reweight and not reweight_gen_only:
             KL_qk_p = self.prior.kl_divergence(qk)
-            results['KL(q_k||p)'] = KL_qk_p
+            results['KL(q_k||p)'] = split(KL_qk_p)
             KL_term = KL_qk_p
         else:
             prior_energy = -log_ph
-            results['-log p(h)'] = prior_energy.mean()
+            results['-log p(h)'] = mean(prior_energy)
             KL_term = prior_energy - q_entropy
 
         # If we pass the gradients we don't want to include the KL(q_k||q_0)
@@ -375,18 +431,18 @@ class Helmholtz(Layer):
             if self.posterior.distribution.has_kl and not reweight and not reweight_gen_only:
                 KL_qk_q0 = self.posterior.distribution.step_kl_divergence(
                     qk, *self.posterior.distribution.split_prob(q0))
-                results['KL(q_k||q_0)'] = KL_qk_q0
+                results['KL(q_k||q_0)'] = split(KL_qk_q0)
                 posterior_term = KL_qk_q0
             else:
-                results['-log q(h)'] = -log_qh0.mean()
+                results['-log q(h)'] = mean(-log_qh0)
                 posterior_term = -log_qh0
         else:
             posterior_term = T.zeros_like(log_qh0)
 
-        lower_bound = -(recon_term + KL_term).mean()
+        lower_bound = -mean(recon_term + KL_term)
 
         w_tilde = get_w_tilde(log_py_h + log_ph - log_qhk)
-        results['log ESS'] = T.log(1. / (w_tilde ** 2).sum(0)).mean()
+        results['log ESS'] = mean(T.log(1. / (w_tilde ** 2).sum(0)))
         if sleep_phase:
             r = self.init_inference_samples(
                 (n_posterior_samples, y.shape[0], self.dim_h))
@@ -401,28 +457,28 @@ class Helmholtz(Layer):
                     + log_qh0.sum(1).mean(0))
             constants.append(w_tilde)
         elif reweight:
-            cost = -(w_tilde * (log_py_h + log_ph + log_qh0)).sum((0, 1))
+            cost = -sum_rows(w_tilde * (log_py_h + log_ph + log_qh0)).sum(0)
             constants.append(w_tilde)
         elif reweight_gen_only:
-            cost = -((w_tilde * (log_py_h + log_ph)).sum((0, 1))
-                    + log_qh0.sum(1).mean(0))
+            cost = -(sum_rows(w_tilde * (log_py_h + log_ph)).sum(0)
+                     + sum_rows(log_qh0).mean(0))
             constants.append(w_tilde)
         else:
-            cost = (recon_term + KL_term + posterior_term).sum(1).mean(0)
+            cost = sum_rows(recon_term + KL_term + posterior_term).mean(0)
 
         results.update(**{
-            '-log p(x|h)': recon_term.mean(),
-            '-log p(x)': -log_p.mean(0),
+            '-log p(x|h)': mean(recon_term),
+            '-log p(x)': mean(-log_p),
             'H(p)': prior_entropy,
-            'H(q)': q_entropy.mean(0),
+            'H(q)': mean(q_entropy),
             'lower_bound': lower_bound,
             'cost': cost
         })
 
         samples = OrderedDict(
-            py=py_h,
-            batch_energies=recon_term,
-            w_tilde=w_tilde
+            py=split(py_h, axis=1),
+            batch_energies=split(recon_term),
+            w_tilde=split(w_tilde)
         )
 
         return results, samples, constants, theano.OrderedUpdates()
@@ -396,8 +396,8 @@ class RBM(Layer):
         if not (isinstance(self.v_dist, Binomial) and isinstance(self.h_dist, Binomial)):
             raise NotImplementedError('Only binomial / binomial RBM supported for AIS.')
 
-        log_za, d_logz, var_dlogz, log_ws, samples = self.ais(K, M)
-        updates = theano.OrderedUpdates([
+        log_za, d_logz, var_dlogz, log_ws, samples, updates = self.ais(K, M)
+        updates.update([
             (self.log_Z, log_za + d_logz),
             (self.std_log_Z, T.sqrt(var_dlogz))])
         results = OrderedDict(
@@ -408,28 +408,70 @@ class RBM(Layer):
         )
         return results, updates
 
-    def ais(self, K, M):
-        '''Performs AIS to estimate the log of the partition function, Z.
+    def ais_params(self):
+        '''Parameters of the base RBM a and of this RBM for AIS.
 
-        Note:
-            Only works for Binomial / Binomial.
+        The base RBM has no weights and visible biases from the mean image.
 
-        Args:
-            K (int): Number of annealing steps.
-            M (int): Number of annealing runs.
+        Returns:
+            list: parameters of RBM a followed by those of this RBM.
+
+        '''
+        W_a = T.zeros_like(self.W).astype(floatX)
+        b_a = -T.log(1. / self.mean_image - 1.)
+        c_a = T.zeros_like(self.h_dist.z).astype(floatX)
+        return [W_a, b_a, c_a] + self.get_params()
+
+    def ais_log_za(self):
+        '''Log partition function of the base RBM.
 
         Returns:
             T.tensor: :math:`log Z_a`.
-            T.tensor: :math:`d \log Z`.
-            T.tensor: variance of :math:`d \log Z`.
-            T.tensor: log weights.
+
+        '''
+        b_a = self.ais_params()[1]
+        return self.h_dist.dim * T.log(2.).astype(floatX) + T.log(1. + T.exp(b_a)).sum()
+
+    def ais_init(self, M):
+        '''Initial AIS samples from the base RBM.
+
+        Args:
+            M (int or T.tensor): number of AIS runs.
+
+        Returns:
             T.tensor: samples.
+            T.tensor: log weights.
 
         '''
+        b_a = self.ais_params()[1]
+        p0 = T.tile(1. / (1. + T.exp(-b_a)), (M, 1))
+        r = self.trng.uniform(size=(M, self.v_dist.dim), dtype=floatX)
+        x0 = (r <= p0).astype(floatX)
+        log_w0 = T.zeros((M,)).astype(floatX)
+        return x0, log_w0
 
-        if not (isinstance(self.v_dist, Binomial) and isinstance(self.h_dist, Binomial)):
-            raise NotImplementedError('Only binomial / binomial RBM supported for AIS.')
+    def ais_anneal(self, x0, log_w0, k0, n_steps, K):
+        '''Runs AIS steps k0 + 1 to k0 + n_steps of a K step schedule.
+
+        Random numbers are drawn at each step, so memory does not grow with
+        the number of steps.
+
+        Note:
+            Only works for Binomial / Binomial.
+
+        Args:
+            x0 (T.tensor): samples at step k0.
+            log_w0 (T.tensor): log weights at step k0.
+            k0 (int or T.tensor): number of steps already done.
+            n_steps (int or T.tensor): number of steps to do.
+            K (int): total number of annealing steps.
+
+        Returns:
+            T.tensor: log weights at each step.
+            T.tensor: samples at each step.
+            theano.OrderedUpdates: updates for the random streams.
 
+        '''
         def free_energy(x, beta, *params):
             '''Calculates the free energy from the annealed distribution.
 
@@ -447,48 +489,182 @@ class RBM(Layer):
             return fe_a + fe_b
 
         def get_beta(k):
-            return (k / float(K)).astype(floatX)
+            return (T.cast(k, 'float64') / K).astype(floatX)
+
+        def step_anneal(k, log_w, x, *params):
+            r_h_a = self.trng.uniform(size=(x.shape[0], self.h_dist.dim), dtype=floatX)
+            r_h_b = self.trng.uniform(size=(x.shape[0], self.h_dist.dim), dtype=floatX)
+            r_v = self.trng.uniform(size=(x.shape[0], self.v_dist.dim), dtype=floatX)
 
-        def step_anneal(r_h_a, r_h_b, r_v, k, log_w, x, *params):
             beta_ = get_beta(k - 1)
             beta  = get_beta(k)
             log_w = log_w + free_energy(x, beta_, *params) - free_energy(x, beta, *params)
             x = self.step_gibbs_ais(r_h_a, r_h_b, r_v, x, beta, *params)
             return log_w, x
 
-        # Random numbers for scan
-        r_vs   = self.trng.uniform(size=(K, M, self.v_dist.dim), dtype=floatX)
-        r_hs_a = self.trng.uniform(size=(K, M, self.h_dist.dim), dtype=floatX)
-        r_hs_b = self.trng.uniform(size=(K, M, self.h_dist.dim), dtype=floatX)
-
-        # Parameters for RBM a and b
-        W_a = T.zeros_like(self.W).astype(floatX)
-        b_a = -T.log(1. / self.mean_image - 1.)
-        c_a = T.zeros_like(self.h_dist.z).astype(floatX)
-        params = [W_a, b_a, c_a] + self.get_params()
-
-        # x0 and log_w0
-        p0     = T.tile(1. / (1. + T.exp(-b_a)), (M, 1))
-        r      = self.trng.uniform(size=(M, self.v_dist.dim), dtype=floatX)
-        x0     = (r <= p0).astype(floatX)
-        log_w0 = T.zeros((M,)).astype(floatX)
-
-        seqs         = [r_hs_a, r_hs_b, r_vs, T.arange(1, K + 1)]
+        seqs         = [T.arange(k0 + 1, k0 + n_steps + 1)]
         outputs_info = [log_w0, x0]
-        non_seqs     = params
+        non_seqs     = self.ais_params()
 
         (log_ws, xs), updates = scan(
-            step_anneal, seqs, outputs_info, non_seqs, K,
+            step_anneal, seqs, outputs_info, non_seqs, n_steps,
             name=self.name + '_ais', strict=False)
 
+        return log_ws, xs, updates
+
+    def ais(self, K, M):
+        '''Performs AIS to estimate the log of the partition function, Z.
+
+        Note:
+            Only works for Binomial / Binomial.
+
+        Args:
+            K (int): Number of annealing steps.
+            M (int): Number of annealing runs.
+
+        Returns:
+            T.tensor: :math:`log Z_a`.
+            T.tensor: :math:`d \log Z`.
+            T.tensor: variance of :math:`d \log Z`.
+            T.tensor: log weights.
+            T.tensor: samples.
+            theano.OrderedUpdates: updates for the random streams.
+
+        '''
+
+        if not (isinstance(self.v_dist, Binomial) and isinstance(self.h_dist, Binomial)):
+            raise NotImplementedError('Only binomial / binomial RBM supported for AIS.')
+
+        x0, log_w0 = self.ais_init(M)
+        log_ws, xs, updates = self.ais_anneal(x0, log_w0, 0, K, K)
+
         log_w  = log_ws[-1]
         d_logz = T.log(T.sum(T.exp(log_w - log_w.max()))) + log_w.max() - T.log(M)
-        log_za = self.h_dist.dim * T.log(2.).astype(floatX) + T.log(1. + T.exp(b_a)).sum()
+        log_za = self.ais_log_za()
 
         var_dlogz = (M * T.exp(2. * (log_w - log_w.max())).sum() /
                      T.exp(log_w - log_w.max()).sum() ** 2 - 1.)
 
-        return log_za, d_logz, var_dlogz, log_ws, xs[-1]
+        return log_za, d_logz, var_dlogz, log_ws, xs[-1], updates
+
+    def run_ais(self, K=10000, M=100, chunk_size=1000, batch_size=None,
+                tol=None, state=None, verbose=True):
+        '''Runs AIS in chunks and updates the partition function.
+
+        Chains are run `batch_size` at a time and each batch does the K steps
+        in compiled chunks of `chunk_size` steps, so memory is bounded by
+        `batch_size` chains and does not depend on K or M. The running
+        estimate of :math:`log Z` and its variance are reported after each
+        chunk.
+
+        The progress is kept in `state`. If the run is interrupted, passing
+        the same `state` again resumes it.
+
+        Note:
+            Only works for Binomial / Binomial.
+
+        Args:
+            K (int): number of AIS steps.
+            M (int): number of AIS runs.
+            chunk_size (int): number of steps per compiled call.
+            batch_size (Optional[int]): number of runs at a time. Defaults
+                to M.
+            tol (Optional[float]): stop once the standard error of
+                :math:`log Z` is below this and at least one batch is done.
+            state (Optional[dict]): state from an interrupted run.
+            verbose (bool): print progress.
+
+        Returns:
+            OrderedDict: results from AIS.
+
+        '''
+        if not (isinstance(self.v_dist, Binomial) and isinstance(self.h_dist, Binomial)):
+            raise NotImplementedError('Only binomial / binomial RBM supported for AIS.')
+
+        if batch_size is None:
+            batch_size = M
+        chunk_size = min(chunk_size, K)
+
+        if not hasattr(self, '_f_ais'):
+            M_ = T.iscalar('M')
+            x0, log_w0 = self.ais_init(M_)
+            f_init = theano.function([M_], [x0, log_w0])
+
+            X = T.matrix('x', dtype=floatX)
+            log_w = T.vector('log_w', dtype=floatX)
+            k = T.iscalar('k')
+            n_steps = T.iscalar('n_steps')
+            K_ = T.iscalar('K')
+            log_ws, xs, updates = self.ais_anneal(X, log_w, k, n_steps, K_)
+            f_anneal = theano.function([X, log_w, k, n_steps, K_],
+                                       [log_ws[-1], xs[-1]], updates=updates)
+            f_log_za = theano.function([], self.ais_log_za())
+            self._f_ais = (f_init, f_anneal, f_log_za)
+        f_init, f_anneal, f_log_za = self._f_ais
+
+        if state is None:
+            state = dict()
+        state.setdefault('log_ws', [])
+        state.setdefault('x', None)
+        log_za = float(f_log_za())
+
+        def summarize(log_w):
+            log_w = log_w.astype('float64')
+            m = log_w.shape[0]
+            w = np.exp(log_w - log_w.max())
+            d_logz = np.log(w.mean()) + log_w.max()
+            var_dlogz = m * (w ** 2).sum() / w.sum() ** 2 - 1.
+            return d_logz, var_dlogz, np.sqrt(var_dlogz / m)
+
+        n_done = sum(log_w.shape[0] for log_w in state['log_ws'])
+        while n_done < M:
+            if tol is not None and n_done > 0:
+                _, _, std_err = summarize(np.concatenate(state['log_ws']))
+                if std_err < tol:
+                    break
+
+            if state['x'] is None:
+                m = min(batch_size, M - n_done)
+                state['x'], state['log_w'] = f_init(m)
+                state['k'] = 0
+
+            while state['k'] < K:
+                n_steps = min(chunk_size, K - state['k'])
+                state['log_w'], state['x'] = f_anneal(
+                    state['x'], state['log_w'], state['k'], n_steps, K)
+                state['k'] += n_steps
+                if verbose:
+                    # At step k, this estimates log Z of the annealed RBM.
+                    d_logz, var_dlogz, std_err = summarize(state['log_w'])
+                    print ('AIS runs %d-%d of %d, step %d of %d: log Z_k = %.4f'
+                           ' (var %.4f, std err %.4f)'
+                           % (n_done, n_done + state['x'].shape[0], M,
+                              state['k'], K, log_za + d_logz, var_dlogz,
+                              std_err))
+
+            state['log_ws'].append(state['log_w'])
+            n_done += state['x'].shape[0]
+            state['x'] = None
+
+            d_logz, var_dlogz, std_err = summarize(
+                np.concatenate(state['log_ws']))
+            if verbose:
+                print ('AIS %d runs: log Z = %.4f (var %.4f, std err %.4f)'
+                       % (n_done, log_za + d_logz, var_dlogz, std_err))
+
+        log_ws = np.concatenate(state['log_ws'])
+        d_logz, var_dlogz, std_err = summarize(log_ws)
+        self.log_Z.set_value(np.array(log_za + d_logz).astype(floatX))
+        self.std_log_Z.set_value(np.array(np.sqrt(var_dlogz)).astype(floatX))
+
+        results = OrderedDict(
+            log_za=log_za,
+            d_logz=d_logz,
+            var_dlogz=var_dlogz,
+            std_err=std_err,
+            log_ws=log_ws
+        )
+        return results
 
     def step_free_energy(self, x, beta, *params):
         '''Step free energy function.
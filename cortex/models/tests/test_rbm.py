@@ -2,6 +2,8 @@
 Module for RBM tests.
 '''
 
+import itertools
+import numpy as np
 import theano
 from theano import tensor as T
 
@@ -36,3 +38,28 @@ def test_sample(n_steps=3, dim_v=13, batch_size=7):
     results, samples, updates, constants = outs
     f = theano.function([X], results.values(), updates=updates)
     f(x)
+
+def test_ais(dim_h=5, dim_v=8, K=300, M=60):
+    model = test_build(dim_h=dim_h, dim_v=dim_v)
+    W = np.random.normal(size=(dim_v, dim_h)).astype(floatX)
+    model.W.set_value(W)
+
+    # Exact log Z by enumerating visible states.
+    b = model.v_dist.get_params()[0].get_value()
+    c = model.h_dist.get_params()[0].get_value()
+    v = np.array(list(itertools.product([0, 1], repeat=dim_v)))
+    log_p = v.dot(b) + np.log(1. + np.exp(v.dot(W) + c)).sum(axis=1)
+    log_Z = np.log(np.exp(log_p - log_p.max()).sum()) + log_p.max()
+
+    state = dict()
+    results = model.run_ais(K=K, M=M, chunk_size=100, batch_size=25,
+                            state=state, verbose=False)
+    assert results['log_ws'].shape == (M,)
+    assert len(state['log_ws']) == 3
+    assert abs(results['log_za'] + results['d_logz'] - log_Z) < 0.2
+    assert np.allclose(model.log_Z.get_value(),
+                       results['log_za'] + results['d_logz'])
+
+    # A finished run is not redone.
+    results_ = model.run_ais(K=K, M=M, state=state, verbose=False)
+    assert np.allclose(results_['log_ws'], results['log_ws'])
@@ -0,0 +1,9 @@
+'''
+NumPy runtime for trained models.
+
+Loads the parameters saved by the demos and evaluates the models with NumPy
+only, e.g., for scoring on machines without Theano. See
+`cortex.runtime.helmholtz`.
+'''
+
+from .helmholtz import Helmholtz, load_params, log_ess, log_sum_exp
@@ -0,0 +1,355 @@
+'''
+Module for NumPy probabilistic distributions.
+
+Mirrors `cortex.models.distributions`: probabilities, samples and densities
+are computed as in the Theano classes, so that models trained with Theano can
+be evaluated without it. Priors own their parameters, while conditional
+distributions (`params=None`) get their probabilities from an MLP.
+'''
+
+from collections import OrderedDict
+from functools import wraps
+import numpy as np
+
+
+_clip = 1e-7 # clipping for multinomial distributions.
+
+def ignore_underflow(f):
+    '''Lets small probabilities underflow to 0.
+
+    Underflow is expected in densities and weights, but raises under
+    `np.seterr(all='raise')` (set by some dataset modules).
+
+    '''
+    @wraps(f)
+    def wrapped(*args, **kwargs):
+        with np.errstate(under='ignore'):
+            return f(*args, **kwargs)
+    return wrapped
+
+def resolve(c):
+    '''Resolves Distribution subclass from str.
+
+    Args:
+        c (str): distribution string.
+
+    Returns:
+        Distribution.
+
+    '''
+    resolve_dict = dict(
+        binomial=Binomial,
+        continuous_binomial=ContinuousBinomial,
+        centered_binomial=CenteredBinomial,
+        multinomial=Multinomial,
+        gaussian=Gaussian,
+        logistic=Logistic,
+        laplace=Laplace
+    )
+
+    C = resolve_dict.get(c, None)
+    if C is None:
+        raise ValueError('Distribution %r not supported' % c)
+    return C
+
+def get_rng(rng=None):
+    '''Returns a random state.
+
+    Args:
+        rng (Optional[int or numpy.random.RandomState]): seed or random state.
+            If None, the global numpy random state is used.
+
+    Returns:
+        numpy.random.RandomState.
+
+    '''
+    if rng is None:
+        return np.random.mtrand._rand
+    if isinstance(rng, np.random.RandomState):
+        return rng
+    return np.random.RandomState(rng)
+
+@ignore_underflow
+def sigmoid(x):
+    '''Sigmoid that does not overflow.
+
+    '''
+    return np.exp(-np.logaddexp(0, -x)).astype(x.dtype)
+
+def softplus(x):
+    return np.logaddexp(0, x).astype(x.dtype)
+
+@ignore_underflow
+def softmax(x):
+    e_x = np.exp(x - x.max(axis=-1, keepdims=True))
+    return e_x / e_x.sum(axis=-1, keepdims=True)
+
+
+class Distribution(object):
+    '''Distribution parent class.
+
+    Not meant to be used alone, use subclass.
+
+    Attributes:
+        dim (int): dimension of distribution.
+        dtype (numpy.dtype): dtype of samples.
+        scale (int): scaling for distributions whose probs are higher order,
+            such as Gaussian, which has mu and sigma.
+        params (OrderedDict or None): parameters of the prior, None for
+            conditional distributions.
+        param_keys (list): names of the parameters, as in the Theano class.
+
+    '''
+    is_continuous = False
+    scale = 1
+    param_keys = []
+
+    def __init__(self, dim, params=None, dtype='float32'):
+        '''Init function for Distribution class.
+
+        Args:
+            dim (int): dimension of distribution.
+            params (Optional[dict]): parameters. Missing ones take their
+                initial value (zeros).
+            dtype (str): dtype of samples and missing parameters.
+
+        '''
+        self.dim = dim
+        self.dtype = np.dtype(dtype)
+        if params is None:
+            self.params = None
+        else:
+            self.params = OrderedDict()
+            for k in self.param_keys:
+                v = params.get(k, None)
+                if v is None:
+                    v = np.zeros((dim,), dtype=dtype)
+                if v.shape != (dim,):
+                    raise ValueError('Sizes do not match for %s: %s vs %s'
+                                     % (k, v.shape, (dim,)))
+                self.params[k] = v
+
+    def get_prob(self, *params):
+        '''Returns single array from params.
+
+        '''
+        if len(params) == 0:
+            if self.params is None:
+                raise ValueError('Conditional distributions need p.')
+            params = self.params.values()
+        return np.concatenate(params, axis=-1)
+
+    def __call__(self, z):
+        return z
+
+    def get_center(self, p):
+        return p
+
+    def split_prob(self, p):
+        return p
+
+    def prototype_samples(self, size, rng=None):
+        return get_rng(rng).uniform(size=size).astype(self.dtype)
+
+    def step_sample(self, epsilon, p):
+        raise NotImplementedError()
+
+    @ignore_underflow
+    def sample(self, n_samples, p=None, rng=None, epsilon=None):
+        '''Samples from distribution.
+
+        Args:
+            n_samples (int): number of samples.
+            p (Optional[numpy.array]): probability.
+            rng (Optional[int or numpy.random.RandomState]).
+            epsilon (Optional[numpy.array]): prototype samples, see
+                `prototype_samples`. Drawn if not provided.
+
+        Returns:
+            numpy.array: samples, with a leading axis of `n_samples`.
+
+        '''
+        if p is None:
+            p = self.get_prob()
+        if epsilon is None:
+            size = (n_samples,) + p.shape[:-1] + (p.shape[-1] // self.scale,)
+            epsilon = self.prototype_samples(size, rng=rng)
+        return self.step_sample(epsilon, p)
+
+    @ignore_underflow
+    def neg_log_prob(self, x, p=None, sum_probs=True):
+        '''Negative log probability.
+
+        Args:
+            x (numpy.array): input.
+            p (Optional[numpy.array]): probability.
+            sum_probs (bool): whether to sum the last axis.
+
+        Returns:
+            numpy.array: :math:`-\log p(x)`.
+
+        '''
+        if p is None:
+            p = self.get_prob()
+        energy = self.f_neg_log_prob(x, p)
+        if sum_probs:
+            return energy.sum(axis=-1)
+        return energy
+
+
+class Binomial(Distribution):
+    '''Binomial distribution.
+
+    '''
+    param_keys = ['z']
+
+    def get_prob(self, *params):
+        if len(params) == 0:
+            params = [self.params['z']]
+        return self(params[0])
+
+    def __call__(self, z):
+        return sigmoid(z) * 0.9999 + 0.000005
+
+    def step_sample(self, epsilon, p):
+        return (epsilon <= p).astype(p.dtype)
+
+    def f_neg_log_prob(self, x, p):
+        return -x * np.log(p) - (1 - x) * np.log(1 - p)
+
+
+class CenteredBinomial(Binomial):
+    '''Centered binomial.
+
+    '''
+    def __call__(self, z):
+        return sigmoid(2.0 * z) * 0.9999 + 0.000005
+
+    def step_sample(self, epsilon, p):
+        return 2.0 * (epsilon <= p).astype(p.dtype) - 1.0
+
+    def f_neg_log_prob(self, x, p):
+        return super(CenteredBinomial, self).f_neg_log_prob(0.5 * (x + 1.0), p)
+
+
+class ContinuousBinomial(Binomial):
+    '''Continuous binomial.
+
+    Note:
+        Doesn't sample.
+
+    '''
+    def sample(self, n_samples, p=None, rng=None, epsilon=None):
+        if p is None:
+            p = self.get_prob()
+        return p[None]
+
+
+class Multinomial(Distribution):
+    '''Multinomial distribuion.
+
+    '''
+    param_keys = ['z']
+
+    def get_prob(self, *params):
+        if len(params) == 0:
+            params = [self.params['z']]
+        return self(params[0])
+
+    def __call__(self, z):
+        return softmax(z)
+
+    def sample(self, n_samples, p=None, rng=None, epsilon=None):
+        if p is None:
+            p = self.get_prob()
+        if epsilon is None:
+            size = (n_samples,) + p.shape[:-1] + (1,)
+            epsilon = self.prototype_samples(size, rng=rng)
+        return self.step_sample(epsilon, p)
+
+    def step_sample(self, epsilon, p):
+        '''One-hot samples from uniform `epsilon` with a last axis of 1.
+
+        '''
+        idx = (np.cumsum(p, axis=-1) < epsilon).sum(axis=-1)
+        idx = np.minimum(idx, p.shape[-1] - 1)
+        return (np.arange(p.shape[-1]) == idx[..., None]).astype(p.dtype)
+
+    def f_neg_log_prob(self, x, p):
+        p = np.clip(p, _clip, 1.0 - _clip)
+        return -x * np.log(p) - (1 - x) * np.log(1 - p)
+
+
+class _Location(Distribution):
+    '''Distributions with a location and a log scale.
+
+    '''
+    is_continuous = True
+    scale = 2
+
+    def get_center(self, p):
+        return p[..., :p.shape[-1] // self.scale]
+
+    def split_prob(self, p):
+        dim = p.shape[-1] // self.scale
+        return p[..., :dim], p[..., dim:]
+
+
+class Gaussian(_Location):
+    '''Gaussian distribution.
+
+    '''
+    param_keys = ['mu', 'log_sigma']
+
+    def __init__(self, dim, params=None, clip=-10, **kwargs):
+        self.clip = clip
+        super(Gaussian, self).__init__(dim, params=params, **kwargs)
+
+    def prototype_samples(self, size, rng=None):
+        return get_rng(rng).normal(size=size).astype(self.dtype)
+
+    def step_sample(self, epsilon, p):
+        mu, log_sigma = self.split_prob(p)
+        return mu + epsilon * np.exp(log_sigma)
+
+    def f_neg_log_prob(self, x, p):
+        mu, log_sigma = self.split_prob(p)
+        if self.clip is not None:
+            log_sigma = np.maximum(log_sigma, self.clip)
+        return 0.5 * ((x - mu) ** 2 / np.exp(2 * log_sigma) + 2 * log_sigma
+                      + np.log(2 * np.pi))
+
+
+class Logistic(_Location):
+    '''Logistic distribution.
+
+    '''
+    param_keys = ['mu', 'log_s']
+
+    def step_sample(self, epsilon, p):
+        mu, log_s = self.split_prob(p)
+        return mu + np.log(epsilon / (1 - epsilon)) * np.exp(log_s)
+
+    def f_neg_log_prob(self, x, p):
+        mu, log_s = self.split_prob(p)
+        u = (x - mu) / np.exp(log_s)
+        return -u + log_s + 2 * np.logaddexp(0, u)
+
+
+class Laplace(_Location):
+    '''Laplace distribution.
+
+    '''
+    param_keys = ['mu', 'log_b']
+
+    def prototype_samples(self, size, rng=None):
+        return get_rng(rng).uniform(size=size).astype(self.dtype) - 0.5
+
+    def step_sample(self, epsilon, p):
+        mu, log_b = self.split_prob(p)
+        return mu + np.exp(log_b) * np.sign(epsilon) * np.log(
+            1.0 - 2 * abs(epsilon))
+
+    def f_neg_log_prob(self, x, p):
+        mu, log_b = self.split_prob(p)
+        return np.log(2.0) + log_b + abs(x - mu) / np.exp(log_b)
@@ -0,0 +1,314 @@
+'''
+Module for NumPy Helmholtz machines.
+
+Evaluates Helmholtz machines (SBNs, GBNs / VAEs, etc.) saved by
+`cortex.models.helmholtz.Helmholtz` demos without Theano: encoding with the
+posterior, decoding with the conditional, sampling from the prior and
+importance-sampled log marginals. Only MLPs (without dropout or weight noise)
+are supported for the posterior and conditional.
+
+Try with:
+
+    from cortex.runtime import Helmholtz
+    model = Helmholtz.load('vae_mnist_best.npz')
+    q = model.encode(x)
+    log_p = model.log_marginal(x, n_posterior_samples=100)
+
+'''
+
+from collections import OrderedDict
+import numpy as np
+
+from .distributions import (
+    ignore_underflow, resolve as resolve_distribution)
+from .mlp import MLP
+
+
+# Names of Helmholtz machines by prior, as in `cortex.models.helmholtz`.
+priors = OrderedDict([
+    ('sbn', 'binomial'),
+    ('gbn', 'gaussian'),
+    ('lbn', 'logistic'),
+    ('labn', 'laplace')
+])
+
+def load_params(model_file):
+    '''Loads a saved model.
+
+    Arguments are unpacked as in `cortex.utils.tools.load_model`.
+
+    Args:
+        model_file (str): path to `.npz` file.
+
+    Returns:
+        dict: parameters and arguments.
+
+    '''
+    params = np.load(model_file, allow_pickle=True)
+    d = dict()
+    for k in params.keys():
+        try:
+            d[k] = params[k].item()
+        except ValueError:
+            d[k] = params[k]
+    return d
+
+@ignore_underflow
+def log_sum_exp(x, axis=None):
+    '''Numerically stable log( sum( exp(A) ) ).
+
+    '''
+    x_max = np.max(x, axis=axis, keepdims=True)
+    y = np.log(np.sum(np.exp(x - x_max), axis=axis, keepdims=True)) + x_max
+    return np.sum(y, axis=axis)
+
+def log_ess(log_w):
+    '''Log effective sample size of importance weights.
+
+    Args:
+        log_w (numpy.array): log weights, samples on the first axis.
+
+    Returns:
+        numpy.array: :math:`\log (1 / \sum \\tilde{w}^2)`.
+
+    '''
+    log_w_tilde = log_w - log_sum_exp(log_w, axis=0)[None]
+    return -log_sum_exp(2 * log_w_tilde, axis=0)
+
+
+class Helmholtz(object):
+    '''NumPy Helmholtz machine.
+
+    Attributes:
+        posterior (MLP): approximate posterior network.
+        conditional (MLP): conditional network.
+        prior (Distribution): prior distribution of latent variables.
+        dim_h (int): latent dimension.
+        name (str): name of the model.
+
+    '''
+    def __init__(self, posterior, conditional, prior, name=None):
+        '''Init function for Helmholtz.
+
+        Args:
+            posterior (MLP).
+            conditional (MLP).
+            prior (Distribution).
+            name (Optional[str]).
+
+        '''
+        self.posterior = posterior
+        self.conditional = conditional
+        self.prior = prior
+        self.dim_h = prior.dim
+        self.name = name
+        self.dtype = posterior.Ws[0].dtype
+
+        if posterior.distribution is None or conditional.distribution is None:
+            raise ValueError('Posterior and conditional need distributions.')
+        if posterior.distribution.dim != self.dim_h:
+            raise ValueError('Posterior does not match the prior: %d vs %d'
+                             % (posterior.distribution.dim, self.dim_h))
+        if conditional.dim_in != self.dim_h:
+            raise ValueError('Conditional does not match the prior: %d vs %d'
+                             % (conditional.dim_in, self.dim_h))
+
+    @staticmethod
+    def factory(params, dim_h=None, prior=None, rec_args=None, gen_args=None,
+                name=None, **kwargs):
+        '''Forms a Helmholtz machine from saved parameters.
+
+        Args:
+            params (dict): parameters, named as in `Helmholtz.set_tparams`,
+                e.g., `gbn_posterior_W0`.
+            dim_h (Optional[int]): latent dimension, checked if provided.
+            prior (Optional[str]): prior distribution. Defaults to the one
+                of the model name (see `priors`).
+            rec_args (Optional[dict]): arguments of the posterior, as saved
+                by the demos.
+            gen_args (Optional[dict]): arguments of the conditional. Must
+                have the output `distribution`.
+            name (Optional[str]): name of the model, the prefix of the
+                parameters. Found from the parameters if not provided.
+            **kwargs: other saved arguments, ignored.
+
+        Returns:
+            Helmholtz.
+
+        '''
+        rec_args = dict(rec_args or dict())
+        gen_args = dict(gen_args or dict())
+
+        if name is None:
+            names = [k[:-len('_posterior_W0')] for k in params.keys()
+                     if k.endswith('_posterior_W0')]
+            if len(names) != 1:
+                raise ValueError('Could not find the model name in the '
+                                 'parameters (found %s)' % names)
+            name = names[0]
+
+        if prior is None:
+            prior = priors.get(name, None)
+        if prior is None:
+            prior = rec_args.get('distribution', None)
+        if not isinstance(prior, basestring):
+            raise ValueError('Prior of %s could not be determined, provide '
+                             '`prior`.' % name)
+
+        if gen_args.get('type', None) in ['darn', 'dag']:
+            raise ValueError('Conditional type %s not supported'
+                             % gen_args['type'])
+        if gen_args.get('distribution', None) is None:
+            raise ValueError('`gen_args` needs the output distribution')
+        if rec_args.get('distribution', None) is None:
+            rec_args['distribution'] = prior
+
+        posterior = MLP.factory(params, name + '_posterior', **rec_args)
+        conditional = MLP.factory(params, name + '_conditional', **gen_args)
+
+        C = resolve_distribution(prior)
+        prior_name = '%s_%s' % (name, prior)
+        prior_params = dict(
+            (k, params.get('%s_%s' % (prior_name, k), None))
+            for k in C.param_keys)
+        prior_model = C(posterior.distribution.dim, params=prior_params,
+                        dtype=posterior.Ws[0].dtype)
+
+        if dim_h is not None and dim_h != prior_model.dim:
+            raise ValueError('Latent dimension does not match: %d vs %d'
+                             % (prior_model.dim, dim_h))
+        return Helmholtz(posterior, conditional, prior_model, name=name)
+
+    @staticmethod
+    def load(model_file, **extra_args):
+        '''Loads a model saved by a Helmholtz demo.
+
+        Args:
+            model_file (str): path to `.npz` file.
+            **extra_args: arguments that override the saved ones, see
+                `factory`.
+
+        Returns:
+            Helmholtz.
+
+        '''
+        d = load_params(model_file)
+        d.update(**extra_args)
+        params = dict((k, v) for k, v in d.iteritems()
+                      if isinstance(v, np.ndarray) and v.dtype.kind == 'f')
+        args = dict((k, d[k]) for k in
+                    ['dim_h', 'prior', 'rec_args', 'gen_args', 'name']
+                    if k in d)
+        return Helmholtz.factory(params, **args)
+
+    def _cast(self, x):
+        return np.asarray(x, dtype=self.dtype)
+
+    def encode(self, x):
+        '''Approximate posterior parameters q(h | x).
+
+        Args:
+            x (numpy.array): input.
+
+        Returns:
+            numpy.array: posterior probabilities, see `get_center`.
+
+        '''
+        return self.posterior.feed(self._cast(x))
+
+    def decode(self, h):
+        '''Conditional parameters p(y | h).
+
+        Args:
+            h (numpy.array): latent states.
+
+        Returns:
+            numpy.array: conditional probabilities, see `get_center`.
+
+        '''
+        return self.conditional.feed(self._cast(h))
+
+    def get_center(self, p, posterior=False):
+        '''Returns the center of the conditional or posterior.
+
+        '''
+        if posterior:
+            return self.posterior.get_center(p)
+        return self.conditional.get_center(p)
+
+    def sample(self, n_samples=100, rng=None, epsilon=None):
+        '''Samples from the prior and feeds the conditional.
+
+        Args:
+            n_samples (int).
+            rng (Optional[int or numpy.random.RandomState]).
+            epsilon (Optional[numpy.array]): prototype samples of the prior.
+
+        Returns:
+            numpy.array: latent samples.
+            numpy.array: conditional probabilities.
+
+        '''
+        h = self.prior.sample(n_samples, rng=rng, epsilon=epsilon)
+        return h, self.conditional.feed(h)
+
+    @ignore_underflow
+    def log_weights(self, x, y=None, n_posterior_samples=10, rng=None,
+                    epsilon=None, q=None):
+        '''Log importance weights of posterior samples.
+
+        Args:
+            x (numpy.array): input to the posterior.
+            y (Optional[numpy.array]): output of the conditional. Defaults to
+                `x`.
+            n_posterior_samples (int).
+            rng (Optional[int or numpy.random.RandomState]).
+            epsilon (Optional[numpy.array]): prototype samples of the
+                posterior, with shape (n_posterior_samples, batch, dim_h).
+            q (Optional[numpy.array]): posterior probabilities. Computed
+                from `x` if not provided.
+
+        Returns:
+            numpy.array: :math:`\log p(y | h) + \log p(h) - \log q(h)`, with
+                shape (n_posterior_samples, batch).
+
+        '''
+        x = self._cast(x)
+        y = x if y is None else self._cast(y)
+        if q is None:
+            q = self.posterior.feed(x)
+
+        if epsilon is None:
+            epsilon = self.posterior.distribution.prototype_samples(
+                (n_posterior_samples, q.shape[0], self.dim_h), rng=rng)
+        h = self.posterior.distribution.step_sample(epsilon, q[None])
+        py_h = self.conditional.feed(h)
+
+        log_py_h = -self.conditional.neg_log_prob(y[None], py_h)
+        log_ph = -self.prior.neg_log_prob(h)
+        log_qh = -self.posterior.neg_log_prob(h, q[None])
+        return log_py_h + log_ph - log_qh
+
+    def log_marginal(self, x, y=None, n_posterior_samples=10, rng=None,
+                     epsilon=None):
+        '''Importance-sampled log marginal.
+
+        Uses :math:`\log \sum p / q - \log N`, as `-log p(x)` of
+        `cortex.models.helmholtz.Helmholtz`.
+
+        Args:
+            x (numpy.array): input to the posterior.
+            y (Optional[numpy.array]): output of the conditional. Defaults to
+                `x`.
+            n_posterior_samples (int).
+            rng (Optional[int or numpy.random.RandomState]).
+            epsilon (Optional[numpy.array]): prototype samples of the
+                posterior.
+
+        Returns:
+            numpy.array: log p(y) of each row.
+
+        '''
+        log_w = self.log_weights(x, y=y, n_posterior_samples=n_posterior_samples,
+                                 rng=rng, epsilon=epsilon)
+        return log_sum_exp(log_w, axis=0) - np.log(log_w.shape[0])
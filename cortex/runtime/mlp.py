@@ -0,0 +1,195 @@
+'''
+Module for NumPy MLPs.
+
+Feeds forward the weights of a trained `cortex.models.mlp.MLP`.
+'''
+
+from collections import OrderedDict
+import numpy as np
+
+from .distributions import (
+    ignore_underflow, resolve as resolve_distribution, sigmoid, softplus)
+
+
+activations = {
+    'T.nnet.sigmoid': sigmoid,
+    'T.nnet.softplus': softplus,
+    'T.tanh': np.tanh,
+    'T.nnet.relu': lambda x: np.maximum(x, 0),
+    'lambda x: x': lambda x: x
+}
+
+def resolve_activation(h_act):
+    '''Resolves a hidden activation string of `MLP`.
+
+    '''
+    f = activations.get(h_act, None)
+    if f is None:
+        raise ValueError('Activation %r not supported (%s)'
+                         % (h_act, activations.keys()))
+    return f
+
+
+class MLP(object):
+    '''Multilayer perceptron model.
+
+    Attributes:
+        Ws (list): weights of each layer.
+        bs (list): biases of each layer.
+        h_act (str): hidden activation string.
+        distribution (Optional[Distribution]): distribution of output.
+        dim_in (int): input dimension.
+        dim_out (int): output dimension, including the scale of the
+            distribution.
+        n_layers (int): number of output and hidden layers.
+        name (str): name of model.
+
+    '''
+    def __init__(self, Ws, bs, h_act='T.nnet.sigmoid', distribution='binomial',
+                 distribution_args=None, name='MLP'):
+        '''Init function for MLP.
+
+        Args:
+            Ws (list): weights of each layer.
+            bs (list): biases of each layer.
+            h_act (str): hidden activation string.
+            distribution (Optional[str]): distribution of output.
+            distribution_args (Optional[dict]): optional arguments for
+                distribution.
+            name (str): name of model.
+
+        '''
+        if distribution_args is None: distribution_args = dict()
+        if len(Ws) == 0 or len(Ws) != len(bs):
+            raise ValueError('MLP %s needs weights and biases for every layer'
+                             % name)
+        self.Ws = Ws
+        self.bs = bs
+        self.h_act = h_act
+        self.f_act = resolve_activation(h_act)
+        self.name = name
+        self.dim_in = Ws[0].shape[0]
+        self.dim_out = Ws[-1].shape[1]
+        self.n_layers = len(Ws)
+
+        if distribution is not None:
+            C = resolve_distribution(distribution)
+            if self.dim_out % C.scale != 0:
+                raise ValueError('Output of MLP %s (%d) does not fit %s'
+                                 % (name, self.dim_out, distribution))
+            self.distribution = C(self.dim_out // C.scale, dtype=Ws[-1].dtype,
+                                  **distribution_args)
+        else:
+            self.distribution = None
+
+    @staticmethod
+    def factory(params, name, h_act='T.nnet.sigmoid', distribution='binomial',
+                distribution_args=None, dim_in=None, dim_out=None, type=None,
+                dropout=False, weight_noise=False, **kwargs):
+        '''Forms an MLP from saved parameters.
+
+        Args:
+            params (dict): parameters, with keys `<name>_W<l>` and
+                `<name>_b<l>`.
+            name (str): name of model.
+            h_act (str): hidden activation string.
+            distribution (Optional[str]): distribution of output.
+            distribution_args (Optional[dict]): optional arguments for
+                distribution.
+            dim_in (Optional[int]): input dimension, checked if provided.
+            dim_out (Optional[int]): output dimension, without the scale of
+                the distribution. Checked if provided.
+            type (Optional[str]): MLP type. Only `mlp` is supported.
+            dropout (bool): dropout is not supported, as Theano MLPs apply
+                it at every feed.
+            weight_noise (bool): weight noise is not supported either.
+            **kwargs: other construction arguments of the Theano MLP, which
+                are implied by the parameters.
+
+        Returns:
+            MLP.
+
+        '''
+        if type not in [None, 'mlp']:
+            raise ValueError('MLP type %r not supported' % type)
+        if dropout or weight_noise:
+            raise ValueError('MLPs with dropout or weight noise are not '
+                             'supported (%s)' % name)
+
+        Ws = []
+        bs = []
+        while '%s_W%d' % (name, len(Ws)) in params:
+            l = len(Ws)
+            Ws.append(params['%s_W%d' % (name, l)])
+            bs.append(params['%s_b%d' % (name, l)])
+        mlp = MLP(Ws, bs, h_act=h_act, distribution=distribution,
+                  distribution_args=distribution_args, name=name)
+
+        if dim_in is not None and dim_in != mlp.dim_in:
+            raise ValueError('Input dimension of %s does not match: %d vs %d'
+                             % (name, mlp.dim_in, dim_in))
+        if (dim_out is not None and mlp.distribution is not None
+                and dim_out != mlp.distribution.dim):
+            raise ValueError('Output dimension of %s does not match: %d vs %d'
+                             % (name, mlp.distribution.dim, dim_out))
+        return mlp
+
+    @ignore_underflow
+    def __call__(self, x):
+        '''Call function.
+
+        Args:
+            x (numpy.array): input.
+
+        Returns:
+            OrderedDict: results at every layer.
+
+        '''
+        outs = OrderedDict(x=x)
+        for l in xrange(self.n_layers):
+            preact = np.dot(x, self.Ws[l]) + self.bs[l]
+
+            if l < self.n_layers - 1:
+                x = self.f_act(preact)
+                outs['preact_%d' % l] = preact
+                outs[l] = x
+            else:
+                if self.distribution is not None:
+                    x = self.distribution(preact)
+                else:
+                    x = self.f_act(preact)
+                outs['z'] = preact
+                outs['p'] = x
+        return outs
+
+    def feed(self, x):
+        '''Simple feed function.
+
+        Args:
+            x (numpy.array): input.
+
+        Returns:
+            numpy.array: output
+
+        '''
+        return self(x)['p']
+
+    def preact(self, x):
+        return self(x)['z']
+
+    def sample(self, p, n_samples=1, rng=None, epsilon=None):
+        assert self.distribution is not None
+        return self.distribution.sample(n_samples, p=p, rng=rng,
+                                        epsilon=epsilon)
+
+    def neg_log_prob(self, x, p, sum_probs=True):
+        assert self.distribution is not None
+        return self.distribution.neg_log_prob(x, p, sum_probs=sum_probs)
+
+    def get_center(self, p):
+        assert self.distribution is not None
+        return self.distribution.get_center(p)
+
+    def split_prob(self, p):
+        assert self.distribution is not None
+        return self.distribution.split_prob(p)
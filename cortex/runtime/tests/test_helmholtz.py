@@ -0,0 +1,155 @@
+'''
+Tests for the NumPy runtime of Helmholtz machines.
+'''
+
+import numpy as np
+from os import path
+import shutil
+import tempfile
+import theano
+from theano import tensor as T
+
+from cortex.models.helmholtz import Helmholtz as THelmholtz
+from cortex import runtime
+from cortex.utils import floatX
+from cortex.utils.tools import get_w_tilde, log_sum_exp
+
+
+configs = [
+    ('gaussian', 'binomial', 'T.nnet.sigmoid'),
+    ('binomial', 'gaussian', 'T.tanh'),
+    ('logistic', 'multinomial', 'T.nnet.softplus'),
+    ('laplace', 'centered_binomial', 'lambda x: x')
+]
+
+def make_data(distribution, n, dim, rng):
+    if distribution == 'binomial':
+        return (rng.uniform(size=(n, dim)) > 0.5).astype(floatX)
+    elif distribution == 'centered_binomial':
+        return 2. * (rng.uniform(size=(n, dim)) > 0.5).astype(floatX) - 1.
+    elif distribution == 'multinomial':
+        return np.eye(dim, dtype=floatX)[rng.randint(0, dim, size=(n,))]
+    return rng.normal(size=(n, dim)).astype(floatX)
+
+def make_model(prior, distribution, h_act, dim_in, dim_h, rng):
+    '''Builds a Theano model with random parameters and saves it as the demos.
+
+    '''
+    rec_args = dict(input_layer='input', dim_hs=[11], h_act=h_act)
+    gen_args = dict(output='input', dim_hs=[9, 7], h_act=h_act)
+    model = THelmholtz.factory(
+        dim_h, distributions=dict(input=distribution),
+        dims=dict(input=dim_in), prior=prior, rec_args=rec_args,
+        gen_args=gen_args)
+    tparams = model.set_tparams()
+    for p in tparams.values():
+        v = p.get_value()
+        p.set_value(rng.normal(scale=0.5, size=v.shape).astype(v.dtype))
+
+    d = dict((k, v.get_value()) for k, v in tparams.items())
+    d.update(dim_h=dim_h, rec_args=rec_args, gen_args=gen_args)
+    return model, d
+
+def test_parity(n=13, dim_in=10, dim_h=5, n_posterior_samples=17):
+    rng = np.random.RandomState(0)
+    out_path = tempfile.mkdtemp()
+    try:
+        for prior, distribution, h_act in configs:
+            model, d = make_model(prior, distribution, h_act, dim_in, dim_h,
+                                  rng)
+            model_file = path.join(out_path, '%s.npz' % model.name)
+            np.savez(model_file, **d)
+            model_ = runtime.Helmholtz.load(model_file)
+            assert model_.name == model.name
+            assert model_.dim_h == dim_h
+
+            X = T.matrix('x', dtype=floatX)
+            H = T.matrix('h', dtype=floatX)
+            R = T.tensor3('r', dtype=floatX)
+            E = T.matrix('e', dtype=floatX)
+
+            q = model.posterior.feed(X)
+            h = model.posterior.distribution.step_sample(R, q[None, :, :])
+            py_h = model.conditional.feed(h)
+            log_w = (-model.conditional.neg_log_prob(X[None, :, :], py_h)
+                     - model.prior.neg_log_prob(h)
+                     + model.posterior.neg_log_prob(h, q[None, :, :]))
+            log_p = log_sum_exp(log_w, axis=0) - T.log(n_posterior_samples)
+            w_tilde = get_w_tilde(log_w)
+            log_ess = T.log(1. / (w_tilde ** 2).sum(0))
+            h_s = model.prior.step_sample(
+                E, model.prior.get_prob(*model.prior.get_params()))
+            py = model.conditional.feed(H)
+
+            f = theano.function(
+                [X, H, R, E],
+                [q, model.posterior.get_center(q), py,
+                 model.conditional.get_center(py), log_w, log_p, log_ess, h_s,
+                 model.conditional.feed(h_s)],
+                on_unused_input='ignore')
+
+            x = make_data(distribution, n, dim_in, rng)
+            h_in = rng.normal(size=(n, dim_h)).astype(floatX)
+            r = model_.posterior.distribution.prototype_samples(
+                (n_posterior_samples, n, dim_h), rng=rng)
+            e = model_.prior.prototype_samples((n, dim_h), rng=rng)
+            outs = f(x, h_in, r, e)
+
+            q_ = model_.encode(x)
+            py_ = model_.decode(h_in)
+            log_w_ = model_.log_weights(x, epsilon=r)
+            h_s_, py_s_ = model_.sample(epsilon=e)
+            outs_ = [q_, model_.get_center(q_, posterior=True), py_,
+                     model_.get_center(py_), log_w_,
+                     model_.log_marginal(x, epsilon=r),
+                     runtime.log_ess(log_w_), h_s_, py_s_]
+
+            keys = ['q', 'q_center', 'py', 'py_center', 'log_w', 'log_p',
+                    'log_ess', 'h_s', 'py_s']
+            for k, o, o_ in zip(keys, outs, outs_):
+                assert o.shape == o_.shape, (prior, k, o.shape, o_.shape)
+                assert o_.dtype == floatX, (prior, k, o_.dtype)
+                assert np.allclose(o, o_, rtol=1e-3, atol=1e-3), (
+                    prior, k, abs(o - o_).max())
+
+            # Seeded estimates repeat, and bound the mean log weight.
+            log_w0 = model_.log_weights(x, n_posterior_samples=100, rng=1)
+            log_p0 = model_.log_marginal(x, n_posterior_samples=100, rng=1)
+            assert np.allclose(
+                log_p0, model_.log_marginal(x, n_posterior_samples=100, rng=1))
+            assert (log_p0 >= log_w0.mean(0) - 1e-4).all(), prior
+    finally:
+        shutil.rmtree(out_path)
+
+def test_sample(n_samples=7, dim_in=10, dim_h=5):
+    rng = np.random.RandomState(0)
+    for prior, distribution, h_act in configs:
+        _, d = make_model(prior, distribution, h_act, dim_in, dim_h, rng)
+        d = dict((k, v) for k, v in d.items() if k not in ['dim_h', 'rec_args',
+                                                             'gen_args'])
+        model = runtime.Helmholtz.factory(
+            d, gen_args=dict(distribution=distribution, h_act=h_act),
+            rec_args=dict(h_act=h_act))
+        h, py = model.sample(n_samples, rng=rng)
+        assert h.shape == (n_samples, dim_h)
+        assert py.shape == (n_samples, model.conditional.dim_out)
+        y = model.conditional.sample(py, rng=rng)
+        assert y.shape == (1, n_samples, dim_in)
+
+def test_unsupported(dim_in=10, dim_h=5):
+    rng = np.random.RandomState(0)
+    _, d = make_model('gaussian', 'binomial', 'T.nnet.sigmoid', dim_in, dim_h,
+                      rng)
+    for k, v in [('gen_args', dict(distribution='binomial', dropout=0.5)),
+                 ('gen_args', dict(distribution='binomial', type='darn')),
+                 ('rec_args', dict(h_act='T.nnet.mystery')),
+                 ('dim_h', dim_h + 1)]:
+        d_ = dict(d)
+        d_[k] = v
+        try:
+            runtime.Helmholtz.factory(d_, **dict(
+                (k_, d_[k_]) for k_ in ['dim_h', 'rec_args', 'gen_args']))
+        except ValueError:
+            pass
+        else:
+            assert False, 'Unsupported %s was not caught.' % k
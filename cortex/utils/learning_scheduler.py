@@ -1,4 +1,8 @@
-'''Scheduler for learning rates.
+'''Scheduler for learning rates and early stopping.
+
+Both can be driven by the validation results (see `training.validate`).
+Lower validation values are better: `training.validate` flips the sign of
+values to maximize.
 '''
 
 from collections import OrderedDict
@@ -8,47 +12,246 @@ def unpack(learning_rate=None, decay_rate=None, schedule=None):
     return learning_rate, decay_rate, schedule
 
 
+class Plateau(object):
+    '''Tracks whether a validation value stopped improving.
+
+    Attributes:
+        patience (int): number of updates without improvement before the
+            value is stalled.
+        min_delta (float): minimum decrease that counts as an improvement.
+        best (float): best value so far.
+        wait (int): number of updates since the last improvement.
+
+    '''
+    def __init__(self, patience=10, min_delta=0.):
+        '''Init function for Plateau.
+
+        Args:
+            patience (int): number of updates without improvement before the
+                value is stalled.
+            min_delta (float): minimum decrease that counts as an
+                improvement.
+
+        '''
+        if patience < 1:
+            raise ValueError('patience must be at least 1 (got %d)' % patience)
+        self.patience = patience
+        self.min_delta = min_delta
+        self.best = float('inf')
+        self.wait = 0
+
+    def update(self, value):
+        '''Updates with a new value.
+
+        Args:
+            value (float): validation value.
+
+        Returns:
+            bool: True if the value improved on the best.
+
+        '''
+        if value < self.best - self.min_delta:
+            self.best = value
+            self.wait = 0
+            return True
+        self.wait += 1
+        return False
+
+    def stalled(self):
+        return self.wait >= self.patience
+
+
+class ReduceOnPlateau(Plateau):
+    '''Decays a learning rate when the validation value stops improving.
+
+    Attributes:
+        factor (float): decay of the learning rate.
+        cooldown (int): number of updates after a decay before counting
+            updates without improvement again.
+        min_learning_rate (float): lower bound of the learning rate.
+
+    '''
+    def __init__(self, factor=0.1, patience=10, min_delta=0., cooldown=0,
+                 min_learning_rate=0.):
+        '''Init function for ReduceOnPlateau.
+
+        Args:
+            factor (float): decay of the learning rate.
+            patience (int): see `Plateau`.
+            min_delta (float): see `Plateau`.
+            cooldown (int): number of updates after a decay before counting
+                updates without improvement again.
+            min_learning_rate (float): lower bound of the learning rate.
+
+        '''
+        super(ReduceOnPlateau, self).__init__(patience=patience,
+                                              min_delta=min_delta)
+        self.factor = factor
+        self.cooldown = cooldown
+        self.min_learning_rate = min_learning_rate
+        self._cooling = 0
+
+    def __call__(self, learning_rate, value):
+        '''Updates with a new value.
+
+        Args:
+            learning_rate (float): current learning rate.
+            value (float): validation value.
+
+        Returns:
+            float: new learning rate.
+
+        '''
+        self.update(value)
+        if self._cooling > 0:
+            self._cooling -= 1
+            self.wait = 0
+        elif self.stalled():
+            learning_rate = max(learning_rate * self.factor,
+                                self.min_learning_rate)
+            self.wait = 0
+            self._cooling = self.cooldown
+        return learning_rate
+
+
+class EarlyStopping(Plateau):
+    '''Stops when the validation value has not improved for `patience` tests.
+
+    Attributes:
+        min_epochs (int): training does not stop before this epoch.
+
+    '''
+    def __init__(self, patience=10, min_delta=0., min_epochs=0):
+        '''Init function for EarlyStopping.
+
+        Args:
+            patience (int): see `Plateau`.
+            min_delta (float): see `Plateau`.
+            min_epochs (int): training does not stop before this epoch.
+
+        '''
+        super(EarlyStopping, self).__init__(patience=patience,
+                                            min_delta=min_delta)
+        self.min_epochs = min_epochs
+
+    def __call__(self, value, e):
+        '''Updates with a new value.
+
+        Args:
+            value (float): validation value.
+            e (int): epoch.
+
+        Returns:
+            bool: True if training should stop.
+
+        '''
+        self.update(value)
+        return self.stalled() and e >= self.min_epochs
+
+
+class StopAtTarget(object):
+    '''Stops when the validation value reaches a target.
+
+    '''
+    def __init__(self, target=None):
+        if target is None:
+            raise ValueError('A target must be provided.')
+        self.target = target
+
+    def __call__(self, value, e):
+        return value <= self.target
+
+# Stopping criteria by name, for `make_stopping`.
+criteria = OrderedDict(patience=EarlyStopping, target=StopAtTarget)
+
+def make_stopping(spec):
+    '''Makes a stopping criterion.
+
+    A criterion is called with the validation value and the epoch after
+    each test and returns True if training should stop.
+
+    Args:
+        spec (None, str, dict or function): a criterion, the name of one of
+            `criteria`, or a dictionary of its arguments with its name in
+            `criterion` (defaults to `patience`), e.g.,
+            `{patience: 5, min_delta: 0.01}`.
+
+    Returns:
+        function or None: criterion.
+
+    '''
+    if spec is None or callable(spec):
+        return spec
+    if isinstance(spec, str):
+        spec = dict(criterion=spec)
+    spec = dict(spec)
+    name = spec.pop('criterion', 'patience')
+    if name not in criteria.keys():
+        raise ValueError('Unknown stopping criterion %s (%s)'
+                         % (name, criteria.keys()))
+    return criteria[name](**spec)
+
+
 class Scheduler(object):
     '''Scheduler for learning rates.
 
     Attributes:
         d (OrderedDict): dictionary of learning rates and decays, schedules.
+        plateaus (OrderedDict): `ReduceOnPlateau` of the learning rates that
+            decay on plateaus.
 
     '''
-    def __init__(self, verbose=True, **kwargs):
+    def __init__(self, verbose=True, plateau=None, **kwargs):
         '''Init function of Scheduler.
 
         kwargs correspond to the model name and their respective schedules.
         Currently, each key is the name of a model while each value is the
         schedule dictionary. The schedule dictionary should include a learning
-        rate and can have either a decay rate or a schedule.
+        rate and can have either a decay rate or a schedule, and `plateau`.
 
         Args:
             verbose (bool): sets verbosity.
+            plateau (Optional[dict]): default arguments of `ReduceOnPlateau`
+                for learning rates that do not set `plateau`. If None, they
+                only decay on plateaus if they set `plateau`.
             **kwargs: keyword args of the scheduled learning rates
 
         '''
         self.d = OrderedDict()
+        self.plateaus = OrderedDict()
         self.verbose = verbose
+        self.plateau = plateau
         for k, v in kwargs.iteritems():
-            self.d[k] = OrderedDict()
-            if isinstance(v, float):
-                self.d[k]['learning_rate'] = v
-            elif isinstance(v, (dict, OrderedDict)):
-                def unpack(learning_rate=None, decay_rate=None, schedule=None):
-                    return learning_rate, decay_rate, schedule
+            self.add(k, v)
 
-                learning_rate, decay_rate, schedule = unpack(**v)
+    def add(self, k, v):
+        '''Adds a learning rate.
+
+        Args:
+            k (str): name of the learning rate.
+            v (float or dict): learning rate or schedule dictionary.
+
+        '''
+        self.d[k] = OrderedDict()
+        plateau = self.plateau
+        if isinstance(v, float):
+            self.d[k]['learning_rate'] = v
+        elif isinstance(v, (dict, OrderedDict)):
+            v = dict(v)
+            plateau = v.pop('plateau', plateau)
+            learning_rate, decay_rate, schedule = unpack(**v)
 
-                if learning_rate is None:
-                    raise ValueError('Must includes learning rate for %s' % k)
+            if learning_rate is None:
+                raise ValueError('Must includes learning rate for %s' % k)
 
-                if (decay_rate is not None) and (schedule is not None):
-                    raise ValueError('Provide either decay rate OR scheduler OR neither'
-                                     ', not both.')
-                self.d[k]['decay_rate'] = decay_rate
-                self.d[k]['schedule'] = schedule
-                self.d[k]['learning_rate'] = learning_rate
+            if (decay_rate is not None) and (schedule is not None):
+                raise ValueError('Provide either decay rate OR scheduler OR neither'
+                                 ', not both.')
+            self.d[k]['decay_rate'] = decay_rate
+            self.d[k]['schedule'] = schedule
+            self.d[k]['learning_rate'] = learning_rate
+        if plateau is not None:
+            self.plateaus[k] = ReduceOnPlateau(**plateau)
 
     def __getitem__(self, k):
         return self.d[k]
@@ -76,3 +279,22 @@ class Scheduler(object):
                 print 'Changing learning rate for %s to %.5f' % (k, self.d[k]['learning_rate'])
 
         return [v['learning_rate'] for v in self.d.values()]
+
+    def update_valid(self, value):
+        '''Decays the learning rates that reached a plateau.
+
+        Args:
+            value (float): validation value, lower is better.
+
+        Returns:
+            list: list of current learning rates.
+
+        '''
+        for k, plateau in self.plateaus.iteritems():
+            learning_rate = self.d[k]['learning_rate']
+            self.d[k]['learning_rate'] = plateau(learning_rate, value)
+            if self.verbose and self.d[k]['learning_rate'] != learning_rate:
+                print ('Validation plateaued, changing learning rate for %s '
+                       'to %.5f' % (k, self.d[k]['learning_rate']))
+
+        return [v['learning_rate'] for v in self.d.values()]
@@ -6,6 +6,7 @@ matplotlib.use('Agg')
 from matplotlib import pylab as plt
 from collections import OrderedDict
 import cPickle as pkl
+import json
 import numpy as np
 import os
 import pprint
@@ -36,6 +37,12 @@ class SimpleMonitor(object):
     def update_valid(self, **kwargs):
         update_dict_of_lists(self.d_valid, **kwargs)
 
+    def needs_save(self):
+        '''Whether saving the monitor writes anything now.
+
+        '''
+        return True
+
     def add(self, **kwargs):
         for k, v in kwargs.iteritems():
             self.d[k] = v
@@ -124,3 +131,159 @@ class SimpleMonitor(object):
             out_path: str
         '''
         np.savez(out_path, **self.d_valid)
+
+
+def _tail_lines(f, n, block_size=4096):
+    '''Reads the last `n` lines of a file without reading all of it.
+
+    '''
+    f.seek(0, os.SEEK_END)
+    end = f.tell()
+    pos = end
+    data = ''
+    while pos > 0 and data.count('\n') <= n:
+        step = min(block_size, pos)
+        pos -= step
+        f.seek(pos)
+        data = f.read(step) + data
+    lines = data.splitlines()
+    if pos > 0:
+        # The first line may be cut.
+        lines = lines[1:]
+    return lines[-n:] if n > 0 else []
+
+def read_log(log_file, tail=None):
+    '''Reads a log written by `StreamingMonitor`.
+
+    Can be used while the log is being written. A partially written last
+    line is ignored.
+
+    Args:
+        log_file (str): path to the log.
+        tail (Optional[int]): if not None, only the last `tail` records are
+            read. The file is read from the end, so this does not depend on
+            the length of the log.
+
+    Returns:
+        OrderedDict: dictionary of lists of training results.
+        OrderedDict: dictionary of lists of validation results.
+
+    '''
+    d = OrderedDict()
+    d_valid = OrderedDict()
+    with open(log_file, 'rb') as f:
+        if tail is None:
+            lines = f.read().splitlines()
+        else:
+            lines = _tail_lines(f, tail)
+
+    for line in lines:
+        try:
+            record = json.loads(line, object_pairs_hook=OrderedDict)
+        except ValueError:
+            continue
+        split = record.pop('_split')
+        update_dict_of_lists(d_valid if split == 'valid' else d, **record)
+
+    return d, d_valid
+
+def plot_log(log_file, out_path, tail=None):
+    '''Plots a log written by `StreamingMonitor`.
+
+    Args:
+        log_file (str): path to the log.
+        out_path (str): path to the figure.
+        tail (Optional[int]): if not None, only the last `tail` records are
+            plotted.
+
+    '''
+    monitor = SimpleMonitor()
+    monitor.d, monitor.d_valid = read_log(log_file, tail=tail)
+    monitor.save(out_path)
+
+
+class StreamingMonitor(SimpleMonitor):
+    '''Monitor that appends results to a log on disk.
+
+    Each call to `update` or `update_valid` appends one line of JSON to the
+    log, so recording an epoch costs the same regardless of the length of the
+    run, and the log can be read (see `read_log`) while training runs. As the
+    log is always up to date, `save_stats` and `save_stats_valid` do nothing,
+    and `save` only plots every `plot_every` validation updates, starting
+    with the first. Use `plot_log` to plot on demand.
+
+    Attributes:
+        log_file (str): path to the log. If None, nothing is written and the
+            monitor behaves like `SimpleMonitor`.
+        plot_every (int): number of validation updates between plots. If
+            None, `save` does not plot.
+
+    '''
+    def __init__(self, log_file=None, plot_every=10):
+        '''Init function for StreamingMonitor.
+
+        Args:
+            log_file (Optional[str]): path to the log. An existing log is
+                overwritten.
+            plot_every (Optional[int]): number of validation updates between
+                plots.
+
+        '''
+        super(StreamingMonitor, self).__init__()
+        self.log_file = log_file
+        self.plot_every = plot_every
+        self._valid_updates = 0
+        if log_file is not None:
+            self._log = open(log_file, 'wb')
+        else:
+            self._log = None
+
+    def _append(self, split, **kwargs):
+        if self._log is None:
+            return
+        record = OrderedDict(_split=split)
+        for k, v in kwargs.iteritems():
+            record[k] = float(v)
+        self._log.write(json.dumps(record) + '\n')
+        self._log.flush()
+
+    def update(self, **kwargs):
+        super(StreamingMonitor, self).update(**kwargs)
+        self._append('train', **kwargs)
+
+    def update_valid(self, **kwargs):
+        super(StreamingMonitor, self).update_valid(**kwargs)
+        self._valid_updates += 1
+        self._append('valid', **kwargs)
+
+    def needs_save(self):
+        '''Whether saving writes anything: only if it plots, with a log.
+
+        '''
+        return self.log_file is None or (
+            self.plot_every is not None
+            and (self._valid_updates - 1) % self.plot_every == 0)
+
+    def save(self, out_path):
+        '''Plots the monitor every `plot_every` validation updates.
+
+        Args:
+            out_path: str
+        '''
+        if self.needs_save():
+            super(StreamingMonitor, self).save(out_path)
+
+    def save_stats(self, out_path):
+        if self.log_file is None:
+            super(StreamingMonitor, self).save_stats(out_path)
+
+    def save_stats_valid(self, out_path):
+        if self.log_file is None:
+            super(StreamingMonitor, self).save_stats_valid(out_path)
+
+    def close(self):
+        '''Closes the log.
+
+        '''
+        if self._log is not None:
+            self._log.close()
@@ -2,6 +2,13 @@
 Optimization routines.
 
 Based (and copied) on Kyunghyun Cho's arctic repo.
+
+Each optimizer returns a gradient function and an update function. By default
+(`fused=True`), the step is fused: the gradient function takes the inputs and
+learning rate(s), returns the cost and extra outputs, and updates the
+parameters, and the update function is None. With `fused=False`, the
+gradients are staged in shared variables (e.g., for inspection) and the update
+function applies the step.
 '''
 import numpy as np
 import theano
@@ -10,12 +17,220 @@ import tools
 from collections import OrderedDict
 
 
-profile = False
+class StepGuard(object):
+    '''Checks in the graph that the cost and gradients of a step are finite.
 
-def adam3(lr, tparams, grads, inp, cost, extra_ups=[], extra_outs=[],
-          exclude_params=set([])):
+    The step counts the steps with a NaN or Inf in the cost or gradients in
+    a shared variable, so the host only reads one integer when checking. At
+    each check (see `check`), the policy is applied to the bad steps since
+    the last check:
+
+        `abort`: training stops.
+        `skip`: nothing, as the updates of bad steps are not applied in the
+            graph. The number of skipped steps is printed.
+        `rollback`: the parameters, optimizer state and extra updated shared
+            variables are restored to their values at the last check. If
+            there was no bad step, the current values are kept for the next
+            rollback.
+
+    Attributes:
+        policy (str): `abort`, `skip` or `rollback`.
+        check_every (int): number of steps between checks.
+        n_bad (theano.shared): number of bad steps.
+        ok (theano.shared): 1 if the last step was finite. Used in two-call
+            mode with `skip`.
+        state (list): shared variables updated by the step.
+        backups (list): copies of `state` for `rollback`.
+
+    '''
+    policies = ['abort', 'skip', 'rollback']
+
+    def __init__(self, policy='abort', check_every=1):
+        '''Init function for StepGuard.
+
+        Args:
+            policy (str): `abort`, `skip` or `rollback`.
+            check_every (int): number of steps between checks.
+
+        '''
+        if policy not in self.policies:
+            raise ValueError('Unknown policy for bad numbers: %s (%s)'
+                             % (policy, self.policies))
+        if check_every < 1:
+            raise ValueError('check_every must be at least 1 (got %d)'
+                             % check_every)
+        self.policy = policy
+        self.check_every = check_every
+        self.n_bad = theano.shared(np.int64(0), name='n_bad_steps')
+        self.ok = theano.shared(np.int8(1), name='last_step_ok')
+        self.state = []
+        self.backups = []
+        self._n_checked = 0
+        self._f_backup = None
+        self._f_restore = None
+
+    def finite(self, xs):
+        '''Single flag that is true if all tensors are finite.
+
+        A NaN or Inf propagates through a sum, so each tensor is only
+        reduced once.
+
+        Args:
+            xs (list): tensors.
+
+        Returns:
+            T.scalar: flag.
+
+        '''
+        bad = None
+        for x in xs:
+            s = x.sum()
+            b = T.or_(T.isnan(s), T.isinf(s))
+            bad = b if bad is None else T.or_(bad, b)
+        return T.eq(bad, 0)
+
+    def count_update(self, finite):
+        return (self.n_bad, self.n_bad + T.cast(T.eq(finite, 0), 'int64'))
+
+    def skip(self, updates, finite):
+        '''Keeps the values of updated variables if `finite` is false.
+
+        '''
+        return [(v, T.switch(finite, u, v)) for v, u in updates]
+
+    def set_state(self, state):
+        '''Sets the shared variables to back up for `rollback`.
+
+        '''
+        self.state = state
+        if self.policy != 'rollback':
+            return
+        self.backups = [theano.shared(v.get_value(), name='%s_backup' % v.name)
+                        for v in self.state]
+        self._f_backup = theano.function(
+            [], [], updates=zip(self.backups, self.state))
+        self._f_restore = theano.function(
+            [], [], updates=zip(self.state, self.backups))
+
+    def reset(self):
+        '''Starts checking from the current state.
+
+        '''
+        self._n_checked = int(self.n_bad.get_value())
+        if self._f_backup is not None:
+            self._f_backup()
+
+    def check(self):
+        '''Applies the policy to the bad steps since the last check.
+
+        Returns:
+            bool: False if training should stop.
+
+        '''
+        n_bad = int(self.n_bad.get_value())
+        new_bad = n_bad - self._n_checked
+        self._n_checked = n_bad
+
+        if self.policy == 'abort':
+            return new_bad == 0
+        elif self.policy == 'skip':
+            if new_bad > 0:
+                print ('Skipped %d steps with bad numbers (%d total)'
+                       % (new_bad, n_bad))
+        elif self.policy == 'rollback':
+            if new_bad > 0:
+                print ('Found %d steps with bad numbers, rolling back '
+                       '(%d total)' % (new_bad, n_bad))
+                self._f_restore()
+            else:
+                self._f_backup()
+        return True
+
+def _stage(tparams, grads, fused):
+    '''Stages gradients for the update.
+
+    In two-call mode, the gradient function writes the gradients to shared
+    variables and the update function reads them back. In fused mode, there
+    is a single function and the gradients are used directly.
+
+    Args:
+        tparams (OrderedDict): parameters.
+        grads (list): gradients of the parameters.
+        fused (bool): fused mode.
+
+    Returns:
+        list: gradients to use in the update.
+        list: updates for the gradient function.
+
+    '''
+    if fused:
+        return grads, []
     gshared = [theano.shared(p.get_value() * 0., name='%s_grad'%k)
                for k, p in tparams.iteritems()]
+    return gshared, zip(gshared, grads)
+
+def _compile(lr, inp, cost, grad_ups, param_ups, extra_ups, extra_outs,
+             fused, grads=None, guard=None):
+    '''Compiles the optimizer step.
+
+    Args:
+        lr (T.scalar or list): learning rate(s).
+        inp (list): inputs.
+        cost (T.scalar): cost.
+        grad_ups (list): updates made from the gradients.
+        param_ups (list): updates of the parameters and optimizer state.
+        extra_ups (theano.OrderedUpdates): extra updates, e.g., from scan.
+        extra_outs (list): extra outputs.
+        fused (bool): if True, compiles a single function.
+        grads (Optional[list]): gradients, checked by `guard`.
+        guard (Optional[StepGuard]): checks that the step is finite.
+
+    Returns:
+        theano.function: gradient function. In fused mode, this takes the
+            inputs followed by the learning rate(s), and also updates the
+            parameters.
+        theano.function or None: update function. None in fused mode.
+
+    '''
+    if not isinstance(lr, list): lr = [lr]
+    if isinstance(param_ups, OrderedDict): param_ups = param_ups.items()
+    if isinstance(extra_ups, OrderedDict): extra_ups = extra_ups.items()
+    extra_ups = list(extra_ups)
+
+    if guard is not None:
+        guard.set_state([v for v, _ in grad_ups + param_ups + extra_ups])
+        finite = guard.finite([cost] + (grads or []))
+        extra_ups.append(guard.count_update(finite))
+        if guard.policy == 'skip':
+            grad_ups = guard.skip(grad_ups, finite)
+            if fused:
+                param_ups = guard.skip(param_ups, finite)
+            else:
+                # The update function reads the flag of the last step.
+                extra_ups.append((guard.ok, T.cast(finite, 'int8')))
+                param_ups = guard.skip(param_ups, guard.ok)
+
+    if fused:
+        # Folding scalars into dot products would compute each gradient once
+        # per consumer in the update.
+        mode = theano.compile.get_default_mode().excluding(
+            'local_dot22_to_dot22scalar')
+        f_step = theano.function(
+            inp + lr, [cost]+extra_outs,
+            updates=grad_ups+param_ups+extra_ups,
+            on_unused_input='ignore', mode=mode)
+        return f_step, None
+
+    f_grad_shared = theano.function(
+        inp, [cost]+extra_outs, updates=grad_ups+extra_ups)
+    f_update = theano.function(lr, [], updates=param_ups,
+                               on_unused_input='ignore')
+
+    return f_grad_shared, f_update
+
+def adam3(lr, tparams, grads, inp, cost, extra_ups=[], extra_outs=[],
+          exclude_params=set([]), fused=True, guard=None):
+    gshared, gsup = _stage(tparams, grads, fused)
     '''
     g_norm = 0.
 
@@ -30,11 +245,6 @@ def adam3(lr, tparams, grads, inp, cost, extra_ups=[], extra_outs=[],
     for i in xrange(len(grads)):
         grads[i] *= scaler
     '''
-    gsup = [(gs, g) for gs, g in zip(gshared, grads)]
-
-    f_grad_shared = theano.function(
-        inp, [cost]+extra_outs, updates=gsup+extra_ups, profile=profile)
-
     b1 = 0.9
     b2 = 0.999
     eps = 1e-8
@@ -76,17 +286,13 @@ def adam3(lr, tparams, grads, inp, cost, extra_ups=[], extra_outs=[],
     '''
     updates[i] = i_t
 
-    if not isinstance(lr, list): lr = [lr]
-    f_update = theano.function(lr, [], updates=updates,
-                               on_unused_input='ignore', profile=profile)
-
-    return f_grad_shared, f_update
+    return _compile(lr, inp, cost, gsup, updates, extra_ups, extra_outs,
+                    fused, grads=grads, guard=guard)
 
 
 def adam2(lr, tparams, grads, inp, cost, extra_ups=[], extra_outs=[],
-          exclude_params=set([])):
-    gshared = [theano.shared(p.get_value() * 0., name='%s_grad'%k)
-               for k, p in tparams.iteritems()]
+          exclude_params=set([]), fused=True, guard=None):
+    gshared, gsup = _stage(tparams, grads, fused)
     '''
     g_norm = 0.
 
@@ -101,11 +307,6 @@ def adam2(lr, tparams, grads, inp, cost, extra_ups=[], extra_outs=[],
     for i in xrange(len(grads)):
         grads[i] *= scaler
     '''
-    gsup = [(gs, g) for gs, g in zip(gshared, grads)]
-
-    f_grad_shared = theano.function(
-        inp, [cost]+extra_outs, updates=gsup+extra_ups, profile=profile)
-
     b1 = 0.9
     b2 = 0.999
     eps = 1e-8
@@ -146,16 +347,12 @@ def adam2(lr, tparams, grads, inp, cost, extra_ups=[], extra_outs=[],
     '''
     updates[i] = i_t
 
-    if not isinstance(lr, list): lr = [lr]
-    f_update = theano.function(lr, [], updates=updates,
-                               on_unused_input='ignore', profile=profile)
-
-    return f_grad_shared, f_update
+    return _compile(lr, inp, cost, gsup, updates, extra_ups, extra_outs,
+                    fused, grads=grads, guard=guard)
 
 def adam(lr, tparams, grads, inp, cost, extra_ups=[], extra_outs=[],
-         exclude_params=set([])):
-    gshared = [theano.shared(p.get_value() * 0., name='%s_grad'%k)
-               for k, p in tparams.iteritems()]
+         exclude_params=set([]), fused=True, guard=None):
+    gshared, gsup = _stage(tparams, grads, fused)
 
     '''
     g_norm = 0.
@@ -172,11 +369,6 @@ def adam(lr, tparams, grads, inp, cost, extra_ups=[], extra_outs=[],
         grads[i] *= scaler
     '''
 
-    gsup = [(gs, g) for gs, g in zip(gshared, grads)]
-
-    f_grad_shared = theano.function(
-        inp, [cost]+extra_outs, updates=gsup+extra_ups, profile=profile)
-
     b1 = 0.9
     b2 = 0.999
     eps = 1e-8
@@ -210,124 +402,105 @@ def adam(lr, tparams, grads, inp, cost, extra_ups=[], extra_outs=[],
 
     updates[i] = i_t
 
-    if not isinstance(lr, list): lr = [lr]
-    f_update = theano.function(lr, [], updates=updates,
-                               on_unused_input='ignore', profile=profile)
-
-    return f_grad_shared, f_update
+    return _compile(lr, inp, cost, gsup, updates, extra_ups, extra_outs,
+                    fused, grads=grads, guard=guard)
 
 def adadelta(lr, tparams, grads, inp, cost, extra_ups=[], extra_outs=[],
-             exclude_params=set([])):
+             exclude_params=set([]), fused=True, guard=None):
     '''Adadelta'''
-    zipped_grads = [theano.shared(p.get_value() * np.float32(0.), name='%s_grad'%k)
-                    for k, p in tparams.iteritems()]
+    zipped_grads, zgup = _stage(tparams, grads, fused)
     running_up2 = [theano.shared(p.get_value() * np.float32(0.), name='%s_rup2'%k)
                    for k, p in tparams.iteritems()]
     running_grads2 = [theano.shared(p.get_value() * np.float32(0.), name='%s_rgrad2'%k)
                       for k, p in tparams.iteritems()]
 
-    zgup = [(zg, g) for zg, g in zip(zipped_grads, grads)]
     rg2up = [(rg2, 0.95 * rg2 + 0.05 * (g ** 2))
         for rg2, g in zip(running_grads2, grads)]
-
-    f_grad_shared = theano.function(
-        inp, [cost]+extra_outs, updates=zgup+rg2up+extra_ups, profile=profile)
+    # In two-call mode, the update reads the running averages after the
+    # gradient function has updated them.
+    rg2_t = [rg2n for _, rg2n in rg2up] if fused else running_grads2
 
     updir = [-T.sqrt(ru2 + 1e-6) / T.sqrt(rg2 + 1e-6) * zg
-             for zg, ru2, rg2 in zip(zipped_grads, running_up2, running_grads2)]
+             for zg, ru2, rg2 in zip(zipped_grads, running_up2, rg2_t)]
     ru2up = [(ru2, 0.95 * ru2 + 0.05 * (ud ** 2))
         for ru2, ud in zip(running_up2, updir)]
     param_up = [(p, p + ud) for p, ud in zip(tools.itemlist(tparams), updir)
         if p.name not in exclude_params]
 
-    if not isinstance(lr, list): lr = [lr]
-    f_update = theano.function(lr, [], updates=ru2up+param_up,
-        on_unused_input='ignore', profile=profile)
-
-    return f_grad_shared, f_update
+    return _compile(lr, inp, cost, zgup+rg2up, ru2up+param_up, extra_ups,
+                    extra_outs, fused, grads=grads, guard=guard)
 
 def rmsprop(lr, tparams, grads, inp, cost, extra_ups=[], extra_outs=[],
             exclude_params=set([]),
-            relaxation=1e-4, momentum=0.9, coefficient=0.95
-            ):
+            relaxation=1e-4, momentum=0.9, coefficient=0.95, fused=True,
+            guard=None):
     '''RMSProp'''
     print ('RMSprop with relaxation %.5f, momentum %.2f, and coeffient %.2f'
            % (relaxation, momentum, coefficient))
-    zipped_grads = [theano.shared(p.get_value() * np.float32(0.), name='%s_grad'%k)
-                    for k, p in tparams.iteritems()]
+    zipped_grads, zgup = _stage(tparams, grads, fused)
     running_grads = [theano.shared(p.get_value() * np.float32(0.), name='%s_rgrad'%k)
                      for k, p in tparams.iteritems()]
     running_grads2 = [theano.shared(p.get_value() * np.float32(0.), name='%s_rgrad2'%k)
                       for k, p in tparams.iteritems()]
 
-    zgup = [(zg, g) for zg, g in zip(zipped_grads, grads)]
     rgup = [(rg, coefficient * rg + (1.0 - coefficient) * g)
         for rg, g in zip(running_grads, grads)]
     rg2up = [(rg2, coefficient * rg2 + (1.0 - coefficient) * (g ** 2))
         for rg2, g in zip(running_grads2, grads)]
-
-    f_grad_shared = theano.function(
-        inp, [cost]+extra_outs, updates=zgup+rgup+rg2up+extra_ups, profile=profile)
+    if fused:
+        rg_t = [rgn for _, rgn in rgup]
+        rg2_t = [rg2n for _, rg2n in rg2up]
+    else:
+        rg_t = running_grads
+        rg2_t = running_grads2
 
     updir = [theano.shared(p.get_value() * np.float32(0.), name='%s_updir'%k)
              for k, p in tparams.iteritems()]
     updir_new = [(ud, momentum * ud - lr * zg / T.sqrt(rg2 - rg ** 2 + relaxation))
-        for ud, zg, rg, rg2 in zip(updir, zipped_grads, running_grads, running_grads2)]
+        for ud, zg, rg, rg2 in zip(updir, zipped_grads, rg_t, rg2_t)]
     param_up = [(p, p + udn[1]) for p, udn in zip(tools.itemlist(tparams), updir_new)
         if p.name not in exclude_params]
 
-    if not isinstance(lr, list): lr = [lr]
-    f_update = theano.function(
-        lr, [], updates=updir_new+param_up, on_unused_input='ignore',
-        profile=profile)
-
-    return f_grad_shared, f_update
+    return _compile(lr, inp, cost, zgup+rgup+rg2up, updir_new+param_up,
+                    extra_ups, extra_outs, fused, grads=grads, guard=guard)
 
 def sgd(lr, tparams, grads, inp, cost, extra_ups=[], extra_outs=[],
-        exclude_params=set([])):
+        exclude_params=set([]), fused=True, guard=None):
     '''Stochastic gradient descent'''
-    gshared = [theano.shared(p.get_value() * 0., name='%s_grad'%k)
-               for k, p in tparams.iteritems()]
-
-    gsup = [(gs, g) for gs, g in zip(gshared, grads)]
-
-    f_grad_shared = theano.function(
-        inp, [cost]+extra_outs, updates=gsup+extra_ups, profile=profile)
+    gshared, gsup = _stage(tparams, grads, fused)
 
     pup = [(p, p - lr * g) for p, g in zip(tools.itemlist(tparams), gshared)
         if p.name not in exclude_params]
 
-    if not isinstance(lr, list): lr = [lr]
-    f_update = theano.function(lr, [], updates=pup, profile=profile)
-
-    return f_grad_shared, f_update
+    return _compile(lr, inp, cost, gsup, pup, extra_ups, extra_outs, fused,
+                    grads=grads, guard=guard)
 
 def rmsprop2(lr, tparams, grads, inp, cost, extra_ups=[], extra_outs=[],
              exclude_params=set([]),
-            relaxation=1e-4, momentum=0.9, coefficient=0.95):
+            relaxation=1e-4, momentum=0.9, coefficient=0.95, fused=True, guard=None):
     '''An alternative RMSProp'''
     print 'RMSprop with relaxation %.5f, momentum %.2f, and coeffient %.2f' % (relaxation, momentum, coefficient)
-    zipped_grads = [theano.shared(p.get_value() * np.float32(0.), name='%s_grad'%k)
-                    for k, p in tparams.iteritems()]
+    zipped_grads, zgup = _stage(tparams, grads, fused)
     running_grads = [theano.shared(p.get_value() * np.float32(0.), name='%s_rgrad'%k)
                      for k, p in tparams.iteritems()]
     running_grads2 = [theano.shared(p.get_value() * np.float32(0.), name='%s_rgrad2'%k)
                       for k, p in tparams.iteritems()]
 
-    zgup = [(zg, g) for zg, g in zip(zipped_grads, grads)]
     rgup = [(rg, coefficient * rg + (1.0 - coefficient) * g)
         for rg, g in zip(running_grads, grads)]
     rg2up = [(rg2, coefficient * rg2 + (1.0 - coefficient) * (g ** 2))
         for rg2, g in zip(running_grads2, grads)]
-
-    f_grad_shared = theano.function(
-        inp, [cost]+extra_outs, updates=zgup+rgup+rg2up+extra_ups, profile=profile)
+    if fused:
+        rg_t = [rgn for _, rgn in rgup]
+        rg2_t = [rg2n for _, rg2n in rg2up]
+    else:
+        rg_t = running_grads
+        rg2_t = running_grads2
 
     updir = [theano.shared(p.get_value() * np.float32(0.), name='%s_updir'%k)
              for k, p in tparams.iteritems()]
     updir_temp = [momentum * ud - lr * zg / T.sqrt(rg2 - rg ** 2 + relaxation)
-                  for ud, zg, rg, rg2 in zip(updir, zipped_grads, running_grads,
-                                             running_grads2)]
+                  for ud, zg, rg, rg2 in zip(updir, zipped_grads, rg_t, rg2_t)]
 
     for i, (k, updated_param) in enumerate(zip(updir, updir_temp)):
         if 'W' in str(k):
@@ -341,9 +514,5 @@ def rmsprop2(lr, tparams, grads, inp, cost, extra_ups=[], extra_outs=[],
     param_up = [(p, p + udn[1]) for p, udn in zip(tools.itemlist(tparams), updir_new)
         if p.name not in exclude_params]
 
-    if not isinstance(lr, list): lr = [lr]
-    f_update = theano.function(
-        lr, [], updates=updir_new+param_up, on_unused_input='ignore',
-        profile=profile)
-
-    return f_grad_shared, f_update
+    return _compile(lr, inp, cost, zgup+rgup+rg2up, updir_new+param_up,
+                    extra_ups, extra_outs, fused, grads=grads, guard=guard)
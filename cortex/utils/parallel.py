@@ -0,0 +1,275 @@
+'''
+Data-parallel training with worker processes.
+
+`data_parallel` builds a step that behaves like a fused optimizer step (see
+`utils.op`): it takes the inputs followed by the learning rate(s), returns
+the cost and extra outputs, and updates the parameters. Each batch is split
+into shards along the first axis, one per process. The processes compute
+the gradients of their shard with replicas of the model forked from the
+training process, and write them to shared memory. The training process
+averages them and applies a single optimizer update. The parameters are
+published in shared memory at the start of each step, so the workers also
+see parameters set outside of the step (e.g., restored by a `StepGuard`
+rollback).
+
+Set `n_workers` in the experiment learning args to use it, e.g.:
+
+    learning_args: {
+      n_workers: 4
+    }
+
+Each process runs its own BLAS threads, so it is usually best to limit them
+(e.g., `OMP_NUM_THREADS=1`) when using as many workers as cores.
+
+'''
+
+import multiprocessing as mp
+import numpy as np
+import random
+import signal
+import theano
+from theano.sandbox.rng_mrg import MRG_RandomStreams as RandomStreams
+import traceback
+
+from . import floatX
+
+
+def _shared_array(shape, dtype):
+    '''Numpy array in shared memory, inherited by forked processes.
+
+    '''
+    dtype = np.dtype(dtype)
+    size = int(np.prod(shape))
+    raw = mp.RawArray('b', max(size, 1) * dtype.itemsize)
+    return np.frombuffer(raw, dtype=dtype, count=size).reshape(shape)
+
+def data_parallel(optimizer, lr, tparams, grads, inp, cost, extra_ups=[],
+                  extra_outs=[], n_workers=2, guard=None, **optimizer_args):
+    '''Builds a data-parallel step for an optimizer.
+
+    The cost and extra outputs must be means over the rows of the inputs, so
+    that the average of the shards weighted by their size is the value for
+    the batch. Extra updates (e.g., persistent chains) are made by each
+    replica on its own copy.
+
+    Args:
+        optimizer (function): optimizer from `utils.op`.
+        lr (T.scalar or list): learning rate(s).
+        tparams (OrderedDict): parameters.
+        grads (list): gradients of the parameters.
+        inp (list): inputs, split along the first axis.
+        cost (T.scalar): cost.
+        extra_ups (theano.OrderedUpdates): extra updates of the replicas.
+        extra_outs (list): extra outputs.
+        n_workers (int): number of processes, including this one.
+        guard (Optional[utils.op.StepGuard]): checks the averaged cost and
+            gradients.
+        **optimizer_args: extra arguments for the optimizer.
+
+    Returns:
+        DataParallel: step.
+        None: there is no separate update function.
+
+    '''
+    f_grads = theano.function(inp, [cost] + extra_outs + grads,
+                              updates=extra_ups)
+
+    cost_avg = theano.shared(np.cast[floatX](0.), name='cost_avg')
+    grads_avg = [theano.shared(p.get_value() * 0., name='%s_grad_avg' % k)
+                 for k, p in tparams.iteritems()]
+    optimizer_args['fused'] = True
+    f_update, _ = optimizer(lr, tparams, grads_avg, [], cost_avg,
+                            guard=guard, **optimizer_args)
+
+    f_step = DataParallel(f_grads, f_update, tparams.values(), cost_avg,
+                          grads_avg, len(inp), n_workers=n_workers)
+    return f_step, None
+
+
+class DataParallel(object):
+    '''Step that splits batches among worker processes.
+
+    Workers are forked on the first call, so the functions can be pickled
+    (e.g., in the function cache of `utils.training.set_functions`) until
+    then. Each worker reseeds the random streams of its replica.
+
+    Attributes:
+        f_grads (theano.function): computes the cost, extra outputs and
+            gradients of a shard.
+        f_update (theano.function): applies the update from `grads_avg`.
+            Takes the learning rate(s).
+        params (list): shared parameters.
+        cost_avg (theano.shared): averaged cost.
+        grads_avg (list): averaged gradients.
+        n_inputs (int): number of inputs.
+        n_workers (int): number of processes, including this one.
+
+    '''
+    def __init__(self, f_grads, f_update, params, cost_avg, grads_avg,
+                 n_inputs, n_workers=2):
+        '''Init function for DataParallel.
+
+        Args:
+            f_grads (theano.function): computes the cost, extra outputs and
+                gradients of a shard.
+            f_update (theano.function): applies the update.
+            params (list): shared parameters.
+            cost_avg (theano.shared): averaged cost, read by `f_update`.
+            grads_avg (list): averaged gradients, read by `f_update`.
+            n_inputs (int): number of inputs.
+            n_workers (int): number of processes, including this one.
+
+        '''
+        if n_workers < 1:
+            raise ValueError('n_workers must be at least 1 (got %d)'
+                             % n_workers)
+        self.f_grads = f_grads
+        self.f_update = f_update
+        self.params = params
+        self.cost_avg = cost_avg
+        self.grads_avg = grads_avg
+        self.n_inputs = n_inputs
+        self.n_workers = n_workers
+        self._workers = None
+
+    def __getstate__(self):
+        d = self.__dict__.copy()
+        for k in ['_workers', '_conns', '_param_bufs', '_grad_bufs']:
+            d.pop(k, None)
+        d['_workers'] = None
+        return d
+
+    def start(self):
+        '''Allocates the shared memory and forks the workers.
+
+        '''
+        if self._workers is not None:
+            return
+        self._param_bufs = [
+            _shared_array(p.get_value(borrow=True).shape, p.dtype)
+            for p in self.params]
+        self._grad_bufs = [
+            _shared_array((self.n_workers,) + g.get_value(borrow=True).shape,
+                          g.dtype)
+            for g in self.grads_avg]
+
+        self._workers = []
+        self._conns = []
+        for rank in xrange(1, self.n_workers):
+            conn, worker_conn = mp.Pipe()
+            worker = mp.Process(
+                target=self._work,
+                args=(rank, worker_conn, random.randint(0, 1000000)))
+            worker.daemon = True
+            worker.start()
+            worker_conn.close()
+            self._workers.append(worker)
+            self._conns.append(conn)
+
+    def close(self):
+        '''Stops the workers.
+
+        '''
+        if self._workers is None:
+            return
+        for conn in self._conns:
+            try:
+                conn.send(None)
+            except IOError:
+                pass
+        for worker in self._workers:
+            worker.join()
+        self._workers = None
+        self._conns = None
+
+    def _publish(self):
+        '''Copies the parameters to shared memory for the workers.
+
+        '''
+        for p, buf in zip(self.params, self._param_bufs):
+            buf[...] = p.get_value(borrow=True)
+
+    def _grads(self, rank, inps):
+        '''Computes the gradients of a shard and writes them for averaging.
+
+        '''
+        rval = self.f_grads(*inps)
+        n_outs = len(rval) - len(self._grad_bufs)
+        for buf, g in zip(self._grad_bufs, rval[n_outs:]):
+            buf[rank] = g
+        return rval[:n_outs]
+
+    def _work(self, rank, conn, seed):
+        '''Worker loop. Runs until `None` is received.
+
+        '''
+        # Interrupts are handled by the training process, which stops us.
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+        trng = RandomStreams(seed)
+        for v in self.f_grads.get_shared():
+            if getattr(v.tag, 'is_rng', False):
+                v.set_value(trng.get_substream_rstates(
+                    v.get_value(borrow=True).shape[0], floatX))
+
+        # The replica reads the published parameters in place.
+        for p, buf in zip(self.params, self._param_bufs):
+            p.set_value(buf, borrow=True)
+
+        while True:
+            inps = conn.recv()
+            if inps is None:
+                return
+            try:
+                rval = self._grads(rank, inps)
+            except Exception:
+                conn.send((False, traceback.format_exc()))
+            else:
+                conn.send((True, rval))
+
+    def __call__(self, *args):
+        '''Takes a step.
+
+        Args:
+            *args: inputs followed by the learning rate(s).
+
+        Returns:
+            list: cost and extra outputs, averaged over the batch.
+
+        '''
+        self.start()
+        self._publish()
+        inps = args[:self.n_inputs]
+        lr = args[self.n_inputs:]
+
+        # Shards as in `np.array_split`: the first ones are one row longer,
+        # so the first `k` processes have rows.
+        n = inps[0].shape[0]
+        k = min(n, self.n_workers)
+        sizes = np.array([n // self.n_workers + 1] * (n % self.n_workers)
+                         + [n // self.n_workers] * (k - n % self.n_workers))
+        bounds = np.concatenate([[0], np.cumsum(sizes)])
+        for rank in xrange(1, k):
+            self._conns[rank - 1].send(
+                [x[bounds[rank]:bounds[rank + 1]] for x in inps])
+
+        try:
+            rvals = [self._grads(0, [x[:bounds[1]] for x in inps])]
+        finally:
+            # Replies are always collected, so the next step starts clean.
+            replies = [self._conns[rank - 1].recv() for rank in xrange(1, k)]
+        for ok, rval in replies:
+            if not ok:
+                raise RuntimeError('Worker failed:\n%s' % rval)
+            rvals.append(rval)
+
+        weights = (sizes / float(n)).astype(floatX)
+        for g, buf in zip(self.grads_avg, self._grad_bufs):
+            g_avg = np.tensordot(weights, buf[:k], axes=1)
+            g.set_value(g_avg.astype(buf.dtype), borrow=True)
+        outs = [sum(w * np.asarray(r[i]) for w, r in zip(weights, rvals))
+                for i in xrange(len(rvals[0]))]
+        self.cost_avg.set_value(np.cast[floatX](outs[0]))
+
+        self.f_update(*lr)
+        return outs
@@ -0,0 +1,144 @@
+'''
+Profiling of training.
+
+Times the phases of training steps in `training.main_loop` and turns on the
+Theano profilers. Both can be set from the experiment yaml with a `profile`
+entry (see `set_profile`), e.g.:
+
+    profile: {
+      theano: True,
+      steps: True
+    }
+
+'''
+
+from collections import OrderedDict
+import numpy as np
+import theano
+import time
+
+
+# Default for `time_steps` in `training.main_loop`.
+time_steps = False
+
+def set_profile(profile):
+    '''Sets profiling for the run.
+
+    Must be called before the Theano functions are compiled. The Theano
+    function and scan profiles are printed when the process exits.
+
+    Args:
+        profile (bool or dict): if True, Theano functions and steps are
+            profiled. If a dict, the keys are
+            `theano` (bool): turns on the Theano function and scan profilers.
+            `memory` (bool): also profiles memory in Theano functions.
+            `steps` (bool): reports step timing in `training.main_loop`.
+
+    '''
+    global time_steps
+
+    if isinstance(profile, dict):
+        unknown = set(profile.keys()) - set(['theano', 'memory', 'steps'])
+        if len(unknown) > 0:
+            raise ValueError('Unknown profile options: %s' % sorted(unknown))
+        theano_profile = profile.get('theano', False)
+        memory = profile.get('memory', False)
+        steps = profile.get('steps', False)
+    else:
+        theano_profile = steps = bool(profile)
+        memory = False
+
+    if theano_profile or memory:
+        print 'Turning on Theano profiler'
+        theano.config.profile = True
+    if memory:
+        theano.config.profile_memory = True
+    time_steps = steps
+
+
+class StepTimer(object):
+    '''Times the phases of training steps.
+
+    Phases are timed with `lap`, which records the time since the previous
+    call to `lap` or `start`. Durations are kept until `reset`, and the phases
+    for good, so that summaries keep the same keys.
+
+    Attributes:
+        times (OrderedDict): lists of durations in seconds for each phase.
+        percentiles (list): percentiles for `summary`.
+
+    '''
+    def __init__(self, percentiles=(50, 90, 99), phases=()):
+        '''Init function for StepTimer.
+
+        Args:
+            percentiles (list): percentiles for `summary`.
+            phases (list): phases reported from the first summary, even if
+                not timed yet.
+
+        '''
+        self.percentiles = percentiles
+        self.times = OrderedDict((k, []) for k in phases)
+        self._t = time.time()
+
+    def start(self):
+        '''Starts timing the next phase.
+
+        '''
+        self._t = time.time()
+
+    def lap(self, phase):
+        '''Records the time since the last lap for a phase.
+
+        Args:
+            phase (str): name of the phase.
+
+        '''
+        t = time.time()
+        if phase in self.times:
+            self.times[phase].append(t - self._t)
+        else:
+            self.times[phase] = [t - self._t]
+        self._t = t
+
+    def reset(self):
+        self.times = OrderedDict((k, []) for k in self.times)
+        self._t = time.time()
+
+    def summary(self):
+        '''Summary of the recorded durations in milliseconds.
+
+        Every phase reports the same percentiles (e.g., `time_fetch_p50`),
+        however many times it was timed, so the keys do not change between
+        summaries. Phases not timed since the last `reset` report 0.
+
+        Returns:
+            OrderedDict: durations in milliseconds.
+
+        '''
+        summary = OrderedDict()
+        for phase, times in self.times.iteritems():
+            ps = np.percentile(times or [0.], self.percentiles)
+            for q, p in zip(self.percentiles, ps):
+                summary['time_%s_p%d' % (phase, q)] = 1000. * p
+        return summary
+
+    def display(self):
+        '''Prints the total time and percentiles of each phase.
+
+        '''
+        total = sum(sum(v) for v in self.times.values())
+        if total == 0:
+            return
+        print 'Time per phase (ms):'
+        header = '\t%-10s | %8s | %6s' % ('phase', 'total', '%')
+        header += ''.join(' | %8s' % ('p%d' % q) for q in self.percentiles)
+        print header
+        for phase, times in self.times.iteritems():
+            if len(times) == 0:
+                continue
+            s = '\t%-10s | %8.1f | %6.2f' % (
+                phase, 1000. * sum(times), 100. * sum(times) / total)
+            ps = np.percentile(times, self.percentiles)
+            s += ''.join(' | %8.3f' % (1000. * p) for p in ps)
+            print s
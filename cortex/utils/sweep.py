@@ -0,0 +1,375 @@
+'''
+Hyperparameter sweeps.
+
+Runs trials of a demo train script from a base experiment yaml and a sweep
+yaml on local processes, at most `n_jobs` at a time. The script, theano and
+the datasets are loaded once: each trial is forked from the sweep process,
+and trials with the same dataset arguments share one memory-mapped copy of
+the data (see `datasets.share_data`). Trials can also share compiled
+functions with a function cache (`-c`, see `training.set_functions`).
+
+Try with
+`python -m cortex.utils.sweep cortex.demos.demos_basic.vae vae_mnist.yaml sweep.yaml -j 4`.
+
+Keys of the sweep yaml are paths in the experiment, separated by dots. A
+`grid` takes lists of values, and `random` takes distributions sampled
+`n_trials` times (or for each point of the grid, if there is one too):
+
+    {
+      grid: {
+        dim_h: [100, 200]
+      },
+      n_trials: 4,
+      random: {
+        learning_args.learning_rate: {log_uniform: [0.00001, 0.01]},
+        learning_args.optimizer: {choice: ['adam', 'rmsprop']}
+      }
+    }
+
+The distributions are `uniform`, `log_uniform`, `randint` (high excluded)
+and `choice`. Each trial is saved in its own directory under the sweep
+directory, with its log, parameters and monitor output. The last validation
+results of every trial are collected in `summary.tsv`.
+
+'''
+
+import argparse
+from collections import OrderedDict
+import copy
+import importlib
+import itertools
+import multiprocessing as mp
+import numpy as np
+import os
+from os import path
+import pprint
+import sys
+import time
+import traceback
+import yaml
+
+from ..datasets import share_data
+from .monitor import read_log
+from .tools import load_experiment, print_section, resolve_path
+from .training import set_experiment
+
+
+distributions = ['uniform', 'log_uniform', 'randint', 'choice']
+
+def set_value(d, key, value):
+    '''Sets a value in nested dictionaries.
+
+    Args:
+        d (dict): dictionary.
+        key (str): keys separated by dots, e.g., `learning_args.epochs`.
+        value: value.
+
+    '''
+    keys = key.split('.')
+    for k in keys[:-1]:
+        if d.get(k, None) is None:
+            d[k] = dict()
+        d = d[k]
+    d[keys[-1]] = value
+
+def sample(spec, rng):
+    '''Samples a value from a distribution of the sweep yaml.
+
+    Args:
+        spec (dict or list): dictionary with one distribution (see
+            `distributions`) or a list of values to choose from.
+        rng (numpy.random.RandomState).
+
+    Returns:
+        sampled value.
+
+    '''
+    if isinstance(spec, list):
+        spec = dict(choice=spec)
+    if not isinstance(spec, dict) or len(spec) != 1:
+        raise ValueError('Bad distribution: %r' % spec)
+    distribution, args = spec.items()[0]
+
+    if distribution == 'uniform':
+        return float(rng.uniform(*args))
+    elif distribution == 'log_uniform':
+        return float(np.exp(rng.uniform(np.log(args[0]), np.log(args[1]))))
+    elif distribution == 'randint':
+        return int(rng.randint(*args))
+    elif distribution == 'choice':
+        return args[rng.randint(len(args))]
+    else:
+        raise ValueError('Unknown distribution %s (%s)'
+                         % (distribution, distributions))
+
+def make_trials(sweep, rng=None):
+    '''Makes the parameters of the trials.
+
+    Args:
+        sweep (dict): sweep spec with `grid` and / or `random` and
+            `n_trials`.
+        rng (Optional[numpy.random.RandomState]).
+
+    Returns:
+        list: OrderedDict of parameters for each trial.
+
+    '''
+    if rng is None:
+        rng = np.random.RandomState()
+    unknown = set(sweep.keys()) - set(['grid', 'random', 'n_trials'])
+    if len(unknown) > 0:
+        raise ValueError('Unknown sweep options: %s' % sorted(unknown))
+
+    grid = sweep.get('grid', None) or dict()
+    keys = sorted(grid.keys())
+    points = [OrderedDict(zip(keys, values))
+              for values in itertools.product(*[grid[k] for k in keys])]
+
+    random_spec = sweep.get('random', None)
+    if random_spec is None:
+        return points
+
+    n_trials = sweep.get('n_trials', 1)
+    keys = sorted(random_spec.keys())
+    trials = []
+    for point in points:
+        for _ in xrange(n_trials):
+            trial = OrderedDict(point)
+            for k in keys:
+                trial[k] = sample(random_spec[k], rng)
+            trials.append(trial)
+    return trials
+
+def _run_trial(script, experiment, name, out_path, params, function_cache):
+    '''Runs a trial in a child process, with its output in `log.txt`.
+
+    '''
+    trial_path = path.join(out_path, name)
+    if not path.isdir(trial_path):
+        os.makedirs(trial_path)
+    # Appends, so that Python and C output share the file.
+    log = open(path.join(trial_path, 'log.txt'), 'a', 1)
+    os.dup2(log.fileno(), 1)
+    os.dup2(log.fileno(), 2)
+    sys.stdout = sys.stderr = log
+
+    try:
+        module = importlib.import_module(script)
+        exp_dict = set_experiment(dict(
+            experiment=experiment, name=name, out_path=out_path,
+            function_cache=function_cache))
+        for k, v in params.iteritems():
+            set_value(exp_dict, k, v)
+        with open(path.join(trial_path, 'sweep_params.yaml'), 'w') as f:
+            yaml.dump(dict(params), f, default_flow_style=False)
+        print 'Sweep parameters: %s' % pprint.pformat(dict(params))
+        module.train(**exp_dict)
+    except BaseException:
+        traceback.print_exc()
+        sys.stdout.flush()
+        os._exit(1)
+
+def summarize(trials, out_path):
+    '''Collects the last validation results of the trials.
+
+    Args:
+        trials (list): tuples of trial name, parameters and status.
+        out_path (str): sweep directory.
+
+    Returns:
+        list: OrderedDict row for each trial.
+
+    '''
+    rows = []
+    for name, params, status in trials:
+        row = OrderedDict(trial=name)
+        row.update(params)
+        row['status'] = status
+
+        trial_path = path.join(out_path, name)
+        log_file = path.join(trial_path, 'stats.jsonl')
+        valid_file = path.join(trial_path, 'stats_valid.npz')
+        if path.isfile(log_file):
+            _, d_valid = read_log(log_file)
+        elif path.isfile(valid_file):
+            d_valid = dict(np.load(valid_file))
+        else:
+            d_valid = dict()
+
+        row['epochs'] = max([len(v) for v in d_valid.values()] or [0])
+        for k in sorted(d_valid.keys()):
+            if len(d_valid[k]) > 0:
+                row[k] = np.asarray(d_valid[k][-1]).mean()
+        rows.append(row)
+    return rows
+
+def format_table(rows, sep=' | ', align=True):
+    '''Formats rows as a table.
+
+    Args:
+        rows (list): OrderedDict for each row. Missing values are left blank.
+        sep (str): column separator.
+        align (bool): if True, columns are padded to the same width.
+
+    Returns:
+        list: lines of the table, starting with the header.
+
+    '''
+    columns = []
+    for row in rows:
+        columns += [k for k in row.keys() if k not in columns]
+
+    def fmt(v):
+        if v is None:
+            return ''
+        if isinstance(v, float):
+            return '%.5g' % v
+        return str(v)
+
+    cells = [columns] + [[fmt(row.get(k, None)) for k in columns]
+                         for row in rows]
+    if not align:
+        return [sep.join(cs) for cs in cells]
+    widths = [max(len(c[i]) for c in cells) for i in xrange(len(columns))]
+    return [sep.join(c.ljust(w) for c, w in zip(cs, widths)).rstrip(' ')
+            for cs in cells]
+
+def run_sweep(script, experiment, sweep, out_path=None, name=None, n_jobs=1,
+              function_cache=None, share=True, seed=None, sort_key=None):
+    '''Runs a sweep.
+
+    Args:
+        script (str): module of the train script, e.g.,
+            `cortex.demos.demos_basic.vae`. It must have a `train` function
+            that takes the experiment arguments.
+        experiment (str): path to the base experiment yaml.
+        sweep (str or dict): path to the sweep yaml, or the sweep spec.
+        out_path (Optional[str]): directory for the sweep directory.
+            Defaults to `$outs`.
+        name (Optional[str]): name of the sweep. Defaults to the name of the
+            experiment followed by `_sweep`. Trials are named after it.
+        n_jobs (int): maximum number of trials running at the same time.
+        function_cache (Optional[str]): directory for caching compiled
+            functions.
+        share (bool): if True, datasets are loaded once for all trials.
+        seed (Optional[int]): seed for random search.
+        sort_key (Optional[str]): validation result to sort the summary by.
+
+    Returns:
+        list: summary rows, see `summarize`.
+
+    '''
+    experiment = path.abspath(experiment)
+    exp_dict = load_experiment(experiment)
+    if not isinstance(sweep, dict):
+        sweep = load_experiment(sweep)
+    trials = make_trials(sweep, rng=np.random.RandomState(seed))
+    if len(trials) == 0:
+        raise ValueError('Sweep has no trials.')
+
+    if name is None:
+        name = exp_dict.get('name', 'sweep') + '_sweep'
+    if out_path is None:
+        out_path = resolve_path('$outs')
+    out_path = path.join(out_path, name)
+    if not path.isdir(out_path):
+        os.makedirs(out_path)
+
+    # Loads the script once, before forking.
+    importlib.import_module(script)
+
+    if share:
+        print_section('Sharing datasets')
+        shared = []
+        for params in trials:
+            trial_dict = copy.deepcopy(exp_dict)
+            for k, v in params.iteritems():
+                set_value(trial_dict, k, v)
+            dataset_args = trial_dict.get('dataset_args', None)
+            if dataset_args is not None and dataset_args not in shared:
+                share_data(path.join(out_path, 'data'), **dataset_args)
+                shared.append(dataset_args)
+
+    print_section('Running %d trials (%d at a time) in %s'
+                  % (len(trials), n_jobs, out_path))
+    names = ['%s_%03d' % (name, i) for i in xrange(len(trials))]
+    pending = range(len(trials))
+    running = OrderedDict()
+    status = dict()
+    try:
+        while len(pending) > 0 or len(running) > 0:
+            while len(pending) > 0 and len(running) < n_jobs:
+                i = pending.pop(0)
+                p = mp.Process(
+                    target=_run_trial,
+                    args=(script, experiment, names[i], out_path, trials[i],
+                          function_cache))
+                p.start()
+                running[i] = (p, time.time())
+                print 'Started %s: %s' % (names[i], dict(trials[i]))
+
+            time.sleep(0.1)
+            for i, (p, t0) in running.items():
+                if p.is_alive():
+                    continue
+                p.join()
+                del running[i]
+                status[i] = 'done' if p.exitcode == 0 else 'failed'
+                print '[%d/%d] %s %s (%.1fs)' % (
+                    len(status), len(trials), names[i], status[i],
+                    time.time() - t0)
+    except KeyboardInterrupt:
+        print 'Sweep interrupted.'
+        for i, (p, _) in running.items():
+            p.terminate()
+            p.join()
+            status[i] = 'interrupted'
+
+    rows = summarize(
+        [(names[i], trials[i], status.get(i, 'not run'))
+         for i in xrange(len(trials))], out_path)
+    if sort_key is not None:
+        rows.sort(key=lambda row: row.get(sort_key, float('inf')))
+
+    lines = format_table(rows)
+    with open(path.join(out_path, 'summary.tsv'), 'w') as f:
+        for line in format_table(rows, sep='\t', align=False):
+            f.write(line + '\n')
+    print_section('Summary')
+    for line in lines:
+        print line
+
+    return rows
+
+def make_argument_parser():
+    '''Parser for sweeps.
+
+    Returns:
+        argparse.parser
+
+    '''
+    parser = argparse.ArgumentParser()
+    parser.add_argument('script',
+                        help='Module of the train script, e.g., '
+                        'cortex.demos.demos_basic.vae')
+    parser.add_argument('experiment', help='Base experiment yaml')
+    parser.add_argument('sweep', help='Sweep yaml')
+    parser.add_argument('-o', '--out_path', default=None,
+                        help='Output path for the sweep directory')
+    parser.add_argument('-n', '--name', default=None)
+    parser.add_argument('-j', '--n_jobs', type=int, default=1,
+                        help='Maximum number of trials running at once')
+    parser.add_argument('-c', '--function_cache', default=None,
+                        help='Directory for caching compiled functions')
+    parser.add_argument('-s', '--seed', type=int, default=None,
+                        help='Seed for random search')
+    parser.add_argument('-k', '--sort_key', default=None,
+                        help='Validation result to sort the summary by')
+    parser.add_argument('--no_share', dest='share', action='store_false',
+                        help='Load datasets in each trial')
+    return parser
+
+if __name__ == '__main__':
+    parser = make_argument_parser()
+    args = parser.parse_args()
+    run_sweep(**vars(args))
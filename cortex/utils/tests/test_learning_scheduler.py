@@ -0,0 +1,82 @@
+'''
+Tests for learning rate scheduling and early stopping.
+'''
+
+import numpy as np
+
+from cortex.datasets import BasicDataset
+from cortex.utils import floatX
+from cortex.utils import training
+from cortex.utils.learning_scheduler import (
+    EarlyStopping,
+    ReduceOnPlateau,
+    Scheduler,
+    make_stopping
+)
+
+
+def test_early_stopping():
+    stopping = EarlyStopping(patience=2, min_delta=0.1, min_epochs=3)
+    stops = [stopping(v, e) for e, v in enumerate([5., 4., 3.95, 3.9, 3.5,
+                                                   3.45, 3.42])]
+    assert stops == [False, False, False, True, False, False, True]
+
+    stopping = make_stopping(dict(criterion='target', target=1.))
+    assert not stopping(1.5, 0) and stopping(0.5, 1)
+    assert isinstance(make_stopping('patience'), EarlyStopping)
+    assert make_stopping(None) is None
+    try:
+        make_stopping(dict(criterion='never'))
+    except ValueError:
+        pass
+    else:
+        assert False, 'Unknown criterion was not caught.'
+
+def test_reduce_on_plateau():
+    plateau = ReduceOnPlateau(factor=0.5, patience=2, cooldown=1,
+                              min_learning_rate=0.2)
+    lrs = []
+    lr = 1.
+    for v in [3., 2., 2., 2., 2., 2., 2., 2., 2., 2.]:
+        lr = plateau(lr, v)
+        lrs.append(lr)
+    assert lrs == [1., 1., 1., 0.5, 0.5, 0.5, 0.25, 0.25, 0.25, 0.2]
+
+def test_scheduler():
+    scheduler = Scheduler(
+        verbose=False, plateau=dict(factor=0.1, patience=1),
+        gen=dict(learning_rate=0.1, decay_rate=0.5),
+        rec=dict(learning_rate=0.2, plateau=dict(factor=0.5, patience=1)))
+    scheduler(1)
+    assert np.allclose(scheduler['gen']['learning_rate'], 0.05)
+    assert np.allclose(scheduler['rec']['learning_rate'], 0.2)
+    scheduler.update_valid(1.)
+    scheduler.update_valid(1.)
+    assert np.allclose(scheduler['gen']['learning_rate'], 0.005)
+    assert np.allclose(scheduler['rec']['learning_rate'], 0.1)
+
+def test_main_loop(epochs=20, patience=3):
+    X = np.arange(60).reshape((20, 3)).astype(floatX)
+    Y = np.zeros((20,), dtype=floatX)
+    train = BasicDataset({'x': X, 'label': Y}, name='x', batch_size=5)
+    valid = BasicDataset({'x': X, 'label': Y}, name='x', batch_size=5)
+    learning_rates = []
+
+    def f_grad_shared(x, lr):
+        learning_rates.append(lr)
+        return [x.mean()]
+
+    def f_test(x):
+        return [x.mean()]
+
+    training.main_loop(
+        train, valid, None, f_grad_shared, None, f_test, ['cost'],
+        epochs=epochs, learning_rate=0.1, extra_outs_keys=['cost'],
+        valid_key='cost', test_train=False, prefetch=0, async_save=False,
+        reduce_on_plateau=dict(factor=0.5, patience=1, min_delta=1e-3),
+        early_stopping=dict(patience=patience, min_delta=1e-3))
+
+    # Validation does not improve after the first test, up to rounding.
+    steps = (patience + 1) * 4
+    assert len(learning_rates) == steps
+    assert np.allclose(learning_rates[::4], [0.1, 0.1, 0.05, 0.025])
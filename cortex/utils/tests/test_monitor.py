@@ -0,0 +1,62 @@
+'''
+Tests for monitors.
+'''
+
+import os
+from os import path
+import shutil
+import tempfile
+
+from cortex.utils import monitor as monitor_module
+from cortex.utils.monitor import StreamingMonitor, read_log
+
+
+def test_streaming_monitor(epochs=25):
+    out_path = tempfile.mkdtemp()
+    try:
+        log_file = path.join(out_path, 'stats.jsonl')
+        monitor = StreamingMonitor(log_file, plot_every=None)
+        for e in xrange(epochs):
+            monitor.update(cost=1. / (e + 1), error=0.5 - 0.01 * e)
+            monitor.update(dt_epoch=0.1 * e)
+            monitor.update_valid(cost=2. / (e + 1), error=0.6 - 0.01 * e)
+
+        # Readable while the log is open.
+        d, d_valid = read_log(log_file)
+        assert d.keys() == monitor.d.keys()
+        for k, v in monitor.d.iteritems():
+            assert d[k] == v
+        for k, v in monitor.d_valid.iteritems():
+            assert d_valid[k] == v
+
+        # Three records per epoch: the last 4 are the last two epochs but the
+        # first two training records.
+        d, d_valid = read_log(log_file, tail=4)
+        assert d_valid['cost'] == monitor.d_valid['cost'][-2:]
+        assert d['cost'] == monitor.d['cost'][-1:]
+        assert d['dt_epoch'] == monitor.d['dt_epoch'][-1:]
+
+        # A partially written record is skipped.
+        with open(log_file, 'ab') as f:
+            f.write('{"_split": "valid", "cost"')
+        d, d_valid = read_log(log_file)
+        assert len(d_valid['cost']) == epochs
+        d, d_valid = read_log(log_file, tail=1)
+        assert len(d_valid) == 0 and len(d) == 0
+
+        assert not monitor.needs_save()
+        monitor.save_stats(path.join(out_path, 'stats_train.npz'))
+        monitor.save(path.join(out_path, 'monitor.png'))
+        monitor.close()
+        assert os.listdir(out_path) == ['stats.jsonl']
+    finally:
+        shutil.rmtree(out_path)
+
+def test_tail_lines(n=100, block_size=7):
+    f = tempfile.TemporaryFile()
+    lines = ['line %d' % i for i in xrange(n)]
+    f.write('\n'.join(lines) + '\n')
+    for tail in [0, 1, 3, n, n + 5]:
+        assert (monitor_module._tail_lines(f, tail, block_size=block_size)
+                == lines[max(n - tail, 0):])
+    f.close()
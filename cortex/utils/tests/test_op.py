@@ -0,0 +1,125 @@
+'''
+Tests for optimizers.
+'''
+
+from collections import OrderedDict
+import numpy as np
+import theano
+from theano import tensor as T
+
+from cortex.utils import floatX
+from cortex.utils import op
+from cortex.utils.tools import itemlist
+
+
+def run_optimizer(optimizer, fused, X, lr=0.01, steps=5, dim_h=4):
+    rng = np.random.RandomState(0)
+    tparams = OrderedDict()
+    tparams['W'] = theano.shared(
+        rng.normal(size=(X.shape[1], dim_h)).astype(floatX), name='W')
+    tparams['b'] = theano.shared(np.zeros((dim_h,), dtype=floatX), name='b')
+    count = theano.shared(np.float32(0.), name='count')
+
+    x = T.matrix('x', dtype=floatX)
+    cost = (T.tanh(T.dot(x, tparams['W']) + tparams['b']) ** 2).mean()
+    grads = T.grad(cost, wrt=itemlist(tparams))
+    lr_ = T.scalar('lr', dtype=floatX)
+    extra_ups = theano.OrderedUpdates([(count, count + 1)])
+
+    f_grad_shared, f_update = getattr(op, optimizer)(
+        lr_, tparams, grads, [x], cost, extra_ups=extra_ups,
+        extra_outs=[cost * 2], fused=fused)
+
+    costs = []
+    for s in xrange(steps):
+        if fused:
+            assert f_update is None
+            rval = f_grad_shared(X, lr)
+        else:
+            rval = f_grad_shared(X)
+            f_update(lr)
+        assert np.allclose(rval[1], 2 * rval[0])
+        costs.append(rval[0])
+
+    assert count.get_value() == steps
+    return costs, dict((k, v.get_value()) for k, v in tparams.iteritems())
+
+def test_fused(optimizers=['sgd', 'adam', 'adam2', 'adam3', 'adadelta',
+                           'rmsprop', 'rmsprop2']):
+    X = np.random.RandomState(1).normal(size=(11, 3)).astype(floatX)
+    for optimizer in optimizers:
+        costs, params = run_optimizer(optimizer, True, X)
+        costs_, params_ = run_optimizer(optimizer, False, X)
+        assert np.allclose(costs, costs_, atol=1e-6), optimizer
+        for k in params.keys():
+            assert np.allclose(params[k], params_[k], atol=1e-5), (optimizer, k)
+
+def make_guarded(optimizer, fused, policy, dim_in=3, dim_h=4):
+    rng = np.random.RandomState(0)
+    tparams = OrderedDict()
+    tparams['W'] = theano.shared(
+        rng.normal(size=(dim_in, dim_h)).astype(floatX), name='W')
+    tparams['b'] = theano.shared(np.zeros((dim_h,), dtype=floatX), name='b')
+
+    x = T.matrix('x', dtype=floatX)
+    cost = (T.tanh(T.dot(x, tparams['W']) + tparams['b']) ** 2).mean()
+    grads = T.grad(cost, wrt=itemlist(tparams))
+    lr = T.scalar('lr', dtype=floatX)
+    guard = op.StepGuard(policy=policy)
+    f_grad_shared, f_update = getattr(op, optimizer)(
+        lr, tparams, grads, [x], cost, fused=fused, guard=guard)
+
+    def step(X):
+        if fused:
+            f_grad_shared(X, 0.1)
+        else:
+            f_grad_shared(X)
+            f_update(0.1)
+
+    return tparams, guard, step
+
+def test_guard(optimizers=['sgd', 'adam', 'rmsprop']):
+    X = np.random.RandomState(1).normal(size=(11, 3)).astype(floatX)
+    X_bad = X.copy()
+    X_bad[0, 0] = np.nan
+
+    for optimizer in optimizers:
+        for fused in [True, False]:
+            tparams, guard, step = make_guarded(optimizer, fused, 'skip')
+            guard.reset()
+            step(X)
+            W = tparams['W'].get_value()
+            step(X_bad)
+            assert np.all(tparams['W'].get_value() == W), (optimizer, fused)
+            assert guard.n_bad.get_value() == 1
+            assert guard.check()
+            step(X)
+            assert np.all(np.isfinite(tparams['W'].get_value()))
+            assert not np.all(tparams['W'].get_value() == W)
+
+            tparams, guard, step = make_guarded(optimizer, fused, 'rollback')
+            guard.reset()
+            step(X)
+            assert guard.check()
+            W = tparams['W'].get_value()
+            step(X)
+            step(X_bad)
+            assert not np.all(np.isfinite(tparams['W'].get_value()))
+            assert guard.check()
+            assert np.all(tparams['W'].get_value() == W), (optimizer, fused)
+
+            tparams, guard, step = make_guarded(optimizer, fused, 'abort')
+            guard.reset()
+            step(X)
+            assert guard.check()
+            step(X_bad)
+            assert not guard.check()
+
+def test_guard_args():
+    for kwargs in [dict(policy='ignore'), dict(check_every=0)]:
+        try:
+            op.StepGuard(**kwargs)
+        except ValueError:
+            pass
+        else:
+            assert False, kwargs
@@ -0,0 +1,87 @@
+'''
+Tests for data-parallel training.
+'''
+
+from collections import OrderedDict
+import cPickle
+import numpy as np
+import theano
+from theano import tensor as T
+
+from cortex.utils import floatX
+from cortex.utils import op
+from cortex.utils.parallel import data_parallel
+from cortex.utils.tools import itemlist
+
+
+def make_step(optimizer, n_workers, dim_in=3, dim_h=4, guard=None):
+    rng = np.random.RandomState(0)
+    tparams = OrderedDict()
+    tparams['W'] = theano.shared(
+        rng.normal(size=(dim_in, dim_h)).astype(floatX), name='W')
+    tparams['b'] = theano.shared(np.zeros((dim_h,), dtype=floatX), name='b')
+
+    x = T.matrix('x', dtype=floatX)
+    y = T.tanh(T.dot(x, tparams['W']) + tparams['b'])
+    cost = (y ** 2).mean()
+    grads = T.grad(cost, wrt=itemlist(tparams))
+    lr = T.scalar('lr', dtype=floatX)
+    extra_outs = [abs(y).mean()]
+
+    if n_workers is None:
+        f_step, _ = getattr(op, optimizer)(
+            lr, tparams, grads, [x], cost, extra_outs=extra_outs,
+            guard=guard)
+    else:
+        f_step, _ = data_parallel(
+            getattr(op, optimizer), lr, tparams, grads, [x], cost,
+            extra_outs=extra_outs, n_workers=n_workers, guard=guard)
+    return tparams, f_step
+
+def test_data_parallel(optimizers=['sgd', 'adam'], steps=4):
+    X = np.random.RandomState(1).normal(size=(11, 3)).astype(floatX)
+    for optimizer in optimizers:
+        tparams, f_step = make_step(optimizer, None)
+        rvals = [f_step(X, 0.1) for s in xrange(steps)]
+
+        for n_workers in [2, 3]:
+            tparams_, f_step_ = make_step(optimizer, n_workers)
+            # Pickles before the workers are started, as in the cache.
+            f_step_ = cPickle.loads(cPickle.dumps(f_step_, protocol=-1))
+            try:
+                rvals_ = [f_step_(X, 0.1) for s in xrange(steps)]
+                # Shorter batch than the number of workers.
+                f_step_(X[:1], 0.)
+            finally:
+                f_step_.close()
+            assert np.allclose(rvals, rvals_, atol=1e-5), (optimizer, n_workers)
+            for p, p_ in zip(f_step_.params, tparams.values()):
+                assert np.allclose(p.get_value(), p_.get_value(), atol=1e-5), (
+                    optimizer, n_workers, p.name)
+
+def test_rollback(optimizer='adam', n_workers=2):
+    X = np.random.RandomState(1).normal(size=(11, 3)).astype(floatX)
+    X_bad = X.copy()
+    X_bad[-1, 0] = np.nan # In the shard of the last worker.
+
+    guard = op.StepGuard(policy='rollback')
+    tparams, f_step = make_step(optimizer, n_workers, guard=guard)
+    try:
+        guard.reset()
+        f_step(X, 0.1)
+        assert guard.check()
+        W = tparams['W'].get_value()
+        f_step(X_bad, 0.1)
+        assert not np.all(np.isfinite(tparams['W'].get_value()))
+        assert guard.check()
+        assert np.all(tparams['W'].get_value() == W)
+
+        # The workers start again from the restored parameters.
+        cost = f_step(X, 0.1)[0]
+        assert np.isfinite(cost)
+        assert guard.check()
+        assert guard.n_bad.get_value() == 1
+        assert np.all(np.isfinite(tparams['W'].get_value()))
+        assert not np.all(tparams['W'].get_value() == W)
+    finally:
+        f_step.close()
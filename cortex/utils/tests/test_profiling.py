@@ -0,0 +1,99 @@
+'''
+Tests for profiling.
+'''
+
+import numpy as np
+import shutil
+import tempfile
+import theano
+import time
+
+from cortex.datasets import BasicDataset
+from cortex.utils import floatX
+from cortex.utils import profiling
+from cortex.utils import training
+from cortex.utils.monitor import SimpleMonitor
+
+
+def test_step_timer(steps=20):
+    timer = profiling.StepTimer(percentiles=(50, 90))
+    for s in xrange(steps):
+        timer.lap('fetch')
+        time.sleep(0.001)
+        timer.lap('grad')
+    timer.lap('test')
+
+    summary = timer.summary()
+    keys = ['time_fetch_p50', 'time_fetch_p90', 'time_grad_p50',
+            'time_grad_p90', 'time_test_p50', 'time_test_p90']
+    assert summary.keys() == keys
+    assert summary['time_grad_p50'] >= 1.
+    assert summary['time_fetch_p50'] < summary['time_grad_p50']
+
+    # Keys do not depend on how many times phases were timed.
+    timer.reset()
+    timer.lap('test')
+    timer.lap('test')
+    summary = timer.summary()
+    assert summary.keys() == keys
+    assert summary['time_grad_p50'] == 0.
+    timer.display()
+
+def test_set_profile():
+    profile = theano.config.profile
+    time_steps = profiling.time_steps
+    try:
+        profiling.set_profile(dict(steps=True))
+        assert profiling.time_steps and not theano.config.profile
+        profiling.set_profile(False)
+        assert not profiling.time_steps
+        try:
+            profiling.set_profile(dict(step=True))
+        except ValueError:
+            pass
+        else:
+            assert False, 'Unknown option was not caught.'
+    finally:
+        theano.config.profile = profile
+        profiling.time_steps = time_steps
+
+def test_main_loop(epochs=3):
+    X = np.arange(60).reshape((20, 3)).astype(floatX)
+    Y = np.zeros((20,), dtype=floatX)
+    train = BasicDataset({'x': X, 'label': Y}, name='x', batch_size=5)
+    valid = BasicDataset({'x': X, 'label': Y}, name='x', batch_size=5)
+    monitor = SimpleMonitor()
+    out_path = tempfile.mkdtemp()
+
+    def f_grad_shared(x, lr):
+        return [x.mean()]
+
+    def f_test(x):
+        return [x.mean()]
+
+    images = []
+
+    def save_images():
+        images.append(len(monitor.d.get('dt_epoch', [])))
+
+    try:
+        training.main_loop(
+            train, valid, None, f_grad_shared, None, f_test, ['cost'],
+            epochs=epochs, learning_rate=0.1, monitor=monitor,
+            extra_outs_keys=['cost'], valid_key='cost', time_steps=True,
+            save_images=save_images, show_every=2, out_path=out_path,
+            async_save=False)
+    finally:
+        shutil.rmtree(out_path)
+
+    # Every phase is in every summary, including the first.
+    n = len(monitor.d['dt_epoch'])
+    assert n == epochs + 1
+    for k in ['time_fetch_p50', 'time_grad_p99', 'time_check_p90',
+              'time_test_p50', 'time_save_p50', 'time_images_p50']:
+        assert len(monitor.d[k]) == n, k
+    assert 'time_update_p50' not in monitor.d.keys()
+    # Images are timed in the epoch where they are saved.
+    assert images == [2, 4]
+    images_ms = monitor.d['time_images_p50']
+    assert images_ms[0] == 0. and images_ms[2] == 0.
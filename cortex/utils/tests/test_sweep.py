@@ -0,0 +1,51 @@
+'''
+Tests for sweeps.
+'''
+
+import numpy as np
+
+from cortex.utils import sweep
+
+
+def test_make_trials(n_trials=5):
+    spec = dict(grid={'dim_h': [10, 20, 30], 'learning_args.epochs': [1, 2]})
+    trials = sweep.make_trials(spec)
+    assert len(trials) == 6
+    assert trials[0].keys() == ['dim_h', 'learning_args.epochs']
+    assert len(set(tuple(t.values()) for t in trials)) == 6
+
+    spec['n_trials'] = n_trials
+    spec['random'] = {
+        'learning_args.learning_rate': {'log_uniform': [1e-5, 1e-2]},
+        'learning_args.optimizer': ['adam', 'rmsprop'],
+        'dim_z': {'randint': [2, 4]}}
+    trials = sweep.make_trials(spec, rng=np.random.RandomState(0))
+    assert len(trials) == 6 * n_trials
+    for t in trials:
+        assert 1e-5 <= t['learning_args.learning_rate'] <= 1e-2
+        assert t['learning_args.optimizer'] in ['adam', 'rmsprop']
+        assert t['dim_z'] in [2, 3]
+
+    try:
+        sweep.make_trials(dict(grids=dict(dim_h=[10])))
+    except ValueError:
+        pass
+    else:
+        assert False, 'Unknown option was not caught.'
+
+def test_set_value():
+    d = dict(learning_args=dict(epochs=10), dim_h=5)
+    sweep.set_value(d, 'learning_args.learning_rate', 0.1)
+    sweep.set_value(d, 'dataset_args.stop', 100)
+    sweep.set_value(d, 'dim_h', 6)
+    assert d == dict(learning_args=dict(epochs=10, learning_rate=0.1),
+                     dataset_args=dict(stop=100), dim_h=6)
+
+def test_format_table():
+    rows = [sweep.OrderedDict([('trial', 'a'), ('cost', 1.)]),
+            sweep.OrderedDict([('trial', 'bb'), ('error', 0.123456789)])]
+    assert sweep.format_table(rows) == ['trial | cost | error',
+                                        'a     | 1    |',
+                                        'bb    |      | 0.12346']
+    assert sweep.format_table(rows, sep='\t', align=False) == [
+        'trial\tcost\terror', 'a\t1\t', 'bb\t\t0.12346']
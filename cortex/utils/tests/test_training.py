@@ -0,0 +1,129 @@
+'''
+Tests for training utilities.
+'''
+
+from collections import OrderedDict
+import numpy as np
+import os
+from os import path
+import shutil
+import tempfile
+import theano
+from theano import tensor as T
+
+from cortex.datasets import BasicDataset
+from cortex.datasets.prefetch import PrefetchDataset
+from cortex.utils import floatX
+from cortex.utils import training
+
+
+def make_dataset(n=50, dim=3, batch_size=7, **kwargs):
+    X = np.arange(n * dim).reshape((n, dim)).astype(floatX)
+    Y = (np.arange(n) % 3).astype(floatX)
+    return BasicDataset({'x': X, 'label': Y}, name='x', batch_size=batch_size,
+                        shuffle=False, **kwargs)
+
+def f_test(x):
+    return [x[:, 0].mean(), x.sum(axis=1), np.float32(x.shape[0])]
+
+def test_test(batch_size=7):
+    data_iter = make_dataset(batch_size=batch_size)
+    keys = ['mean', 'sum', 'size']
+    X = data_iter.X
+    n_last = data_iter.n % batch_size
+
+    # The short last batch is tested, and weighted by its size.
+    results = training.test(data_iter, f_test, keys, ['x'])
+    assert results.keys() == keys
+    assert np.allclose(results['mean'], X[:, 0].mean())
+    assert np.allclose(results['sum'], X.sum(axis=1).mean())
+    assert np.allclose(results['size'], (
+        (data_iter.n - n_last) * batch_size + n_last ** 2)
+        / float(data_iter.n))
+    assert data_iter.drop_last
+
+    results = training.test(data_iter, f_test, keys, ['x'], batch_size=20)
+    assert np.allclose(results['mean'], X[:, 0].mean())
+    assert np.allclose(results['size'], (40 * 20 + 10 * 10) / 50.)
+
+    results = training.test(data_iter, f_test, keys, ['x'], batch_size=20,
+                            n_samples=5)
+    assert np.allclose(results['mean'],
+                       X[range(5) + range(20, 25) + range(40, 45), 0].mean())
+    assert np.allclose(results['size'], 5)
+
+    results = training.test(PrefetchDataset(data_iter), f_test, keys, ['x'])
+    assert np.allclose(results['mean'], X[:, 0].mean())
+    assert data_iter.drop_last
+
+    calls = []
+    def f_count(x):
+        calls.append(x.shape[0])
+        return f_test(x)
+    training.test(data_iter, f_count, keys, ['x'], max_samples=0)
+    assert calls == []
+
+    results = training.test(PrefetchDataset(data_iter), f_test, keys, ['x'],
+                            max_samples=14)
+    assert np.allclose(results['mean'], data_iter.X[:14, 0].mean())
+    assert data_iter.pos == 0
+
+def test_main_loop_save(epochs=2):
+    out_path = tempfile.mkdtemp()
+    try:
+        train = make_dataset(batch_size=5)
+        valid = make_dataset(batch_size=5)
+        tparams = OrderedDict(
+            W=theano.shared(np.ones((3, 2), dtype=floatX), name='W'))
+        saved = []
+
+        # Save functions without `savez` still work with `async_save`.
+        def save(tparams, outfile):
+            saved.append(outfile)
+            np.savez(outfile, **dict((k, v.get_value())
+                                     for k, v in tparams.iteritems()))
+
+        training.main_loop(
+            train, valid, tparams, lambda x, lr: [x.mean()], None,
+            lambda x: [x.mean()], ['cost'], epochs=epochs, learning_rate=0.1,
+            extra_outs_keys=['cost'], valid_key='cost', name='test',
+            out_path=out_path, save=save)
+        assert len(saved) >= 3
+        assert all(path.isfile(f) for f in saved)
+    finally:
+        shutil.rmtree(out_path)
+
+def test_set_functions():
+    cache_dir = tempfile.mkdtemp()
+    try:
+        def make_tparams():
+            return OrderedDict(
+                W=theano.shared(np.ones((3, 2), dtype=floatX), name='W'))
+
+        for i in xrange(3):
+            tparams = make_tparams()
+            built = []
+
+            def build():
+                built.append(True)
+                W = tparams['W']
+                X = T.matrix('x', dtype=floatX)
+                cost = T.dot(X, W).sum()
+                g = theano.shared(np.zeros((3, 2), dtype=floatX), name='g')
+                f_grad = theano.function([X], cost,
+                                         updates=[(g, T.grad(cost, W))])
+                f_update = theano.function([], [], updates=[(W, W - g)])
+                return OrderedDict(f_grad=f_grad, f_update=f_update,
+                                   keys=['cost'])
+
+            functions = training.set_functions(
+                build, tparams, function_cache=cache_dir, dim=3 + (i // 2))
+            assert len(built) == (0 if i == 1 else 1)
+            assert functions['keys'] == ['cost']
+
+            functions['f_grad'](np.ones((1, 3), dtype=floatX))
+            functions['f_update']()
+            assert np.allclose(tparams['W'].get_value(), 0.)
+        assert len(os.listdir(cache_dir)) == 2
+    finally:
+        shutil.rmtree(cache_dir)
@@ -0,0 +1,87 @@
+'''
+Tests for the background writer.
+'''
+
+import numpy as np
+import os
+from os import path
+import shutil
+import tempfile
+import theano
+
+from cortex.utils import floatX
+from cortex.utils.monitor import SimpleMonitor
+from cortex.utils.writer import AsyncWriter, takes_savez
+
+
+def test_savez(n=5):
+    out_path = tempfile.mkdtemp()
+    try:
+        W = theano.shared(np.zeros((3, 4), dtype=floatX), name='W')
+        writer = AsyncWriter()
+
+        def save(tparams, out_file, savez=np.savez):
+            savez(out_file, W=tparams['W'].get_value(), dim=3)
+
+        for i in xrange(n):
+            W.set_value(W.get_value() + 1)
+            writer.save(save, dict(W=W), path.join(out_path, 'W_%d.npz' % i))
+        writer.close()
+
+        assert sorted(os.listdir(out_path)) == ['W_%d.npz' % i
+                                                for i in xrange(n)]
+        for i in xrange(n):
+            d = np.load(path.join(out_path, 'W_%d.npz' % i))
+            assert np.all(d['W'] == i + 1)
+            assert d['dim'] == 3
+    finally:
+        shutil.rmtree(out_path)
+
+def test_save_monitor():
+    out_path = tempfile.mkdtemp()
+    try:
+        monitor = SimpleMonitor()
+        monitor.update(cost=1., error=0.5, dt_epoch=0.1)
+        monitor.update_valid(cost=2., error=0.25)
+
+        writer = AsyncWriter()
+        writer.save_monitor(monitor, out_path)
+        # The child has its own copy of the monitor.
+        monitor.update(cost=3., error=0.75, dt_epoch=0.2)
+        writer.flush()
+
+        assert sorted(os.listdir(out_path)) == [
+            'monitor.png', 'stats_train.npz', 'stats_valid.npz']
+        d = np.load(path.join(out_path, 'stats_train.npz'))
+        assert np.allclose(d['cost'], [1.])
+        d = np.load(path.join(out_path, 'stats_valid.npz'))
+        assert np.allclose(d['error'], [0.25])
+        writer.close()
+    finally:
+        shutil.rmtree(out_path)
+
+def test_error():
+    writer = AsyncWriter()
+    writer.savez(path.join(tempfile.gettempdir(), 'no_such_dir', 'W.npz'),
+                 W=np.zeros((2,)))
+    try:
+        writer.flush()
+    except (IOError, OSError):
+        pass
+    else:
+        assert False, 'Error in the worker was not raised.'
+    writer.close()
+
+def test_takes_savez():
+    def save_old(tparams, outfile):
+        pass
+
+    def save_new(tparams, outfile, savez=np.savez):
+        pass
+
+    def save_kwargs(tparams, outfile, **kwargs):
+        pass
+
+    assert not takes_savez(save_old)
+    assert takes_savez(save_new)
+    assert takes_savez(save_kwargs)
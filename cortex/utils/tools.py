@@ -28,7 +28,6 @@ from . import floatX
 
 random_seed = random.randint(0, 10000)
 rng_ = np.random.RandomState(random_seed)
-profile = False
 
 # For getting terminal column width
 _, _columns = os.popen('stty size', 'r').read().split()
@@ -196,7 +195,6 @@ def scan(f_scan, seqs, outputs_info, non_seqs, n_steps, name='scan',
         non_sequences=non_seqs,
         name=name,
         n_steps=n_steps,
-        profile=profile,
         strict=strict
     )
 
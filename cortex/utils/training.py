@@ -8,10 +8,14 @@ not as a basis for all training.
 
 import argparse
 from collections import OrderedDict
+import cPickle
+from functools import partial
 from glob import glob
+import hashlib
 import numpy as np
 import os
 from os import path
+import pprint
 from progressbar import (
     Bar,
     Percentage,
@@ -21,21 +25,30 @@ from progressbar import (
     Timer
 )
 import shutil
+import sys
 import theano
 from theano import tensor as T
 import time
 
 from . import op
-from .learning_scheduler import Scheduler
+from . import profiling
+from .parallel import DataParallel, data_parallel
+from ..datasets.prefetch import PrefetchDataset
+from .learning_scheduler import Scheduler, make_stopping
+from .profiling import StepTimer, set_profile
 from .tools import (
     check_bad_nums,
     itemlist,
     load_experiment,
     load_model,
     resolve_path,
-    update_dict_of_lists,
     warn_kwargs
 )
+from .writer import (
+    AsyncWriter,
+    save_monitor,
+    takes_savez
+)
 
 
 def make_argument_parser():
@@ -56,6 +69,8 @@ def make_argument_parser():
     parser.add_argument('-r', '--load_last', action='store_true')
     parser.add_argument('-l', '--load_model', default=None)
     parser.add_argument('-n', '--name', default=None)
+    parser.add_argument('-c', '--function_cache', default=None,
+                        help='Directory for caching compiled functions')
     return parser
 
 def make_argument_parser_test():
@@ -108,6 +123,9 @@ def set_experiment(args):
     exp_dict = load_experiment(path.abspath(args['experiment']))
     exp_dict.update(args)
 
+    if 'profile' in exp_dict.keys():
+        set_profile(exp_dict.pop('profile'))
+
     if not 'out_path' in exp_dict.keys():
         exp_dict['out_path'] = resolve_path('$outs')
 
@@ -255,8 +273,8 @@ def set_params(tparams, updates, excludes=[]):
     return tparams, all_params
 
 def set_optimizer(inputs, cost, tparams, constants, updates, extra_outs,
-                  optimizer='sgd', optimizer_args=None,
-                  **learning_args):
+                  optimizer='sgd', optimizer_args=None, nan_policy='abort',
+                  nan_check_every=1, n_workers=1, **learning_args):
     '''Sets the parameter update functions with optimizer.
 
     Args:
@@ -269,12 +287,23 @@ def set_optimizer(inputs, cost, tparams, constants, updates, extra_outs,
         optimizer (Optional[str]): optimizer string. See `utils.op` for details.
             Defaults to `sgd`.
         optimizer_args (Optional[dict]): optional arguments for optimizer.
+            Set `fused` to False to stage the gradients in shared variables
+            and update in a second call.
+        nan_policy (Optional[str]): what to do with steps with NaN or Inf in
+            the cost or gradients: `abort`, `skip` or `rollback`. If None,
+            the outputs are checked on the host after each step. See
+            `utils.op.StepGuard`.
+        nan_check_every (int): number of steps between checks for NaN or
+            Inf.
+        n_workers (int): if more than 1, batches are split among this number
+            of processes and the step is fused. See `utils.parallel`.
         **learning_args: extra kwargs for learning not used.
 
     Returns:
-        theano.function: gradient function.
-        theano.function: update function.
-        dict: extra learning keyword arguments.
+        theano.function: gradient function. If fused (default), also updates
+            the parameters and takes the learning rate(s) after the inputs.
+        theano.function or None: update function. None if fused.
+        dict: extra learning keyword arguments, with `guard` for `main_loop`.
 
     '''
 
@@ -285,16 +314,145 @@ def set_optimizer(inputs, cost, tparams, constants, updates, extra_outs,
 
     updates = theano.OrderedUpdates(updates)
 
+    if nan_policy is not None:
+        guard = op.StepGuard(nan_policy, check_every=nan_check_every)
+    else:
+        guard = None
+
     lr = T.scalar(name='lr')
-    f_grad_shared, f_grad_updates = eval('op.' + optimizer)(
-        lr, tparams, grads, inputs, cost, extra_ups=updates,
-        extra_outs=extra_outs, **optimizer_args)
+    if n_workers > 1:
+        f_grad_shared, f_grad_updates = data_parallel(
+            eval('op.' + optimizer), lr, tparams, grads, inputs, cost,
+            extra_ups=updates, extra_outs=extra_outs, n_workers=n_workers,
+            guard=guard, **optimizer_args)
+    else:
+        f_grad_shared, f_grad_updates = eval('op.' + optimizer)(
+            lr, tparams, grads, inputs, cost, extra_ups=updates,
+            extra_outs=extra_outs, guard=guard, **optimizer_args)
 
+    learning_args['guard'] = guard
     return f_grad_shared, f_grad_updates, learning_args
 
-def test(data_iter, f_test, f_test_keys, input_keys, n_samples=None):
+# Flags that change what theano compiles.
+function_cache_flags = ['floatX', 'device', 'mode', 'optimizer',
+                        'optimizer_including', 'optimizer_excluding',
+                        'optimizer_requiring', 'linker', 'cxx', 'openmp',
+                        'allow_gc', 'blas.ldflags', 'profile',
+                        'profile_memory']
+
+def function_cache_key(**key_args):
+    '''Key for a set of compiled functions.
+
+    The key depends on the arguments, the theano version and flags, and the
+    modification times of the cortex source files.
+
+    Args:
+        **key_args: everything the graph depends on.
+
+    Returns:
+        str: sha1 hex digest.
+
+    '''
+    flags = OrderedDict()
+    for flag in function_cache_flags:
+        v = theano.config
+        try:
+            for k in flag.split('.'):
+                v = getattr(v, k)
+        except AttributeError:
+            v = None
+        flags[flag] = v
+
+    source_dir = path.dirname(path.dirname(path.abspath(__file__)))
+    sources = []
+    for root, dirs, files in os.walk(source_dir):
+        for f in sorted(files):
+            if f.endswith('.py'):
+                stat = os.stat(path.join(root, f))
+                sources.append((path.join(root, f), stat.st_mtime, stat.st_size))
+    sources.sort()
+
+    h = hashlib.sha1()
+    h.update(pprint.pformat(key_args))
+    h.update(pprint.pformat(flags))
+    h.update(theano.__version__)
+    h.update(repr(sources))
+    return h.hexdigest()
+
+def set_functions(build, tparams, function_cache=None, **key_args):
+    '''Compiles functions, or loads them from a cache of compiled functions.
+
+    On a cache hit the graph is not formed and nothing is compiled. The
+    shared variables in `tparams` keep their values and take over the
+    storage of the matching variables in the loaded functions, so the
+    functions train and test the current model. Functions compiled earlier
+    with `tparams` no longer see their updates. Other shared variables (e.g.,
+    optimizer state) are shared among the loaded functions as they were when
+    saved.
+
+    Args:
+        build (function): Takes no arguments, forms the graph and returns an
+            OrderedDict of theano functions and other picklable objects
+            (e.g., lists of keys).
+        tparams (OrderedDict): all shared parameters of the models.
+        function_cache (Optional[str]): directory of the cache. If None,
+            functions are compiled and not cached.
+        **key_args: everything the graph depends on: model hyperparameters,
+            input shapes, optimizer, etc. See `function_cache_key`.
+
+    Returns:
+        OrderedDict: the outputs of `build`.
+
+    '''
+    if function_cache is None:
+        return build()
+
+    function_cache = resolve_path(function_cache)
+    if not path.isdir(function_cache):
+        os.makedirs(function_cache)
+    cache_file = path.join(function_cache,
+                           'functions_%s.pkl' % function_cache_key(**key_args))
+
+    recursion_limit = sys.getrecursionlimit()
+    sys.setrecursionlimit(max(recursion_limit, 50000))
+    try:
+        if path.isfile(cache_file):
+            print 'Loading compiled functions from %s' % cache_file
+            try:
+                with open(cache_file, 'rb') as f:
+                    cached = cPickle.load(f)
+            except Exception as e:
+                print 'Failed to load compiled functions (%s)' % e
+            else:
+                # The current shared variables take over the storage of the
+                # loaded ones, keeping their values.
+                for k, v in cached['tparams'].iteritems():
+                    if k in tparams:
+                        v.set_value(tparams[k].get_value(borrow=True),
+                                    borrow=True)
+                        tparams[k].container = v.container
+                functions = cached['functions']
+                return functions
+
+        functions = build()
+        print 'Saving compiled functions to %s' % cache_file
+        with open(cache_file + '.tmp', 'wb') as f:
+            cPickle.dump(dict(functions=functions, tparams=tparams), f,
+                         protocol=cPickle.HIGHEST_PROTOCOL)
+        os.rename(cache_file + '.tmp', cache_file)
+        return functions
+    finally:
+        sys.setrecursionlimit(recursion_limit)
+
+def test(data_iter, f_test, f_test_keys, input_keys, n_samples=None,
+         batch_size=None, max_samples=None):
     '''Tests the model using a data iterator.
 
+    Results are averaged over samples: each batch is weighted by its number
+    of rows (of the first input), so the short last batch, which is not
+    dropped here, does not bias the result. Outputs that are not scalars are
+    averaged first.
+
     Args:
         data_iter (Dataset): dataset iterator.
         f_test (theano.function)
@@ -304,6 +462,11 @@ def test(data_iter, f_test, f_test_keys, input_keys, n_samples=None):
             for `f_test`.
         n_samples (Optional[int]) If not None, use only this number of samples
             as input to `f_test`.
+        batch_size (Optional[int]): If not None, batch size for testing
+            instead of that of `data_iter`. Larger batches make fewer calls
+            to `f_test`, at the cost of memory.
+        max_samples (Optional[int]): If not None, stop after this number of
+            samples.
 
     Returns:
         OrderedDict: dictionary of np.array results.
@@ -311,50 +474,62 @@ def test(data_iter, f_test, f_test_keys, input_keys, n_samples=None):
     '''
     data_iter.reset()
     maxvalid = data_iter.n
+    if max_samples is not None:
+        maxvalid = min(maxvalid, max_samples)
+
+    # Every sample is tested, also those of a short last batch.
+    dataset = getattr(data_iter, 'dataset', data_iter)
+    drop_last = getattr(dataset, 'drop_last', None)
+    if drop_last is not None:
+        dataset.drop_last = False
 
     widgets = ['Testing (%s set): ' % data_iter.mode, Percentage(),
                ' (', Timer(), ')']
     pbar    = ProgressBar(widgets=widgets, maxval=maxvalid).start()
-    results = OrderedDict()
-    while True:
-        try:
-            outs = data_iter.next()
+    sums = np.zeros((len(f_test_keys),), dtype='float64')
+    means = np.zeros((len(f_test_keys),), dtype='float64')
+    total = 0
+    try:
+        while max_samples is None or total < max_samples:
+            try:
+                if batch_size is None:
+                    outs = data_iter.next()
+                else:
+                    outs = data_iter.next(batch_size=batch_size)
+            except StopIteration:
+                print
+                break
+
             inps = [outs[k] for k in input_keys]
             if n_samples is not None:
                 inps = [x[:n_samples] for x in inps]
             r = f_test(*inps)
-            results_i = dict((k, v) for k, v in zip(f_test_keys, r))
-
-            for k, v in results_i.iteritems():
-                if isinstance(v, theano.sandbox.cuda.CudaNdarray):
-                    results_i[k] = np.asarray(v)
 
-            update_dict_of_lists(results, **results_i)
+            for i, v in enumerate(r):
+                means[i] = np.mean(v)
+            n = inps[0].shape[0]
+            sums += n * means
+            total += n
 
-            if data_iter.pos == -1:
+            if data_iter.pos == -1 or data_iter.pos >= maxvalid:
                 pbar.update(maxvalid)
             else:
                 pbar.update(data_iter.pos)
-
-        except StopIteration:
+        else:
             print
-            break
-
-    for k, v in results.iteritems():
-        try:
-            results[k] = np.mean(v)
-        except Exception as e:
-            print k
-            print v
-            raise e
+    finally:
+        data_iter.reset()
+        if drop_last is not None:
+            dataset.drop_last = drop_last
 
-    data_iter.reset()
+    results = OrderedDict(
+        (k, v) for k, v in zip(f_test_keys, sums / max(total, 1)))
 
     return results
 
 def validate(tparams, results, best_valid, e, best_epoch,
              save=None, valid_key=None, valid_sign=None, bestfile=None,
-             **kwargs):
+             scheduler=None, early_stopping=None, **kwargs):
     '''Generic validation method.
 
     Compares the validation result against previous best.
@@ -369,10 +544,15 @@ def validate(tparams, results, best_valid, e, best_epoch,
         save (function): Method for saving params.
         valid_key (str): Key from results to test against best_valid.
         bestfile (str): Path to best file.
+        scheduler (Optional[Scheduler]): Its learning rates that decay on
+            plateaus are updated with the validation result.
+        early_stopping (Optional[function]): Stopping criterion. See
+            `learning_scheduler.make_stopping`.
 
     Returns:
         float: best valid
         int: best epoch
+        bool: True if training should stop.
 
     '''
     warn_kwargs(None, **kwargs)
@@ -391,7 +571,12 @@ def validate(tparams, results, best_valid, e, best_epoch,
     else:
         print 'Best (%.2f) at epoch %d' % (best_valid, best_epoch)
 
-    return best_valid, best_epoch
+    if scheduler is not None:
+        scheduler.update_valid(valid_value)
+
+    stop = early_stopping is not None and early_stopping(valid_value, e)
+
+    return best_valid, best_epoch, stop
 
 def main_loop(train, valid, tparams,
               f_grad_shared, f_grad_updates, f_test, f_test_keys,
@@ -406,9 +591,18 @@ def main_loop(train, valid, tparams,
               epochs=None,
               learning_rate=None,
               learning_rate_scheduler=None,
+              learning_rate_schedule=None,
+              reduce_on_plateau=None,
+              early_stopping=None,
               monitor=None,
               out_path=None,
               extra_outs_keys=None,
+              prefetch=2,
+              test_batch_size=None,
+              test_train=True,
+              async_save=True,
+              time_steps=None,
+              guard=None,
               **validation_args):
     '''Generic main loop.
 
@@ -419,8 +613,12 @@ def main_loop(train, valid, tparams,
         valid (Dataset): Validation dataset.
         tparams (OrderedDict): dictionary of Theano.shared.
             Parameters of the model.
-        f_grad_shared (theano.function): Computes gradients.
-        f_grad_updates (theano.function): Updates parameters.
+        f_grad_shared (theano.function): Computes gradients. Can be a
+            `utils.parallel.DataParallel` step, whose workers are stopped at
+            the end.
+        f_grad_updates (theano.function or None): Updates parameters. If None,
+            `f_grad_shared` is a fused step that takes the learning rate(s)
+            after the inputs and updates the parameters.
         f_test (theano.function): Tests model are returns results.
         f_test_keys (list): List of keys that go with `f_test`.
         input_keys (Optional[list]): If not None, used to extract
@@ -433,15 +631,49 @@ def main_loop(train, valid, tparams,
         output_every (Optional[int]): If not None, print rvals from
             `f_grad_shared` and save images.
         name (str): Name of experiment.
-        save (function): Saving function for parameters.
+        save (function): Saving function for parameters. Takes `tparams`,
+            the output file and, optionally, a `savez` function to use
+            instead of `np.savez`. Only functions with a `savez` argument
+            are saved asynchronously.
         save_images (Optional[function]): Function to save images.
         epochs (int): Number of training epochs.
         learning_rate (float).
-        learning_rate_scheduler (Optional[Scheduler]): For scheduling learning
-            rate.
+        learning_rate_scheduler (Optional[dict]): For scheduling learning
+            rate. Arguments of `Scheduler`.
+        learning_rate_schedule (Optional[dict]): Same as
+            `learning_rate_scheduler`, as named in the learning args of the
+            demos.
+        reduce_on_plateau (Optional[dict]): If not None, learning rates
+            decay when the validation result stops improving. Arguments of
+            `learning_scheduler.ReduceOnPlateau`, e.g.,
+            `{factor: 0.5, patience: 3}`.
+        early_stopping (Optional[dict, str or function]): If not None,
+            stopping criterion on the validation result, e.g.,
+            `{patience: 10, min_delta: 0.01}`. See
+            `learning_scheduler.make_stopping`.
         monitor (utils.monitor.Monitor).
         out_path (str): Director path for output files.
         extra_outs_keys (list): Keys for extra outs of `f_grad_shared`.
+        prefetch (Optional[int]): If not 0 or None, number of batches drawn
+            ahead in a background thread for `train` and `valid`. See
+            `datasets.prefetch.PrefetchDataset`.
+        test_batch_size (Optional[int]): If not None, batch size for testing.
+            See `test`.
+        test_train (bool or int): If False (or 0), the training set is not
+            tested.
+            If an int, at most this number of training samples are tested.
+        async_save (bool): If True, checkpoints are written in a background
+            thread and monitor plots in a child process. See
+            `utils.writer.AsyncWriter`.
+        time_steps (Optional[bool]): If True, the time spent in each phase of
+            training (fetching data, the gradient step, checking, updating,
+            testing, saving and saving images) is printed and added to the
+            monitor at each test. If None, `utils.profiling.time_steps` is
+            used, which is set from the experiment. See
+            `utils.profiling.StepTimer`.
+        guard (Optional[utils.op.StepGuard]): In-graph check for NaN or Inf
+            in the steps, from `set_optimizer`. If None, the outputs of
+            `f_grad_shared` are checked on the host after each step.
         **validation_args: Arguments for test.
 
     '''
@@ -449,29 +681,67 @@ def main_loop(train, valid, tparams,
     best_valid = float('inf')
     best_epoch = 0
 
+    if learning_rate_scheduler is None:
+        learning_rate_scheduler = learning_rate_schedule
     if learning_rate_scheduler is not None:
-        learning_rate_scheduler = Scheduler(**learning_rate_scheduler)
+        learning_rate_scheduler = Scheduler(plateau=reduce_on_plateau,
+                                            **learning_rate_scheduler)
         learning_rate = [v['learning_rate'] for v in learning_rate_scheduler.d.values()]
     elif isinstance(learning_rate, float):
         learning_rate = (learning_rate,)
+    if learning_rate_scheduler is None and reduce_on_plateau is not None:
+        learning_rate_scheduler = Scheduler(plateau=reduce_on_plateau)
+        for i, lr in enumerate(learning_rate):
+            learning_rate_scheduler.add('learning_rate_%d' % i, lr)
+    early_stopping = make_stopping(early_stopping)
 
     if input_keys is None:
         input_keys = [train.name]
 
+    if prefetch:
+        print 'Prefetching %d batches in the background' % prefetch
+        train = PrefetchDataset(train, depth=prefetch)
+        valid = PrefetchDataset(valid, depth=prefetch)
+
     if out_path is not None:
         bestfile = path.join(out_path, '{name}_best.npz'.format(name=name))
     else:
         bestfile = None
 
+    if async_save:
+        writer = AsyncWriter()
+        # Save functions without `savez` write synchronously, as before.
+        if save is not None and takes_savez(save):
+            save = partial(writer.save, save)
+    else:
+        writer = None
+
+    if time_steps is None:
+        time_steps = profiling.time_steps
+    # All phases are reported from the first epoch on, so that the monitor
+    # series keep the same keys.
+    phases = ['fetch', 'grad', 'check']
+    if f_grad_updates is not None:
+        phases.append('update')
+    phases += ['test', 'save']
+    if save_images is not None and out_path is not None:
+        phases.append('images')
+    timer = StepTimer(phases=phases)
+
+    if guard is not None:
+        guard.reset()
+
     try:
         epoch_t0 = time.time()
         s = 0
         e = 0
+        stop = False
 
         widgets = ['Epoch {epoch} (training {name}, '.format(epoch=e, name=name),
                    Timer(), '): ', Bar()]
         epoch_pbar = ProgressBar(widgets=widgets, maxval=train.n).start()
         training_time = 0
+        timer.start()
         while True:
             try:
                 outs = train.next()
@@ -480,9 +750,12 @@ def main_loop(train, valid, tparams,
                     epoch_pbar.update(train.n)
                 else:
                     epoch_pbar.update(train.pos)
+                timer.lap('fetch')
 
             except StopIteration:
-                if (test_every is None) or ((e + 1) % test_every == 0):
+                timer.start()
+                tested = (test_every is None) or ((e + 1) % test_every == 0)
+                if tested:
                     print
                     if f_extra is not None:
                         print 'Performing initial evaluation function...'
@@ -490,14 +763,28 @@ def main_loop(train, valid, tparams,
                     epoch_t1 = time.time()
                     dt_epoch = epoch_t1 - epoch_t0
                     training_time += dt_epoch
-                    results = test(train, f_test, f_test_keys, input_keys,
-                                   n_samples=valid.n)
-                    results_valid = test(valid, f_test, f_test_keys, input_keys)
-                    best_valid, best_epoch = validate(
+                    if not test_train:
+                        results = OrderedDict()
+                    else:
+                        results = test(
+                            train, f_test, f_test_keys, input_keys,
+                            n_samples=valid.n, batch_size=test_batch_size,
+                            max_samples=(None if test_train is True
+                                         else test_train))
+                    results_valid = test(valid, f_test, f_test_keys, input_keys,
+                                         batch_size=test_batch_size)
+                    timer.lap('test')
+
+                    best_valid, best_epoch, stop = validate(
                         tparams,
                         results_valid, best_valid, e, best_epoch,
                         bestfile=bestfile,
-                        save=save, **validation_args)
+                        save=save, scheduler=learning_rate_scheduler,
+                        early_stopping=early_stopping, **validation_args)
+                    if learning_rate_scheduler is not None:
+                        learning_rate = [
+                            v['learning_rate']
+                            for v in learning_rate_scheduler.d.values()]
 
                     if monitor is not None:
                         monitor.update(**results)
@@ -505,16 +792,28 @@ def main_loop(train, valid, tparams,
                                        training_time=training_time)
                         monitor.update_valid(**results_valid)
                         monitor.display()
-                        if out_path is not None:
-                            monitor.save(path.join(out_path, 'monitor.png'))
-                            monitor.save_stats(
-                                path.join(out_path, 'stats_train.npz'))
-                            monitor.save_stats_valid(
-                                path.join(out_path, 'stats_valid.npz'))
+                        if out_path is not None and monitor.needs_save():
+                            if writer is not None:
+                                writer.save_monitor(monitor, out_path)
+                            else:
+                                save_monitor(monitor, out_path)
+                    timer.lap('save')
                 if (save_images is not None
                     and out_path is not None
                     and (show_every is None or ((e + 1) % show_every == 0))):
                     save_images()
+                    timer.lap('images')
+                if tested:
+                    # After saving, so that its time is in this epoch.
+                    if time_steps:
+                        timer.display()
+                        if monitor is not None:
+                            monitor.update(**timer.summary())
+                    timer.reset()
+                if stop:
+                    print 'Stopping early at epoch %d (best at epoch %d)' % (
+                        e, best_epoch)
+                    break
 
                 e += 1
 
@@ -525,29 +824,51 @@ def main_loop(train, valid, tparams,
                 widgets = ['Epoch {epoch} ({name}, '.format(epoch=e, name=name),
                            Timer(), '): ', Bar()]
                 epoch_pbar = ProgressBar(widgets=widgets, maxval=train.n).start()
+                timer.start()
 
                 continue
 
             if e > epochs:
                 break
 
-            rval = f_grad_shared(*inps)
+            if f_grad_updates is None:
+                rval = f_grad_shared(*(inps + list(learning_rate)))
+            else:
+                rval = f_grad_shared(*inps)
+            timer.lap('grad')
             if output_every is not None and s % output_every == 0:
                 for k, v in zip(rval, extra_outs_keys):
                     print k, v
 
                 if save_images is not None and out_path is not None:
                     save_images()
-            check_bad_nums(rval, extra_outs_keys)
-            if check_bad_nums(rval[:1], extra_outs_keys[:1]):
-                print 'Dying, found bad cost... Sorry (bleh)'
-                exit()
-            f_grad_updates(*learning_rate)
+                    timer.lap('images')
+            if guard is None:
+                check_bad_nums(rval, extra_outs_keys)
+                if check_bad_nums(rval[:1], extra_outs_keys[:1]):
+                    print 'Dying, found bad cost... Sorry (bleh)'
+                    exit()
+                timer.lap('check')
+            if f_grad_updates is not None:
+                f_grad_updates(*learning_rate)
+                timer.lap('update')
             s += 1
+            if guard is not None and s % guard.check_every == 0:
+                if not guard.check():
+                    check_bad_nums(rval, extra_outs_keys)
+                    print 'Dying, found bad numbers... Sorry (bleh)'
+                    exit()
+                timer.lap('check')
 
     except KeyboardInterrupt:
         print 'Training interrupted.'
 
+    if prefetch:
+        train.close()
+        valid.close()
+    if isinstance(f_grad_shared, DataParallel):
+        f_grad_shared.close()
+
     try:
         if out_path is not None:
             outfile = path.join(out_path, '{name}_{t}.npz'.format(name=name, t=int(time.time())))
@@ -558,6 +879,8 @@ def main_loop(train, valid, tparams,
                 save(tparams, outfile)
                 save(tparams, last_outfile)
                 print 'Done saving.'
+        if writer is not None:
+            writer.close()
     except KeyboardInterrupt:
         print 'Saving interupted.'
 
@@ -0,0 +1,194 @@
+'''
+Background writer for checkpoints and monitor output.
+'''
+
+import inspect
+import multiprocessing as mp
+import numpy as np
+import os
+from os import path
+import Queue
+import threading
+
+
+def _tmp_path(out_file):
+    '''Temporary path with the same extension as `out_file`.
+
+    Keeps the extension so that writers that infer the format from it (e.g.,
+    `plt.savefig`) or append one (e.g., `np.savez`) write where expected.
+
+    '''
+    root, ext = path.splitext(out_file)
+    return root + '.tmp' + ext
+
+def write_atomic(out_file, f_write):
+    '''Writes a file with `f_write` to a temporary path, then renames it.
+
+    Args:
+        out_file (str): path of the file.
+        f_write (function): function that takes a path and writes to it. It
+            may write nothing, in which case `out_file` is left as is.
+
+    '''
+    tmp_file = _tmp_path(out_file)
+    f_write(tmp_file)
+    if path.exists(tmp_file):
+        os.rename(tmp_file, out_file)
+
+def takes_savez(save):
+    '''Whether a save function takes a `savez` argument.
+
+    Args:
+        save (function): save function, see `AsyncWriter.save`.
+
+    Returns:
+        bool.
+
+    '''
+    try:
+        argspec = inspect.getargspec(save)
+    except TypeError:
+        return False
+    return 'savez' in argspec.args or argspec.keywords is not None
+
+def save_monitor(monitor, out_path):
+    '''Saves the monitor figure and stats to `out_path`.
+
+    Args:
+        monitor (utils.monitor.SimpleMonitor).
+        out_path (str): directory for the output files.
+
+    '''
+    write_atomic(path.join(out_path, 'monitor.png'), monitor.save)
+    write_atomic(path.join(out_path, 'stats_train.npz'), monitor.save_stats)
+    write_atomic(path.join(out_path, 'stats_valid.npz'),
+                 monitor.save_stats_valid)
+
+
+class AsyncWriter(object):
+    '''Writes checkpoints and monitor output without stalling training.
+
+    Parameter snapshots are compressed and written in a worker thread, and
+    monitor plots are rendered in a forked process that has its own copy of
+    the monitor. Every file is written to a temporary path and renamed, so an
+    interrupted write never leaves a partial file behind.
+
+    Errors in the worker are raised on the next call to `savez`, `flush` or
+    `close`.
+
+    Attributes:
+        max_pending (int): maximum number of checkpoints waiting to be
+            written. `savez` blocks when this is reached.
+
+    '''
+    def __init__(self, max_pending=2):
+        '''Init function for AsyncWriter.
+
+        Args:
+            max_pending (int): maximum number of checkpoints waiting to be
+                written.
+
+        '''
+        self.max_pending = max_pending
+        self._queue = Queue.Queue(maxsize=max_pending)
+        self._error = None
+        self._worker = threading.Thread(target=self._write, name='writer')
+        self._worker.daemon = True
+        self._worker.start()
+        self._plotter = None
+
+    def _write(self):
+        '''Worker loop. Runs until `None` is taken from the queue.
+
+        '''
+        while True:
+            item = self._queue.get()
+            try:
+                if item is None:
+                    return
+                out_file, arrays = item
+                write_atomic(
+                    out_file, lambda f: np.savez_compressed(f, **arrays))
+            except Exception as e:
+                self._error = e
+            finally:
+                self._queue.task_done()
+
+    def _check(self):
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise error
+
+    def savez(self, out_file, **arrays):
+        '''Queues arrays to be saved to a compressed npz file.
+
+        The arrays are not copied: they must be snapshots (e.g., from
+        `get_value()`) that are not modified afterwards.
+
+        Args:
+            out_file (str): path of the npz file.
+            **arrays: arrays to save.
+
+        '''
+        self._check()
+        if self._worker is None:
+            raise ValueError('Writer is closed.')
+        self._queue.put((out_file, arrays))
+
+    def save(self, save, tparams, out_file):
+        '''Calls a demo save function with `savez` from this writer.
+
+        Args:
+            save (function): function that takes `tparams`, `out_file` and
+                `savez`.
+            tparams (OrderedDict): dictionary of Theano shared variables.
+            out_file (str): path of the npz file.
+
+        '''
+        save(tparams, out_file, savez=self.savez)
+
+    def save_monitor(self, monitor, out_path):
+        '''Saves the monitor figure and stats in a child process.
+
+        The child is forked with a copy of the monitor, so the monitor can be
+        updated right away. If the previous child is still rendering, this
+        waits for it.
+
+        Args:
+            monitor (utils.monitor.SimpleMonitor).
+            out_path (str): directory for the output files.
+
+        '''
+        self._join_plotter()
+        self._plotter = mp.Process(target=save_monitor,
+                                   args=(monitor, out_path))
+        self._plotter.daemon = True
+        self._plotter.start()
+
+    def _join_plotter(self):
+        if self._plotter is not None:
+            self._plotter.join()
+            if self._plotter.exitcode != 0:
+                print ('Saving monitor failed (exit code %d)'
+                       % self._plotter.exitcode)
+            self._plotter = None
+
+    def flush(self):
+        '''Waits until everything queued so far is written.
+
+        '''
+        self._queue.join()
+        self._join_plotter()
+        self._check()
+
+    def close(self):
+        '''Writes everything queued and stops the worker.
+
+        '''
+        if self._worker is None:
+            return
+        self._queue.put(None)
+        self._worker.join()
+        self._worker = None
+        self._join_plotter()
+        self._check()